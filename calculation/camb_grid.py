@@ -0,0 +1,141 @@
+import hashlib
+import itertools
+import os
+from concurrent import futures
+
+import camb
+import numpy as np
+
+
+def grid_points(param_range):
+    """ Expands parameter ranges into the list of grid points.
+
+    Arguments:
+        param_range (dict): Parameter name (dotted CAMB attribute, e.g.
+            'Reion.optical_depth') to [start, end, step].
+
+    Returns:
+        List of dicts of parameter name to value. The points run over the
+        values of each parameter from start to end, with the last
+        parameter varying slowest and the first one fastest.
+    """
+    names = list(param_range.keys())[::-1]
+    values = []
+    for name in names:
+        start, end, step = param_range[name]
+        numsteps = round((end - start) / step) + 1
+        values.append([float(val) for val in
+                       np.linspace(start, end, num=numsteps)])
+    return [dict(zip(names, point)) for point in itertools.product(*values)]
+
+
+def point_key(base_param_file, params):
+    """ Cache key of a grid point: a hash of the full CAMB parameter set.
+
+    The set is the CAMB parameters resolved from the base parameter file
+    (including any files it reads in) with the point's values applied,
+    together with the CAMB version, so that editing an included file or
+    upgrading CAMB does not reuse stale spectra.
+    """
+    model = _read_params(base_param_file, params)
+    sha = hashlib.sha1()
+    sha.update(camb.__version__.encode())
+    sha.update(repr(model).encode())
+    return sha.hexdigest()
+
+
+def _read_params(base_param_file, params):
+    """ Reads the CAMB parameters of a grid point.
+
+    Arguments:
+        base_param_file (string): The CAMB parameter file.
+        params (dict): Dotted CAMB attribute (e.g. 'Reion.optical_depth')
+            to the value it is set to.
+
+    Returns:
+        The camb.CAMBparams.
+    """
+    model = camb.read_ini(base_param_file)
+    for name, value in params.items():
+        namelist = name.split('.')
+        currobj = model
+        for attr in namelist[:-1]:
+            currobj = getattr(currobj, attr)
+        setattr(currobj, namelist[-1], value)
+    return model
+
+
+def compute_cls(base_param_file, params):
+    """ Total CMB spectra of one grid point, as returned by CAMB.
+
+    A fresh set of CAMB parameters is read from base_param_file, so that
+    points can be run independently in different processes.
+
+    Returns:
+        Array of shape (lmax + 1, 5) with l and the TT, EE, BB and TE
+        l(l+1)Cl/2pi in muK^2, as the Cl files written by run_likelihood.
+    """
+    model = _read_params(base_param_file, params)
+    cls = camb.get_results(model).get_total_cls(CMB_unit='muK')
+    ells = np.arange(len(cls)).reshape(len(cls), 1)
+    return np.append(ells, cls, axis=1)
+
+
+def run_grid(base_param_file, param_range, cache_dir, num_processes=None):
+    """ Computes the spectra of a parameter grid on a process pool.
+
+    See run_points for the caching.
+
+    Arguments:
+        base_param_file (string): The CAMB parameter file that is modified
+            for each point.
+        param_range (dict): The parameter ranges, as for grid_points.
+        cache_dir (string): The directory of the cached spectra.
+        num_processes (int): Number of worker processes. None means the
+            number of CPUs.
+
+    Returns:
+        List of (params, cls) tuples, one per grid point in the order of
+        grid_points, where cls is as returned by compute_cls.
+    """
+    return run_points(base_param_file, grid_points(param_range), cache_dir,
+                      num_processes)
+
+
+def run_points(base_param_file, points, cache_dir, num_processes=None):
+    """ Computes the spectra of a list of parameter points.
+
+    Every point is stored in cache_dir as a binary .npy file named by
+    point_key, so a rerun (or a resumed run, or a different likelihood
+    on the same points) only computes the points that are not there yet.
+    The missing points are run on a process pool.
+
+    Arguments:
+        base_param_file (string): The CAMB parameter file that is modified
+            for each point.
+        points (list of dicts): Parameter name to value for each point.
+        cache_dir (string): The directory of the cached spectra.
+        num_processes (int): Number of worker processes. None means the
+            number of CPUs.
+
+    Returns:
+        List of (params, cls) tuples in the order of points.
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    fnames = [os.path.join(cache_dir, point_key(base_param_file, params) +
+                           '.npy') for params in points]
+    missing = [i for i, fname in enumerate(fnames)
+               if not os.path.exists(fname)]
+    if missing:
+        with futures.ProcessPoolExecutor(max_workers=num_processes) as pool:
+            tasks = {pool.submit(compute_cls, base_param_file, points[i]): i
+                     for i in missing}
+            for task in futures.as_completed(tasks):
+                fname = fnames[tasks[task]]
+                # Written under a temporary name, so that an interrupted
+                # run never leaves a partial file in the cache
+                tmp_fname = fname[:-len('.npy')] + '.tmp.npy'
+                np.save(tmp_fname, task.result())
+                os.replace(tmp_fname, fname)
+    return [(params, np.load(fname)) for params, fname in zip(points, fnames)]
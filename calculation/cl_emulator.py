@@ -0,0 +1,161 @@
+import itertools
+
+import numpy as np
+from numpy.polynomial import chebyshev
+
+from calculation import camb_grid
+
+# Spectra of the columns after the multipole in the CAMB spectra
+_SPECTRA = ('TT', 'EE', 'BB', 'TE')
+
+
+def chebyshev_nodes(low, high, num_nodes):
+    """ Chebyshev nodes (of the first kind) mapped to [low, high]. """
+    if num_nodes == 1 or low == high:
+        return np.array([0.5 * (low + high)])
+    x = np.cos(np.pi * (np.arange(num_nodes) + 0.5) / num_nodes)[::-1]
+    return 0.5 * (low + high) + 0.5 * (high - low) * x
+
+
+class ClEmulator(object):
+    """ Interpolates CAMB spectra over a box in parameter space.
+
+    CAMB is run on a tensor grid of Chebyshev nodes in each parameter
+    (through camb_grid.run_points, so the node spectra are cached). The
+    spectra at the nodes are compressed with a principal component
+    analysis, and the weight of each component is interpolated by a
+    tensor product Chebyshev polynomial. Evaluating a point then costs a
+    few small matrix products.
+
+    Arguments:
+        base_param_file (string): The CAMB parameter file that is modified
+            for each point.
+        bounds (dict): Parameter name (as in camb_grid) to (low, high).
+        num_nodes (int or dict): Number of nodes in each parameter, or a
+            dict with the number for each parameter.
+        cache_dir (string): The directory of the cached CAMB spectra.
+        num_processes (int): Number of processes running CAMB.
+        num_components (int): Number of principal components kept. None
+            keeps all of them, which reproduces the node spectra exactly.
+    """
+
+    def __init__(self, base_param_file, bounds, num_nodes, cache_dir,
+                 num_processes=None, num_components=None):
+        self.base_param_file = base_param_file
+        self.cache_dir = cache_dir
+        self.num_processes = num_processes
+        self.names = list(bounds)
+        self.bounds = np.array([bounds[name] for name in self.names],
+                               dtype=np.float64)
+        if not isinstance(num_nodes, dict):
+            num_nodes = dict.fromkeys(self.names, num_nodes)
+        nodes = [chebyshev_nodes(low, high, num_nodes[name])
+                 for name, (low, high) in zip(self.names, self.bounds)]
+        self.shape = tuple(len(curr_nodes) for curr_nodes in nodes)
+        points = [dict(zip(self.names, point))
+                  for point in itertools.product(*nodes)]
+        results = camb_grid.run_points(base_param_file, points, cache_dir,
+                                       num_processes)
+        spectra = np.array([cls for _, cls in results])
+        self.ells = spectra[0, :, 0]
+        values = spectra[:, :, 1:].reshape(len(spectra), -1)
+        self.mean = values.mean(axis=0)
+        _, _, components = np.linalg.svd(values - self.mean,
+                                         full_matrices=False)
+        if num_components is not None:
+            components = components[:num_components]
+        self.components = components
+        weights = np.dot(values - self.mean, components.T)
+        # Tensor product interpolation: invert the Chebyshev Vandermonde
+        # matrix of each parameter along its axis
+        coeffs = weights.reshape(self.shape + (len(components),))
+        for axis, curr_nodes in enumerate(nodes):
+            vander = chebyshev.chebvander(self._scale(curr_nodes, axis),
+                                          len(curr_nodes) - 1)
+            coeffs = np.moveaxis(np.tensordot(
+                np.linalg.inv(vander), coeffs, axes=(1, axis)), 0, axis)
+        self.coeffs = coeffs
+
+    def _scale(self, values, axis):
+        "Maps parameter values of an axis from its bounds to [-1, 1]."
+        low, high = self.bounds[axis]
+        if low == high:
+            return np.zeros_like(values)
+        return (2 * np.asarray(values) - low - high) / (high - low)
+
+    def evaluate(self, points):
+        """ Emulated spectra of a list of parameter points.
+
+        Arguments:
+            points (list of dicts): Parameter name to value for each point.
+                Points outside the bounds are extrapolated.
+
+        Returns:
+            Array of shape (num_points, lmax + 1, 5), laid out as
+            camb_grid.compute_cls for each point.
+        """
+        for axis, name in enumerate(self.names):
+            x = self._scale([point[name] for point in points], axis)
+            basis = chebyshev.chebvander(x, self.shape[axis] - 1)
+            # Contract the leading parameter axis, keeping the point axis
+            if axis == 0:
+                weights = np.tensordot(basis, self.coeffs, axes=(1, 0))
+            else:
+                weights = np.einsum('pa,pa...->p...', basis, weights)
+        values = self.mean + np.dot(weights, self.components)
+        values = values.reshape(len(points), len(self.ells), -1)
+        ells = np.broadcast_to(self.ells[None, :, None],
+                               (len(points), len(self.ells), 1))
+        return np.concatenate([ells, values], axis=2)
+
+    def __call__(self, params):
+        "Emulated spectra of one parameter point."
+        return self.evaluate([params])[0]
+
+    def validate(self, points=None, num_points=8, seed=0):
+        """ Interpolation error against CAMB at held-out points.
+
+        Arguments:
+            points (list of dicts): The points. If None, num_points points
+                are drawn uniformly within the bounds.
+            num_points (int): Number of random points if points is None.
+            seed (int): Seed of the random points.
+
+        Returns:
+            dict of spectrum name to a dict with 'max_abs', the largest
+            absolute error at l >= 2, 'max_rel', the largest error relative
+            to the largest absolute value of the spectrum (at l >= 2), and
+            'max_cv', the largest error in units of the cosmic variance of
+            the spectrum at each l >= 2. Points where a spectrum is
+            identically zero (e.g. BB without tensors) only enter
+            'max_abs', and so do multipoles of zero cosmic variance
+            'max_cv'; 'max_rel' and 'max_cv' are None when no point or
+            multipole is left.
+        """
+        if points is None:
+            rng = np.random.default_rng(seed)
+            draws = rng.uniform(self.bounds[:, 0], self.bounds[:, 1],
+                                size=(num_points, len(self.names)))
+            points = [dict(zip(self.names, draw)) for draw in draws]
+        truth = np.array([cls for _, cls in camb_grid.run_points(
+            self.base_param_file, points, self.cache_dir,
+            self.num_processes)])
+        errors = np.abs(self.evaluate(points) - truth)[:, 2:, 1:]
+        truth = truth[:, 2:, 1:]
+        ells = self.ells[2:, None]
+        tt, ee, te = truth[..., 0], truth[..., 1], truth[..., 3]
+        cosmic_var = np.sqrt(2. / (2 * ells + 1)) * np.abs(truth)
+        cosmic_var[..., 3] = np.sqrt((tt * ee + te ** 2) /
+                                     (2 * ells[:, 0] + 1))
+        report = {}
+        for i, spec in enumerate(_SPECTRA):
+            scale = np.abs(truth[..., i]).max(axis=1)
+            nonzero = scale > 0
+            rel = errors[nonzero, :, i].max(axis=1) / scale[nonzero]
+            resolved = cosmic_var[..., i] > 0
+            cv = errors[..., i][resolved] / cosmic_var[..., i][resolved]
+            report[spec] = {
+                'max_abs': errors[..., i].max(),
+                'max_rel': rel.max() if rel.size else None,
+                'max_cv': cv.max() if cv.size else None}
+        return report
@@ -0,0 +1,424 @@
+import os
+from concurrent import futures
+
+import numpy as np
+import healpy
+import scipy.linalg
+from scipy.linalg import lapack
+
+from utils import file_utils, fits_io_utils, fits_utils, map_utils
+
+DEFAULT_BLOCK_ROWS = 1024
+
+# Approximate number of bytes of matrix panels the out-of-core routines
+# hold in memory
+DEFAULT_MEMORY_BUDGET = 2 * 1024 ** 3
+
+_COMPONENTS = {1: 'i', 2: 'qu', 3: 'iqu'}
+
+
+def load_dense(mat, block_rows=DEFAULT_BLOCK_ROWS):
+    """ Copies a (possibly memory-mapped) matrix into memory block by block.
+
+    Arguments:
+        mat (np.array): The matrix, typically the 'data' of a covariance
+            matrix read with file_utils.read_covmat(..., mmap=True).
+        block_rows (int): Number of rows copied at a time.
+
+    Returns:
+        C-contiguous float64 copy of the matrix.
+    """
+    n = mat.shape[0]
+    res = np.empty(mat.shape, dtype=np.float64)
+    for start in range(0, n, block_rows):
+        res[start:start + block_rows] = mat[start:start + block_rows]
+    return res
+
+
+def invert(mat, method='cholesky', block_rows=DEFAULT_BLOCK_ROWS):
+    """ Inverts a symmetric covariance matrix.
+
+    The factorizations are done by LAPACK and the products by the BLAS that
+    numpy and scipy are linked against, which is threaded. The whole matrix
+    is copied into memory; use invert_out_of_core for matrices that do not
+    fit.
+
+    Arguments:
+        mat (np.array): The matrix. It is not modified, even if it is held
+            in memory.
+        method (string): 'cholesky' for positive definite matrices, 'lu' for
+            the general inverse (as 'scalapost invert LU'), or 'eigen' for the
+            pseudo-inverse, where eigenvalues below 1e-12 times the largest
+            are discarded.
+        block_rows (int): Number of rows copied at a time from mat.
+
+    Returns:
+        The inverse matrix.
+    """
+    a = load_dense(mat, block_rows)
+    if method == 'cholesky':
+        # a is symmetric, so its transpose is the same matrix in Fortran
+        # order and LAPACK can work in place
+        factor, info = lapack.dpotrf(a.T, lower=True, overwrite_a=True,
+                                     clean=False)
+        if info > 0:
+            raise np.linalg.LinAlgError("Matrix is not positive definite")
+        inverse, info = lapack.dpotri(factor, lower=True, overwrite_c=True)
+        if info != 0:
+            raise np.linalg.LinAlgError("Cholesky inversion failed")
+        return _symmetrize_lower(inverse, block_rows).T
+    elif method == 'lu':
+        return scipy.linalg.inv(a, overwrite_a=True, check_finite=False)
+    elif method == 'eigen':
+        return matrix_power(a, -1, overwrite=True)
+    raise ValueError("Unknown inversion method: {}".format(method))
+
+
+def matrix_power(mat, power, overwrite=False, block_rows=DEFAULT_BLOCK_ROWS):
+    """ Computes a power of a symmetric matrix by eigendecomposition.
+
+    Eigenvalues below 1e-12 times the largest are treated as zero, so that
+    negative powers give the pseudo-inverse (power). The eigendecomposition
+    needs the whole matrix in memory, so memory-mapped inputs are copied
+    in.
+
+    Arguments:
+        mat (np.array): The matrix.
+        power (float): The power, e.g. 0.5 for the square root or -0.5 for
+            the inverse square root.
+        overwrite (bool): Whether mat may be overwritten, if it is held in
+            memory.
+        block_rows (int): Number of rows copied at a time from mat.
+
+    Returns:
+        The matrix power.
+    """
+    if not overwrite or not isinstance(mat, np.ndarray) or \
+            isinstance(mat, np.memmap):
+        mat = load_dense(mat, block_rows)
+    eigvals, eigvecs = scipy.linalg.eigh(mat, overwrite_a=True,
+                                         check_finite=False)
+    cutoff = 1e-12 * np.abs(eigvals).max()
+    if power != int(power) and np.any(eigvals < -cutoff):
+        raise np.linalg.LinAlgError("Matrix has negative eigenvalues")
+    keep = eigvals > cutoff
+    scaled = eigvecs[:, keep] * eigvals[keep] ** power
+    return np.dot(scaled, eigvecs[:, keep].T)
+
+
+def sqrt(mat, block_rows=DEFAULT_BLOCK_ROWS):
+    """ Symmetric square root of a matrix (as 'scalapost sqrt'). """
+    return matrix_power(mat, 0.5, block_rows=block_rows)
+
+
+def inverse_sqrt(mat, block_rows=DEFAULT_BLOCK_ROWS):
+    """ Symmetric inverse square root of a matrix. """
+    return matrix_power(mat, -0.5, block_rows=block_rows)
+
+
+def _symmetrize_lower(mat, block_rows=DEFAULT_BLOCK_ROWS):
+    """ Copies the lower triangle of a square matrix into the upper one. """
+    n = mat.shape[0]
+    for start in range(0, n, block_rows):
+        stop = min(start + block_rows, n)
+        mat[start:stop, stop:] = mat[stop:, start:stop].T
+        block = mat[start:stop, start:stop]
+        block[...] = np.tril(block) + np.tril(block, -1).T
+    return mat
+
+
+def cholesky_out_of_core(mat, factor_fname,
+                         memory_budget=DEFAULT_MEMORY_BUDGET,
+                         num_threads=None):
+    """ Out-of-core Cholesky factorization of a positive definite matrix.
+
+    The upper triangular factor U, with mat = U^T U, is computed one panel
+    of rows at a time (left-looking): each row panel of mat is read once,
+    updated with all previously computed panels of U, which are streamed
+    back from factor_fname, and then factored. Reading the next panel of U
+    overlaps with the update from the current one, and the updates and
+    triangular solves are split over columns on a thread pool.
+
+    Arguments:
+        mat (np.array): The (n, n) matrix, typically memory-mapped with
+            file_utils.read_covmat(..., mmap=True). Only its upper triangle
+            is read.
+        factor_fname (string): The .npy file U is written to.
+        memory_budget (int): Approximate number of bytes of panels held in
+            memory, which sets the panel height.
+        num_threads (int): Number of threads for the panel updates. None
+            means the number of CPUs.
+
+    Returns:
+        U as a np.memmap of factor_fname. It can later be reopened with
+        np.load(factor_fname, mmap_mode='r').
+    """
+    n = mat.shape[0]
+    rows = _panel_rows(n, memory_budget, 3)
+    num_threads = num_threads or os.cpu_count()
+    factor = np.lib.format.open_memmap(factor_fname, mode='w+',
+                                       dtype=np.float64, shape=(n, n))
+    # One extra worker so that the panel reads run next to the updates
+    with futures.ThreadPoolExecutor(max_workers=num_threads + 1) as pool:
+        for k0 in range(0, n, rows):
+            k1 = min(k0 + rows, n)
+            size = k1 - k0
+            panel = np.array(mat[k0:k1, k0:], dtype=np.float64)
+            if k0 > 0:
+                pending = pool.submit(np.array, factor[0:rows, k0:])
+            for j0 in range(0, k0, rows):
+                prev = pending.result()
+                if j0 + rows < k0:
+                    pending = pool.submit(
+                        np.array, factor[j0 + rows:min(j0 + 2 * rows, k0),
+                                         k0:])
+                prev_diag = prev[:, :size].T
+
+                def update(start, stop):
+                    panel[:, start:stop] -= np.dot(prev_diag,
+                                                   prev[:, start:stop])
+
+                _map_column_chunks(pool, update, n - k0, num_threads)
+            diag_block, info = lapack.dpotrf(panel[:, :size], lower=False,
+                                             clean=True)
+            if info != 0:
+                raise np.linalg.LinAlgError("Matrix is not positive "
+                                            "definite")
+            panel[:, :size] = diag_block
+
+            def solve(start, stop):
+                panel[:, size + start:size + stop] = \
+                    scipy.linalg.solve_triangular(
+                        diag_block, panel[:, size + start:size + stop],
+                        trans='T', check_finite=False)
+
+            _map_column_chunks(pool, solve, n - k1, num_threads)
+            factor[k0:k1, k0:] = panel
+    factor.flush()
+    return factor
+
+
+def cholesky_solve(factor, rhs, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """ Solves mat x = rhs given the Cholesky factor from
+    cholesky_out_of_core.
+
+    The factor is streamed twice, one row panel at a time: forwards for
+    U^T z = rhs and backwards for U x = z. Leading zero rows of rhs (as
+    for columns of the identity) skip the corresponding part of the
+    forward pass.
+
+    Arguments:
+        factor (np.array): The (possibly memory-mapped) upper factor U.
+        rhs (np.array): Right-hand side of shape (n,) or (n, m).
+        memory_budget (int): Approximate number of bytes of the factor held
+            in memory at a time.
+
+    Returns:
+        The solution x, of the same shape as rhs.
+    """
+    n = factor.shape[0]
+    rows = _panel_rows(n, memory_budget, 1)
+    res = np.array(rhs, dtype=np.float64).reshape(n, -1)
+    nonzero = np.flatnonzero(np.any(res != 0, axis=1))
+    first = nonzero[0] // rows * rows if len(nonzero) else n
+    for k0 in range(first, n, rows):
+        k1 = min(k0 + rows, n)
+        panel = np.array(factor[k0:k1, k0:])
+        res[k0:k1] = scipy.linalg.solve_triangular(
+            panel[:, :k1 - k0], res[k0:k1], trans='T', check_finite=False)
+        res[k1:] -= np.dot(panel[:, k1 - k0:].T, res[k0:k1])
+    for k0 in reversed(range(0, n, rows)):
+        k1 = min(k0 + rows, n)
+        panel = np.array(factor[k0:k1, k0:])
+        res[k0:k1] = scipy.linalg.solve_triangular(
+            panel[:, :k1 - k0],
+            res[k0:k1] - np.dot(panel[:, k1 - k0:], res[k1:]),
+            check_finite=False)
+    return res.reshape(np.shape(rhs))
+
+
+def invert_out_of_core(mat, out_fname, ordering, polarization,
+                       factor_fname=None,
+                       memory_budget=DEFAULT_MEMORY_BUDGET,
+                       num_threads=None):
+    """ Inverts a positive definite matrix that does not fit in memory.
+
+    The matrix is factored with cholesky_out_of_core, and the inverse is
+    then solved for one block of identity columns at a time. As the
+    inverse is symmetric, each block of columns is written as a block of
+    rows of a Fortran covariance matrix file (see file_utils.write_covmat).
+
+    Arguments:
+        mat (np.array): The (n, n) matrix, typically memory-mapped.
+        out_fname (string): The output .unf filename.
+        ordering (string): 'ring' or 'nest'/'nested'.
+        polarization (int): The polarization flag.
+        factor_fname (string): Where to keep the Cholesky factor. If None,
+            it is written next to out_fname and removed afterwards.
+        memory_budget (int): Approximate number of bytes held in memory.
+        num_threads (int): Number of threads for the factorization.
+    """
+    n = mat.shape[0]
+    keep_factor = factor_fname is not None
+    if not keep_factor:
+        factor_fname = out_fname + '.factor.npy'
+    try:
+        factor = cholesky_out_of_core(mat, factor_fname, memory_budget,
+                                      num_threads)
+        cols = _panel_rows(n, memory_budget // 2, 1)
+        with file_utils.CovmatWriter(out_fname, n, ordering,
+                                     polarization) as writer:
+            for start in range(0, n, cols):
+                stop = min(start + cols, n)
+                identity = np.zeros((n, stop - start))
+                identity[np.arange(start, stop),
+                         np.arange(stop - start)] = 1.
+                writer.write_rows(cholesky_solve(
+                    factor, identity, memory_budget // 2).T)
+        del factor
+    finally:
+        if not keep_factor and os.path.exists(factor_fname):
+            os.remove(factor_fname)
+
+
+def _panel_rows(n, memory_budget, num_panels):
+    "Height of num_panels panels of n float64 columns within the budget."
+    return int(max(1, min(n, memory_budget // (8 * n * num_panels))))
+
+
+def _map_column_chunks(pool, func, num_cols, num_threads):
+    "Calls func(start, stop) for num_threads column chunks on the pool."
+    bounds = np.linspace(0, num_cols, num_threads + 1).astype(int)
+    tasks = [pool.submit(func, start, stop)
+             for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+    for task in tasks:
+        task.result()
+
+
+def read_map2mask(fname):
+    """ Reads a map2mask file.
+
+    The map2mask is a HEALPix map giving, for each observed pixel, its index
+    in the covariance matrix (1-based, or 0-based if an index 0 is
+    present). Unobserved pixels hold negative values.
+
+    Returns:
+        Tuple (pixels, indices, nside, ordering), where indices are the
+        0-based matrix indices of the observed pixels.
+    """
+    header = fits_io_utils.read_fits_header(fname)
+    nside = int(header.get_value('NSIDE'))
+    ordering = ('nested' if header.get_value('ORDERING') == 'NESTED'
+                else 'ring')
+    values = fits_io_utils.read_planck_pixels(
+        fname, pixel_ranges=[(0, 12 * nside ** 2)], nest=None)
+    pixels = np.flatnonzero(values > -0.5)
+    indices = np.round(values[pixels]).astype(np.int64)
+    if len(indices) and indices.min() > 0:
+        indices -= 1
+    return pixels, indices, nside, ordering
+
+
+def diag2rms_maps(diag, pixels, indices, nside):
+    """ Places the square root of a matrix diagonal in full-sky maps.
+
+    The covariance matrix is assumed to have all pixels of one Stokes
+    component before those of the next (e.g. I, then Q, then U), with the
+    pixel order given by the map2mask indices.
+
+    Arguments:
+        diag (np.array): The matrix diagonal.
+        pixels, indices: The observed pixels and their matrix indices, as
+            returned by read_map2mask.
+        nside (int): The nside of the maps.
+
+    Returns:
+        Array of shape (ncomp, npix), with UNSEEN in unobserved pixels.
+    """
+    nobs = len(pixels)
+    if nobs == 0 or len(diag) % nobs:
+        raise ValueError("Matrix size {} does not match {} observed "
+                         "pixels".format(len(diag), nobs))
+    ncomp = len(diag) // nobs
+    maps = np.full((ncomp, 12 * nside ** 2), healpy.UNSEEN)
+    for comp in range(ncomp):
+        maps[comp, pixels] = np.sqrt(diag[indices + comp * nobs])
+    return maps
+
+
+def rms2diag(maps, pixels, indices, factor=1.):
+    """ Builds the diagonal of a covariance matrix from rms maps.
+
+    The inverse of diag2rms_maps, with the rms scaled by factor (as
+    'scalapost rms2cov').
+    """
+    maps = np.atleast_2d(maps)
+    nobs = len(pixels)
+    diag = np.empty(nobs * len(maps))
+    for comp, curr_map in enumerate(maps):
+        diag[indices + comp * nobs] = (factor * curr_map[pixels]) ** 2
+    return diag
+
+
+def write_rms_map(fname, maps, ordering, column_units=None):
+    """ Writes rms maps to a FITS file.
+
+    Arguments:
+        fname (string): The output filename.
+        maps (np.array): Array of shape (ncomp, npix) from diag2rms_maps.
+        ordering (string): 'ring' or 'nested'.
+        column_units (list of strings): Units of the columns. If None, the
+            columns are written without units.
+    """
+    _write_stokes_maps(fname, maps, ordering, 'rms', column_units,
+                       'RMS from covariance matrix')
+
+
+def write_signal_map(fname, maps, ordering, column_units=None,
+                     comment='Mean of samples'):
+    """ Writes I, QU or IQU signal maps to a FITS file.
+
+    Arguments are as for write_rms_map.
+    """
+    _write_stokes_maps(fname, maps, ordering, 'signal', column_units,
+                       comment)
+
+
+def _write_stokes_maps(fname, maps, ordering, kind, column_units, comment):
+    "Writes maps of the Stokes components as the 'kind' column property."
+    maps = np.atleast_2d(maps)
+    components = _COMPONENTS[len(maps)]
+    column_properties = {}
+    for i, comp in enumerate(components):
+        column_properties[kind + '_' + comp] = [i]
+    if column_units is None:
+        column_units = [''] * len(maps)
+        column_properties['unitless'] = list(range(len(maps)))
+    column_names = [fits_utils.DEFAULT_COLUMN_NAMES[kind + '_' + comp]
+                    for comp in components]
+    fmap = map_utils.bundle_fullmap(list(maps), ordering=ordering,
+                                    column_properties=column_properties,
+                                    column_units=column_units,
+                                    column_names=column_names,
+                                    comments=[comment])
+    fits_io_utils.write_planck_fullmap(fname, fmap)
+
+
+def write_covmat(fname, mat, ordering, polarization,
+                 block_rows=DEFAULT_BLOCK_ROWS):
+    """ Writes a covariance matrix in the Fortran unformatted format.
+
+    See file_utils.write_covmat.
+    """
+    file_utils.write_covmat(fname, mat, ordering, polarization, block_rows)
+
+
+def write_diagonal_covmat(fname, diag, ordering, polarization,
+                          block_rows=DEFAULT_BLOCK_ROWS):
+    """ Writes a diagonal covariance matrix in the Fortran format.
+
+    Only blocks of block_rows rows are ever held in memory, never the full
+    matrix. Arguments are as for write_covmat.
+    """
+    file_utils.BlockDiagonalCovariance.from_diagonal(
+        diag, ordering, polarization).write_covmat(fname, block_rows)
@@ -0,0 +1,513 @@
+import hashlib
+import os
+from concurrent import futures
+
+import numpy as np
+import healpy
+import scipy.linalg
+
+from utils import file_utils, fits_io_utils
+
+# Eigenmodes with a signal-to-noise eigenvalue below this fraction of the
+# largest one are discarded (as 'eigen_StoN' 1e-13 in comm_like_tools)
+DEFAULT_STON_THRESHOLD = 1e-13
+
+# Column order of the Cl files written from CAMB (get_total_cls)
+CAMB_SPECTRA = ('TT', 'EE', 'BB', 'TE')
+
+SPECTRA = ('TT', 'EE', 'BB', 'TE', 'TB', 'EB')
+
+# Number of Cl vectors whose covariance matrices are built at a time
+DEFAULT_BATCH_SIZE = 64
+
+_COMPONENTS = {1: 'i', 2: 'qu', 3: 'iqu'}
+
+_FIELDS = {'i': ('T',), 'qu': ('E', 'B'), 'iqu': ('T', 'E', 'B')}
+
+
+def read_cls(fname, lmax, spectra=CAMB_SPECTRA, dl=True):
+    """ Reads power spectra from a text file.
+
+    Arguments:
+        fname (string): The file, with the multipole in the first column and
+            one column per spectrum after that.
+        lmax (int): The maximum multipole returned.
+        spectra (iterable of strings): The spectra of the columns after the
+            multipole, e.g. ('TT', 'EE', 'BB', 'TE') for CAMB output.
+        dl (bool): Whether the file holds l(l+1)Cl/2pi rather than Cl.
+
+    Returns:
+        dict of spectrum name to array of Cl for l = 0..lmax. Spectra that
+        are not in the file (and multipoles missing from it) are zero.
+    """
+    return cls_from_array(np.loadtxt(fname, ndmin=2), lmax, spectra, dl)
+
+
+def cls_from_array(data, lmax, spectra=CAMB_SPECTRA, dl=True):
+    """ Converts an array laid out as the files of read_cls. """
+    ells = np.round(data[:, 0]).astype(int)
+    keep = ells <= lmax
+    ells = ells[keep]
+    cls = {}
+    for spec in SPECTRA:
+        cls[spec] = np.zeros(lmax + 1)
+    for i, spec in enumerate(spectra):
+        cls[spec][ells] = data[keep, i + 1]
+    if dl:
+        factor = np.zeros(lmax + 1)
+        ell = np.arange(1, lmax + 1)
+        factor[1:] = 2 * np.pi / (ell * (ell + 1.))
+        for spec in SPECTRA:
+            cls[spec] *= factor
+    return cls
+
+
+def read_beam(fname, lmax):
+    """ Reads a beam transfer function.
+
+    Arguments:
+        fname (string): A FITS file readable by healpy.read_cl, or a text
+            file with the multipole in the first column followed by one
+            (temperature and polarization) or three (T, E, B) columns.
+        lmax (int): The maximum multipole returned.
+
+    Returns:
+        Array of shape (3, lmax + 1) with the T, E and B beams.
+    """
+    if fname.endswith('.fits'):
+        beam = np.atleast_2d(healpy.read_cl(fname))[:, :lmax + 1]
+    else:
+        data = np.loadtxt(fname, ndmin=2)
+        ells = np.round(data[:, 0]).astype(int)
+        keep = ells <= lmax
+        beam = np.zeros((data.shape[1] - 1, lmax + 1))
+        beam[:, ells[keep]] = data[keep, 1:].T
+    if beam.shape[1] != lmax + 1:
+        raise ValueError("Beam in {} does not extend to l = {}".format(
+            fname, lmax))
+    if len(beam) == 1:
+        return np.repeat(beam, 3, axis=0)
+    if len(beam) == 2:
+        return beam[[0, 1, 1]]
+    return beam[:3]
+
+
+def observed_pixels(mask, ncomp, ordering='ring'):
+    """ Pixels of each Stokes component covered by a mask.
+
+    The pixels are returned in the order of a covariance matrix in the
+    given ordering, i.e. sorted by their index in that ordering.
+
+    Arguments:
+        mask (np.array): RING mask of shape (npix,), applied to all
+            components, or (ncomp, npix). Pixels above 0.5 are used.
+        ncomp (int): Number of Stokes components (1, 2 or 3).
+        ordering (string): The ordering of the covariance matrix.
+
+    Returns:
+        List with a RING pixel index array per component.
+    """
+    mask = np.atleast_2d(mask)
+    if len(mask) == 1:
+        mask = np.repeat(mask, ncomp, axis=0)
+    nside = healpy.npix2nside(mask.shape[1])
+    pixels = []
+    for curr_mask in mask[-ncomp:]:
+        if ordering.lower().startswith('nest'):
+            nest_mask = healpy.reorder(curr_mask, r2n=True)
+            pixels.append(healpy.nest2ring(
+                nside, np.flatnonzero(nest_mask > 0.5)))
+        else:
+            pixels.append(np.flatnonzero(curr_mask > 0.5))
+    return pixels
+
+
+def pixel_harmonics(nside, pixels, lmax):
+    """ Real spherical harmonics of the T, E and B modes at given pixels.
+
+    Each column is the map (restricted to the pixels, with the components
+    stacked) of one real degree of freedom of the alm of a multipole:
+    a_l0, and the real and imaginary parts of a_lm for m > 0, scaled so
+    that the covariance of a statistically isotropic signal is
+    sum_l C_l^XY Y_X[:, l] Y_Y[:, l]^T. The maps come from healpy.alm2map,
+    so the Q/U conventions are those of healpy.
+
+    Arguments:
+        nside (int): The nside of the maps.
+        pixels (list of np.arrays): RING pixels of each of the 1 (I), 2
+            (Q, U) or 3 (I, Q, U) components, as from observed_pixels.
+        lmax (int): The maximum multipole.
+
+    Returns:
+        dict with 'ells' (the multipole of each column) and an array of
+        shape (number of pixels, (lmax + 1)^2) for each of the fields 'T',
+        'E' and 'B' that contribute to the components.
+    """
+    components = _COMPONENTS[len(pixels)]
+    fields = _FIELDS[components]
+    pol = components != 'i'
+    map_index = ['iqu'.index(comp) for comp in components]
+    offsets = np.cumsum([0] + [len(curr) for curr in pixels])
+    num_modes = (lmax + 1) ** 2
+    harmonics = {'ells': np.empty(num_modes, dtype=int)}
+    for field in fields:
+        harmonics[field] = np.zeros((offsets[-1], num_modes))
+    col = 0
+    for ell in range(lmax + 1):
+        for m in range(ell + 1):
+            idx = healpy.Alm.getidx(lmax, ell, m)
+            values = [1.] if m == 0 else [2 ** -0.5, 1j * 2 ** -0.5]
+            for value in values:
+                harmonics['ells'][col] = ell
+                if 'T' in fields or ell >= 2:
+                    # T and E do not mix in the maps, so one transform
+                    # gives both
+                    maps = _unit_alm_maps(nside, lmax, idx, value,
+                                          [0, 1] if pol else [0])
+                    _fill_columns(harmonics, col, maps, pixels, map_index,
+                                  offsets, 'T', 'E' if ell >= 2 else None)
+                if 'B' in fields and ell >= 2:
+                    maps = _unit_alm_maps(nside, lmax, idx, value, [2])
+                    _fill_columns(harmonics, col, maps, pixels, map_index,
+                                  offsets, None, 'B')
+                col += 1
+    return harmonics
+
+
+def _unit_alm_maps(nside, lmax, idx, value, fields):
+    "Maps (I or I, Q, U) of an alm that is value at idx in the fields."
+    alm = np.zeros((3, healpy.Alm.getsize(lmax)), dtype=complex)
+    alm[fields, idx] = value
+    if fields == [0]:
+        return [healpy.alm2map(alm[0], nside, lmax=lmax)]
+    return healpy.alm2map(alm, nside, lmax=lmax, pol=True)
+
+
+def _fill_columns(harmonics, col, maps, pixels, map_index, offsets,
+                  temperature_field, polarization_field):
+    "Stores the observed pixels of maps in column col of the fields."
+    for i, index in enumerate(map_index):
+        field = temperature_field if index == 0 else polarization_field
+        if field in harmonics:
+            harmonics[field][offsets[i]:offsets[i + 1], col] = \
+                maps[index][pixels[i]]
+
+
+def beam_harmonics(harmonics, beam=None, pixwin_nside=None):
+    """ Applies a beam and/or pixel window to the columns of harmonics.
+
+    Arguments:
+        harmonics (dict): As returned by pixel_harmonics.
+        beam (np.array): The (3, lmax + 1) T, E, B beam from read_beam.
+        pixwin_nside (int): If given, the HEALPix pixel window of this nside
+            is applied as well.
+
+    Returns:
+        dict like harmonics, with the smoothed fields.
+    """
+    ells = harmonics['ells']
+    lmax = ells.max()
+    transfer = np.ones((3, lmax + 1))
+    if beam is not None:
+        transfer *= beam[:, :lmax + 1]
+    if pixwin_nside is not None:
+        pixwin_t, pixwin_p = healpy.pixwin(pixwin_nside, pol=True,
+                                           lmax=lmax)
+        transfer *= [pixwin_t, pixwin_p, pixwin_p]
+    res = {'ells': ells}
+    for i, field in enumerate('TEB'):
+        if field in harmonics:
+            res[field] = harmonics[field] * transfer[i][ells]
+    return res
+
+
+def signal_covariance(harmonics, cls):
+    """ Pixel covariance of a statistically isotropic CMB signal.
+
+    Arguments:
+        harmonics (dict): As returned by pixel_harmonics (or
+            beam_harmonics), possibly projected onto a basis.
+        cls (dict): Spectrum name to Cl array for l = 0..lmax, as returned
+            by read_cls. Missing spectra are taken to be zero.
+
+    Returns:
+        The covariance matrix.
+    """
+    ells = harmonics['ells']
+    fields = [field for field in 'TEB' if field in harmonics]
+    res = 0.
+    for i, field1 in enumerate(fields):
+        for field2 in fields[i:]:
+            spec = field1 + field2
+            if spec not in cls or not np.any(cls[spec]):
+                continue
+            term = np.dot(harmonics[field1] * cls[spec][ells],
+                          harmonics[field2].T)
+            res = res + term if field1 == field2 else res + term + term.T
+    return res
+
+
+def ston_basis(signal, noise, threshold=DEFAULT_STON_THRESHOLD):
+    """ Signal-to-noise eigenbasis of a signal and noise covariance.
+
+    Solves the generalized eigenproblem S v = lambda N v, normalized so
+    that v^T N v = 1, and keeps the modes whose eigenvalue is above
+    threshold times the largest one.
+
+    Returns:
+        Tuple (basis, eigenvalues), with the basis vectors as columns
+        ordered by decreasing eigenvalue. basis^T N basis is the identity
+        and basis^T S basis is diag(eigenvalues).
+    """
+    eigvals, eigvecs = scipy.linalg.eigh(signal, noise, check_finite=False)
+    keep = eigvals > threshold * eigvals.max()
+    return eigvecs[:, keep][:, ::-1], eigvals[keep][::-1]
+
+
+class GaussianLikelihood(object):
+    """ Gaussian likelihood of S/N-compressed data, batched over spectra.
+
+    In the basis of ston_compress the noise covariance is the identity,
+    so the covariance of the data for spectra C_l is
+    C = I + sum_{XY, l} C_l^XY G_l^XY. The projections G_l^XY of the
+    varied spectra and multipoles are precomputed once, and the remaining
+    (fixed) terms are taken from the fiducial spectra. For a stack of
+    spectra, the covariance matrices are then built with one matrix
+    product per batch, and their Cholesky factorizations run in parallel
+    on a thread pool.
+
+    Arguments:
+        data (dict): The compressed data, as returned by ston_compress or
+            read_likelihood_data.
+        fiducial_cls (dict): Spectra used for the multipoles and spectra
+            that are not varied, as from read_cls.
+        lmin, lmax (int): The range of multipoles that are varied.
+        spectra (iterable of strings): The spectra that are varied.
+        num_threads (int): Number of threads for the factorizations. None
+            means the number of CPUs.
+        batch_size (int): Number of covariance matrices built at a time.
+    """
+
+    def __init__(self, data, fiducial_cls, lmin, lmax, spectra=SPECTRA,
+                 num_threads=None, batch_size=DEFAULT_BATCH_SIZE):
+        harmonics = data['harmonics']
+        ells = harmonics['ells']
+        if lmax > ells.max():
+            raise ValueError("The data only extend to l = {}".format(
+                ells.max()))
+        self.data = data['data']
+        self.num_threads = num_threads or os.cpu_count()
+        self.batch_size = batch_size
+        self.terms = [(spec, ell) for spec in spectra
+                      if spec[0] in harmonics and spec[1] in harmonics
+                      for ell in range(lmin, lmax + 1)]
+        size = len(self.data)
+        self._projections = np.empty((len(self.terms), size, size))
+        for i, (spec, ell) in enumerate(self.terms):
+            cols = ells == ell
+            term = np.dot(harmonics[spec[0]][:, cols],
+                          harmonics[spec[1]][:, cols].T)
+            self._projections[i] = term if spec[0] == spec[1] else \
+                term + term.T
+        fixed_cls = {}
+        for spec in SPECTRA:
+            fixed_cls[spec] = np.array(fiducial_cls[spec][:ells.max() + 1],
+                                       dtype=np.float64)
+        for spec, ell in self.terms:
+            fixed_cls[spec][ell] = 0.
+        self._fixed = np.eye(size) + signal_covariance(harmonics, fixed_cls)
+
+    def log_likelihood(self, cls):
+        """ Log-likelihood for each of a stack of spectra.
+
+        Arguments:
+            cls (list of dicts): Spectra as from read_cls (one dict per
+                point), or an array of shape (num_points, 6, lmax + 1)
+                with the spectra in the order of SPECTRA.
+
+        Returns:
+            Array of -(x^T C^-1 x + log det C) / 2 for each point, without
+            the constant term. Points where C is not positive definite get
+            -inf.
+        """
+        coeffs = self._coefficients(cls)
+        res = np.empty(len(coeffs))
+        with futures.ThreadPoolExecutor(
+                max_workers=self.num_threads) as pool:
+            for start in range(0, len(coeffs), self.batch_size):
+                covs = np.tensordot(coeffs[start:start + self.batch_size],
+                                    self._projections, axes=1)
+                covs += self._fixed
+                res[start:start + len(covs)] = list(
+                    pool.map(self._point_log_likelihood, covs))
+        return res
+
+    def _coefficients(self, cls):
+        "The Cl of the varied terms, of shape (num_points, num_terms)."
+        coeffs = np.empty((len(cls), len(self.terms)))
+        for i, curr_cls in enumerate(cls):
+            if not isinstance(curr_cls, dict):
+                curr_cls = dict(zip(SPECTRA, curr_cls))
+            for j, (spec, ell) in enumerate(self.terms):
+                coeffs[i, j] = curr_cls[spec][ell]
+        return coeffs
+
+    def _point_log_likelihood(self, cov):
+        try:
+            factor = scipy.linalg.cho_factor(cov, overwrite_a=True,
+                                             check_finite=False)
+        except np.linalg.LinAlgError:
+            return -np.inf
+        chisq = np.dot(self.data, scipy.linalg.cho_solve(
+            factor, self.data, check_finite=False))
+        logdet = 2 * np.sum(np.log(np.diag(factor[0])))
+        return -0.5 * (chisq + logdet)
+
+
+def ston_compress(mean_maps, mask, covmat, beam, cls, lmax,
+                  threshold=DEFAULT_STON_THRESHOLD, pixwin=True,
+                  cache_dir=None):
+    """ Signal-to-noise compression of a map for a Gaussian likelihood.
+
+    The in-process equivalent of comm_like_tools mapcov2gausslike with
+    'eigen_StoN'. The basis depends on the mask, the noise covariance, the
+    beam, the fiducial spectra and the settings, but not on the map, so
+    with a cache_dir it is stored under a hash of those inputs and reused
+    whenever they are the same.
+
+    Arguments:
+        mean_maps (np.array): The (ncomp, npix) RING map(s), with
+            components matching the covariance matrix (I, QU or IQU).
+        mask (np.array): RING mask, as for observed_pixels.
+        covmat (dict): The noise covariance, as from file_utils.read_covmat,
+            over the masked pixels (component-major).
+        beam (np.array): The (3, lmax + 1) beam from read_beam, or None.
+        cls (dict): The fiducial spectra, as from read_cls.
+        lmax (int): The maximum multipole of the signal.
+        threshold (float): Relative eigenvalue threshold for ston_basis.
+        pixwin (bool): Whether to apply the pixel window to the signal.
+        cache_dir (string): Directory of the basis cache. None disables it.
+
+    Returns:
+        dict with the compressed 'data' vector, the 'eigenvalues' and
+        'basis', the 'harmonics' projected onto the basis (with the beam
+        and pixel window applied), 'nside', 'lmax', 'components' and the
+        cache 'key'.
+    """
+    mean_maps = np.atleast_2d(mean_maps)
+    nside = healpy.npix2nside(mean_maps.shape[1])
+    ncomp = len(mean_maps)
+    pixels = observed_pixels(mask, ncomp, covmat['ordering'])
+    if sum(len(curr) for curr in pixels) != covmat['n']:
+        raise ValueError("The mask has {} pixels but the covariance matrix "
+                         "is {}x{}".format(sum(len(curr) for curr in pixels),
+                                           covmat['n'], covmat['n']))
+    key = _input_hash(pixels, covmat['data'], beam,
+                      [cls[spec][:lmax + 1] for spec in SPECTRA],
+                      lmax, threshold, pixwin, nside)
+    cache_fname = None
+    if cache_dir is not None:
+        cache_fname = os.path.join(cache_dir, 'ston_{}.npz'.format(key))
+    if cache_fname is not None and os.path.exists(cache_fname):
+        res = read_likelihood_data(cache_fname)
+    else:
+        harmonics = beam_harmonics(pixel_harmonics(nside, pixels, lmax),
+                                   beam, nside if pixwin else None)
+        noise = np.array(covmat['data'], dtype=np.float64)
+        basis, eigvals = ston_basis(signal_covariance(harmonics, cls),
+                                    noise, threshold)
+        projected = {'ells': harmonics['ells']}
+        for field in 'TEB':
+            if field in harmonics:
+                projected[field] = np.dot(basis.T, harmonics[field])
+        res = {'basis': basis,
+               'eigenvalues': eigvals,
+               'harmonics': projected,
+               'nside': nside,
+               'lmax': lmax,
+               'components': _COMPONENTS[ncomp],
+               'key': key}
+        if cache_fname is not None:
+            write_likelihood_data(cache_fname, res)
+    data = np.concatenate([curr_map[curr_pix] for curr_map, curr_pix
+                           in zip(mean_maps, pixels)])
+    res['data'] = np.dot(res['basis'].T, data)
+    return res
+
+
+def create_likelihood_data(mean_fname, mask_fname, covmat_fname, beam_fname,
+                           cl_fname, lmax, threshold=DEFAULT_STON_THRESHOLD,
+                           pixwin=True, cache_dir=None):
+    """ Reads the inputs of ston_compress from files and compresses.
+
+    The mean map and mask are FITS maps (read in RING ordering), the
+    covariance a Fortran matrix file, and the beam and fiducial Cl files
+    are read with read_beam and read_cls.
+    """
+    covmat = file_utils.read_covmat(covmat_fname, mmap=True)
+    header = fits_io_utils.read_fits_header(mean_fname)
+    npix = 12 * int(header.get_value('NSIDE')) ** 2
+    mean_maps = fits_io_utils.read_planck_pixels(
+        mean_fname, pixel_ranges=[(0, npix)], field=None)
+    mask = fits_io_utils.read_planck_pixels(
+        mask_fname, pixel_ranges=[(0, npix)], field=None)
+    beam = read_beam(beam_fname, lmax) if beam_fname is not None else None
+    # Use as many (trailing) components of the map as the covariance has
+    for ncomp in range(1, len(mean_maps) + 1):
+        num_pixels = sum(len(curr) for curr in observed_pixels(
+            mask, ncomp, covmat['ordering']))
+        if num_pixels == covmat['n']:
+            break
+    return ston_compress(mean_maps[-ncomp:], mask, covmat, beam,
+                         read_cls(cl_fname, lmax), lmax, threshold, pixwin,
+                         cache_dir)
+
+
+def write_likelihood_data(fname, data):
+    "Writes the output of ston_compress to a .npz file."
+    arrays = {}
+    for key, value in data.items():
+        if key == 'harmonics':
+            for field, harmonics in value.items():
+                arrays['harmonics_' + field] = harmonics
+        else:
+            arrays[key] = value
+    np.savez(fname, **arrays)
+
+
+def read_likelihood_data(fname):
+    "Reads a file written by write_likelihood_data."
+    res = {'harmonics': {}}
+    with np.load(fname) as arrays:
+        for key in arrays.files:
+            if key.startswith('harmonics_'):
+                res['harmonics'][key[len('harmonics_'):]] = arrays[key]
+            elif arrays[key].ndim == 0:
+                res[key] = arrays[key].item()
+            else:
+                res[key] = arrays[key]
+    return res
+
+
+def _input_hash(*inputs):
+    "SHA-1 of arrays (possibly memory-mapped), lists of arrays and values."
+    sha = hashlib.sha1()
+
+    def update(value):
+        if isinstance(value, (list, tuple)):
+            sha.update('list{}'.format(len(value)).encode())
+            for item in value:
+                update(item)
+        elif isinstance(value, np.ndarray):
+            sha.update('{}{}'.format(value.dtype.str, value.shape).encode())
+            rows = np.atleast_1d(value)
+            for start in range(0, len(rows), file_utils.DEFAULT_BLOCK_ROWS):
+                sha.update(np.ascontiguousarray(
+                    rows[start:start + file_utils.DEFAULT_BLOCK_ROWS]
+                ).tobytes())
+        else:
+            sha.update(repr(value).encode())
+
+    for value in inputs:
+        update(value)
+    return sha.hexdigest()
@@ -1,8 +1,20 @@
+from concurrent import futures
+import os
+
 import numpy as np
 import healpy
 
-def radii2mask(nside, centers, radii, inclusive=True, fact=4, 
-               ordering='ring'):
+DEFAULT_DISC_BATCH = 1024
+
+_INV_TWOPI = 1.0 / (2 * np.pi)
+
+# _ranges2mask sets the covered pixels one by one when they are fewer than
+# 1 / _RANGE_FILL_FRACTION of the map, and scans the whole map otherwise
+_RANGE_FILL_FRACTION = 8
+
+
+def radii2mask(nside, centers, radii, inclusive=True, fact=4,
+               ordering='ring', num_threads=None):
     """ Gives an array of pixels included in a list of centers and a radius.
     
     Arguments:
@@ -17,26 +29,108 @@ def radii2mask(nside, centers, radii, inclusive=True, fact=4,
         fact (integer): Only used when inclusive=True. The overlapping test
             will be done at the resolution fact*nside.
         ordering (string): 'ring' or 'nested'.
+        num_threads (int): Number of threads used to process the sources.
+            Default is the number of cores.
 
     Returns:
         Array of booleans where the specified circles are masked out.
     """
 
-    centers_vecs = healpy.dir2vec(centers, lonlat=True)
-
-    mask = np.ones(12 * nside ** 2, dtype=np.bool)
-
-    num = 0
     if ordering == 'ring':
         nest = False
     elif ordering == 'nested':
         nest = True
-    for center, radius in zip(centers_vecs.transpose(), radii):
-        if radius == 0:
-            continue
-        mask[healpy.query_disc(nside, center, radius, inclusive=inclusive,
-                               fact=fact, nest=nest)] = 0
-    return mask
+    else:
+        raise ValueError("Unknown ordering: {}".format(ordering))
+    centers_vecs = healpy.dir2vec(centers, lonlat=True)
+    covered = query_discs(nside, centers_vecs, radii, inclusive=inclusive,
+                          fact=fact, nest=nest, num_threads=num_threads)
+    return ~covered
+
+
+def query_discs(nside, vecs, radii, inclusive=False, fact=4, nest=False,
+                num_threads=None, batch_size=DEFAULT_DISC_BATCH):
+    """ Finds the pixels covered by any of a set of discs.
+
+    This gives the union of healpy.query_disc over all the discs. Inclusive
+    queries in RING ordering, where the oversampled boundary test makes
+    each call expensive, are processed in vectorized batches that intersect
+    the discs with whole rings at once, using the same selection rules as
+    the HEALPix C++ library.
+
+    Only that case is batched. Inclusive NESTED queries use a different,
+    hierarchical selection in HEALPix, so they can not be derived from the
+    RING result, and they are made one disc at a time. Exact
+    (non-inclusive) queries select the same pixels in either ordering and
+    could go through the batches, but each healpy call is cheap and
+    batching them is no faster, so they are also made one disc at a time.
+
+    Arguments:
+        nside (int): Nside of the map.
+        vecs (np.array): Unit vectors of the disc centers, shape (3, ndisc).
+        radii (np.array): Radii of the discs, in radians.
+        inclusive (bool): As in healpy.query_disc.
+        fact (integer): As in healpy.query_disc.
+        nest (bool): Whether the pixels are in NESTED ordering.
+        num_threads (int): Number of threads over which the batches are
+            spread. Default is the number of cores. Ignored unless inclusive
+            is True and nest is False.
+        batch_size (int): Number of discs handled together in each batch.
+            Ignored unless inclusive is True and nest is False.
+
+    Returns:
+        Array of booleans of length 12 * nside ** 2, True for every pixel
+        covered by at least one disc.
+    """
+
+    nside = int(nside)
+    npix = 12 * nside ** 2
+    vecs = np.asarray(vecs, dtype=np.float64).reshape(3, -1)
+    radii = np.broadcast_to(np.asarray(radii, dtype=np.float64),
+                            vecs.shape[1:])
+    if inclusive:
+        fct = int(fact)
+        if nest:
+            if fct < 1 or fct & (fct - 1):
+                raise ValueError("fact must be a power of 2 for nested "
+                                 "ordering: {}".format(fact))
+            if nside & (nside - 1):
+                raise ValueError("Nside must be a power of 2 for nested "
+                                 "ordering: {}".format(nside))
+        elif fct < 1 or (1 << 29) // nside < fct:
+            raise ValueError("Invalid oversampling factor: {}".format(fact))
+    else:
+        fct = 0
+    keep = radii != 0
+    theta, phi = _vec2pointing(vecs[:, keep])
+    radii = radii[keep]
+
+    if nest or not inclusive:
+        mask = np.zeros(npix, dtype=bool)
+        for vec, radius in zip(vecs[:, keep].T, radii):
+            mask[healpy.query_disc(nside, vec, radius, inclusive=inclusive,
+                                   fact=max(fct, 1), nest=nest)] = True
+        return mask
+
+    engine = _disc_ranges_ring
+    batches = [slice(start, start + batch_size)
+               for start in range(0, len(radii), batch_size)]
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+    if num_threads > 1 and len(batches) > 1:
+        with futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+            results = list(executor.map(
+                lambda sl: engine(nside, theta[sl], phi[sl], radii[sl], fct),
+                batches))
+    else:
+        results = [engine(nside, theta[sl], phi[sl], radii[sl], fct)
+                   for sl in batches]
+
+    if not results:
+        return np.zeros(npix, dtype=bool)
+    starts = np.concatenate([starts for starts, _ in results])
+    stops = np.concatenate([stops for _, stops in results])
+    return _ranges2mask(npix, starts, stops)
 
 
 def calc_snr_dep_radii(amplitude, noise, fwhm):
@@ -61,3 +155,255 @@ def calc_snr_dep_radii(amplitude, noise, fwhm):
     radii[pos_filter] = (fwhm / 60.0 / 180.0 * np.pi / 
                          (2 * np.sqrt(2 * np.log(2))) * beam_frac)
     return list(radii)
+
+
+def _ranges2mask(npix, starts, stops):
+    """ Boolean map that is True inside any of the half-open pixel ranges. """
+
+    nonempty = stops > starts
+    starts = np.clip(starts[nonempty], 0, npix)
+    stops = np.clip(stops[nonempty], 0, npix)
+    order = np.argsort(starts, kind='stable')
+    starts, stops = starts[order], np.maximum.accumulate(stops[order])
+    # Merge overlapping and adjacent ranges so every boundary is unique
+    first = np.ones(len(starts), dtype=bool)
+    first[1:] = starts[1:] > stops[:-1]
+    last = np.ones(len(starts), dtype=bool)
+    last[:-1] = first[1:]
+    starts, stops = starts[first], stops[last]
+    lengths = stops - starts
+    total = lengths.sum()
+    if total * _RANGE_FILL_FRACTION < npix:
+        # Few pixels covered: set them directly instead of scanning the map
+        mask = np.zeros(npix, dtype=bool)
+        offsets = np.cumsum(lengths) - lengths
+        mask[np.repeat(starts - offsets, lengths) + np.arange(total)] = True
+        return mask
+    edges = np.zeros(npix + 1, dtype=np.int8)
+    edges[starts] = 1
+    edges[stops] = -1
+    return np.cumsum(edges[:npix], dtype=np.int8).view(bool)
+
+
+def _vec2pointing(vecs):
+    """ Converts unit vectors to normalized (theta, phi) as HEALPix does. """
+
+    x, y, z = vecs
+    theta = np.arctan2(np.sqrt(x * x + y * y), z)
+    phi = np.arctan2(y, x)
+    phi = np.where(phi < 0, phi + 2 * np.pi, phi)
+    phi = np.where(phi >= 2 * np.pi, np.fmod(phi, 2 * np.pi), phi)
+    return theta, phi
+
+
+def _ring_above(nside, z):
+    """ Number of the next ring to the north of z = cos(theta). """
+
+    az = np.abs(z)
+    with np.errstate(invalid='ignore'):
+        equatorial = np.trunc(nside * (2 - 1.5 * z))
+        iring = np.trunc(nside * np.sqrt(3 * (1 - az)))
+    polar = np.where(z > 0, iring, 4 * nside - iring - 1)
+    return np.where(az <= 2. / 3., equatorial, polar).astype(np.int64)
+
+
+def _ring2z(nside, ring):
+    """ z = cos(theta) of the given rings. """
+
+    fact2 = 4. / (12 * nside ** 2)
+    fact1 = (nside << 1) * fact2
+    south = 4 * nside - ring
+    return np.where(ring < nside, 1 - ring * ring * fact2,
+                    np.where(ring <= 3 * nside, (2 * nside - ring) * fact1,
+                             south * south * fact2 - 1))
+
+
+def _ring_info(nside, ring):
+    """ First pixel, number of pixels and shift flag of the given rings. """
+
+    npix = 12 * nside ** 2
+    south = 4 * nside - ring
+    is_north = ring < nside
+    is_south = ring > 3 * nside
+    startpix = np.where(
+        is_north, 2 * ring * (ring - 1),
+        np.where(is_south, npix - 2 * south * (south + 1),
+                 2 * nside * (nside - 1) + (ring - nside) * 4 * nside))
+    ringpix = np.where(is_north, 4 * ring,
+                       np.where(is_south, 4 * south, 4 * nside))
+    shifted = is_north | is_south | (((ring - nside) & 1) == 0)
+    return startpix, ringpix, shifted
+
+
+def _cosdist_zphi(z1, phi1, z2, phi2):
+    """ Cosine of the angular distance between two (z, phi) positions. """
+
+    return z1 * z2 + np.cos(phi1 - phi2) * np.sqrt((1. - z1 * z1) *
+                                                   (1. - z2 * z2))
+
+
+def _pix2zphi(nside, pix, nest):
+    """ (z, phi) of pixel centers, matching HEALPix pix2zphi exactly. """
+
+    return (healpy.pix2vec(nside, pix, nest=nest)[2],
+            healpy.pix2ang(nside, pix, nest=nest)[1])
+
+
+def _expand(counts):
+    """ Owner index and position within the owner for concatenated ranges. """
+
+    owner = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.cumsum(counts) - counts
+    return owner, np.arange(owner.size) - offsets[owner]
+
+
+def _disc_ranges_ring(nside, theta, phi, radii, fct):
+    """ Pixel ranges covered by discs in RING ordering.
+
+    Vectorized form of the RING branch of HEALPix query_disc_internal: each
+    disc is intersected with all rings between its northern and southern
+    edge, and for fct > 1 the ends of each ring segment are trimmed by
+    testing the boundary of the pixels at resolution fct * nside.
+
+    Returns:
+        Arrays (starts, stops) of half-open pixel ranges.
+    """
+
+    npix = 12 * nside ** 2
+    starts, stops = [], []
+
+    if fct > 1:
+        rsmall = radii + healpy.max_pixrad(fct * nside)
+        rbig = radii + healpy.max_pixrad(nside)
+    elif fct == 1:
+        rsmall = rbig = radii + healpy.max_pixrad(nside)
+    else:
+        rsmall = rbig = radii
+    full = rsmall >= np.pi
+    if np.any(full):
+        starts.append([0])
+        stops.append([npix])
+        theta, phi = theta[~full], phi[~full]
+        rsmall, rbig = rsmall[~full], rbig[~full]
+    rbig = np.minimum(np.pi, rbig)
+    cosrsmall = np.cos(rsmall)
+    cosrbig = np.cos(rbig)
+    z0 = np.cos(theta)
+    with np.errstate(divide='ignore'):
+        xa = 1. / np.sqrt((1 - z0) * (1 + z0))
+    cpix = healpy.ang2pix(nside, theta, phi)
+
+    rlat1 = theta - rsmall
+    irmin = _ring_above(nside, np.cos(rlat1)) + 1
+    north = (rlat1 <= 0) & (irmin > 1)
+    if np.any(north):
+        sp, rp, _ = _ring_info(nside, irmin[north] - 1)
+        starts.append(np.zeros_like(sp))
+        stops.append(sp + rp)
+    if fct > 1:
+        irmin = np.where(rlat1 > 0, np.maximum(1, irmin - 1), irmin)
+
+    rlat2 = theta + rsmall
+    irmax = _ring_above(nside, np.cos(rlat2))
+    if fct > 1:
+        irmax = np.where(rlat2 < np.pi, np.minimum(4 * nside - 1, irmax + 1),
+                         irmax)
+    south = (rlat2 >= np.pi) & (irmax + 1 < 4 * nside)
+    if np.any(south):
+        sp, _, _ = _ring_info(nside, irmax[south] + 1)
+        starts.append(sp)
+        stops.append(np.full_like(sp, npix))
+
+    # One entry per (disc, ring) pair
+    disc, offset = _expand(np.maximum(irmax - irmin + 1, 0))
+    iz = irmin[disc] + offset
+    z = _ring2z(nside, iz)
+    dz0, dphi0 = z0[disc], phi[disc]
+    with np.errstate(invalid='ignore'):
+        x = (cosrbig[disc] - z * dz0) * xa[disc]
+        ysq = 1 - z * z - x * x
+        dphi = np.where(ysq <= 0, np.pi - 1e-15 if fct > 1 else 0.,
+                        np.arctan2(np.sqrt(ysq), x))
+    ipix1, nr, shifted = _ring_info(nside, iz)
+    shift = np.where(shifted, 0.5, 0.)
+    with np.errstate(invalid='ignore'):
+        ip_lo = np.floor(nr * _INV_TWOPI * (dphi0 - dphi) - shift) + 1
+        ip_hi = np.floor(nr * _INV_TWOPI * (dphi0 + dphi) - shift)
+    valid = dphi > 0
+    ip_lo = np.where(valid, ip_lo, 0).astype(np.int64)
+    ip_hi = np.where(valid, ip_hi, -1).astype(np.int64)
+
+    if fct > 1:
+        # Pixels whose centers are further than rsmall + max_pixrad from the
+        # disc center cannot pass the boundary test, so the trimming starts
+        # at the edges of that range instead of stepping through them.
+        rcheck = (rsmall + healpy.max_pixrad(nside))[disc]
+        with np.errstate(invalid='ignore'):
+            x = (np.cos(rcheck) - z * dz0) * xa[disc]
+            ysq = 1 - z * z - x * x
+            dphi = np.where(ysq > 0, np.arctan2(np.sqrt(ysq), x),
+                            np.where(x > 0, 0., np.pi))
+            dphi[np.isnan(dphi) | (rcheck >= np.pi)] = np.pi
+        check_lo = np.floor(nr * _INV_TWOPI * (dphi0 - dphi) - shift)
+        check_hi = np.floor(nr * _INV_TWOPI * (dphi0 + dphi) - shift) + 1
+        lo_limit = np.minimum(ip_hi, check_hi.astype(np.int64))
+        ip_lo = np.maximum(ip_lo, check_lo.astype(np.int64))
+
+        args = (nside, fct, nr, ipix1, dz0, dphi0, cosrsmall[disc], cpix[disc])
+        active = np.flatnonzero(ip_lo <= lo_limit)
+        while active.size:
+            outside = _ring_pixel_outside(ip_lo[active], active, *args)
+            active = active[outside]
+            ip_lo[active] += 1
+            active = active[ip_lo[active] <= lo_limit[active]]
+        ip_lo = np.where(ip_lo > lo_limit, ip_hi + 1, ip_lo)
+        ip_hi = np.where(ip_lo <= ip_hi,
+                         np.maximum(ip_lo, np.minimum(ip_hi, check_hi)),
+                         ip_hi).astype(np.int64)
+        active = np.flatnonzero(ip_hi > ip_lo)
+        while active.size:
+            outside = _ring_pixel_outside(ip_hi[active], active, *args)
+            active = active[outside]
+            ip_hi[active] -= 1
+            active = active[ip_hi[active] > ip_lo[active]]
+
+    seg = ip_lo <= ip_hi
+    ip_lo, ip_hi, ipix1, nr = ip_lo[seg], ip_hi[seg], ipix1[seg], nr[seg]
+    wrap = ip_hi >= nr
+    ip_lo = np.where(wrap, ip_lo - nr, ip_lo)
+    ip_hi = np.where(wrap, ip_hi - nr, ip_hi)
+    split = ip_lo < 0
+    starts.append(np.where(split, ipix1, ipix1 + ip_lo))
+    stops.append(ipix1 + ip_hi + 1)
+    starts.append(ipix1[split] + ip_lo[split] + nr[split])
+    stops.append(ipix1[split] + nr[split])
+    return (np.concatenate(starts).astype(np.int64),
+            np.concatenate(stops).astype(np.int64))
+
+
+def _ring_pixel_outside(pix, sel, nside, fct, nr, ipix1, z0, phi0, cosrsmall,
+                        cpix):
+    """ Whether ring pixels lie entirely outside their disc.
+
+    Vectorized form of HEALPix check_pixel_ring: the boundary of each pixel
+    is sampled at the centers of its edge subpixels at resolution
+    fct * nside, and a pixel is outside when none of these lie within the
+    enlarged radius.
+    """
+
+    nr, ipix1 = nr[sel], ipix1[sel]
+    pix = np.where(pix >= nr, pix - nr, np.where(pix < 0, pix + nr, pix))
+    pix = pix + ipix1
+    outside = pix != cpix[sel]
+    px, py, pf = healpy.pix2xyf(nside, pix)
+    px, py = px * fct, py * fct
+    i = np.arange(fct - 1)[:, None]
+    last = fct - 1
+    sub = np.concatenate([
+        healpy.xyf2pix(nside * fct, px + i, py, pf),
+        healpy.xyf2pix(nside * fct, px + last, py + i, pf),
+        healpy.xyf2pix(nside * fct, px + last - i, py + last, pf),
+        healpy.xyf2pix(nside * fct, px, py + last - i, pf)])
+    pz, pphi = _pix2zphi(nside * fct, sub, False)
+    near = _cosdist_zphi(pz, pphi, z0[sel], phi0[sel]) > cosrsmall[sel]
+    return outside & ~np.any(near, axis=0)
@@ -0,0 +1,230 @@
+import glob
+import os
+import re
+from concurrent import futures
+
+import numpy as np
+import healpy
+from scipy.linalg import blas
+
+from calculation import covariance
+from utils import file_utils, fits_io_utils
+
+# Number of samples read (and added to the covariance) at a time
+DEFAULT_CHUNK_SIZE = 16
+
+
+class RunningCovariance(object):
+    """ Mean and covariance of vectors, updated one chunk at a time.
+
+    The samples are shifted by the mean of the first chunk, and the sums
+    of the shifted samples and of their outer products are accumulated,
+    the latter with an in-place BLAS rank-k update (dsyrk). The memory
+    used is that of one covariance matrix, whatever the number of samples.
+    Accumulators of different chains are combined with the pairwise
+    update of Chan et al.
+    """
+
+    def __init__(self, size):
+        self.count = 0
+        self._shift = None
+        self._sum = np.zeros(size)
+        # Only the upper triangle is updated
+        self._sum_sq = np.zeros((size, size), order='F')
+
+    def update(self, samples):
+        """ Adds samples, an array of shape (num_samples, size). """
+        samples = np.atleast_2d(samples)
+        if len(samples) == 0:
+            return
+        if self._shift is None:
+            self._shift = samples.mean(axis=0)
+        shifted = samples - self._shift
+        self._sum += shifted.sum(axis=0)
+        blas.dsyrk(1., shifted.T, beta=1., c=self._sum_sq, overwrite_c=1)
+        self.count += len(samples)
+
+    @property
+    def mean(self):
+        return self._shift + self._sum / self.count
+
+    def scatter(self):
+        "Sum of the outer products of the deviations from the mean."
+        res = np.triu(self._sum_sq)
+        res += np.triu(res, 1).T
+        offset = self._sum / self.count
+        res -= self.count * np.outer(offset, offset)
+        return res
+
+    def covariance(self, ddof=1):
+        return self.scatter() / (self.count - ddof)
+
+
+def combine(accumulators, ddof=1):
+    """ Mean and covariance of the samples of several RunningCovariances.
+
+    Returns:
+        Tuple (count, mean, covariance).
+    """
+    count = 0
+    mean = None
+    scatter = None
+    for acc in accumulators:
+        if acc.count == 0:
+            continue
+        if count == 0:
+            count, mean, scatter = acc.count, acc.mean, acc.scatter()
+            continue
+        total = count + acc.count
+        delta = acc.mean - mean
+        scatter += acc.scatter()
+        scatter += np.outer(delta, delta) * (count * acc.count / total)
+        mean = mean + delta * (acc.count / total)
+        count = total
+    if count == 0:
+        raise ValueError("No samples")
+    return count, mean, scatter / (count - ddof)
+
+
+def group_chain_files(pattern):
+    """ Groups per-sample map files by chain.
+
+    Arguments:
+        pattern (string): Glob pattern of the files, whose names contain
+            the chain and sample as '_c0001_k00010' (as written by
+            Commander), e.g. 'chains/cmb_c*_k*.fits'.
+
+    Returns:
+        List with the sorted filenames of each chain, in chain order.
+    """
+    chains = {}
+    for fname in glob.glob(pattern):
+        match = re.search(r'_c(\d+)_k(\d+)', os.path.basename(fname))
+        if match is None:
+            continue
+        chains.setdefault(int(match.group(1)), []).append(
+            (int(match.group(2)), fname))
+    return [[fname for _, fname in sorted(chains[chain])]
+            for chain in sorted(chains)]
+
+
+def read_sample(fname, pixels, nside=None, fields=None):
+    """ Reads the masked pixels of one sample as a vector.
+
+    Arguments:
+        fname (string): The FITS map of the sample.
+        pixels (list of np.arrays): RING pixels of each component, as from
+            likelihood.observed_pixels.
+        nside (int): The nside of the pixels. If the sample has another
+            nside, the full map is read and regridded with healpy.ud_grade;
+            otherwise only the rows holding the pixels are read.
+        fields (list of ints): The field of each component. Defaults to the
+            last len(pixels) fields of an IQU map.
+
+    Returns:
+        The pixel values, with the components stacked.
+    """
+    if fields is None:
+        fields = list(range(3))[-len(pixels):]
+    sample_nside = int(fits_io_utils.read_fits_header(fname).get_value(
+        'NSIDE'))
+    if nside is None or nside == sample_nside:
+        needed = np.unique(np.concatenate(pixels))
+        values = fits_io_utils.read_planck_pixels(fname, pixels=needed,
+                                                  field=fields, nest=False)
+        return np.concatenate([
+            curr_values[np.searchsorted(needed, curr_pixels)]
+            for curr_values, curr_pixels in zip(values, pixels)])
+    maps = fits_io_utils.read_planck_pixels(
+        fname, pixel_ranges=[(0, 12 * sample_nside ** 2)], field=fields,
+        nest=False)
+    maps = np.atleast_2d(healpy.ud_grade(maps, nside))
+    return np.concatenate([curr_map[curr_pixels] for curr_map, curr_pixels
+                           in zip(maps, pixels)])
+
+
+def chain_mean_cov(chains, pixels, burnin=0, nside=None, fields=None,
+                   chunk_size=DEFAULT_CHUNK_SIZE, num_threads=None,
+                   num_parallel_chains=1):
+    """ Mean and covariance of the masked pixels over chain samples.
+
+    The in-process equivalent of comm_process_resfiles pix2mean_cov. The
+    samples are streamed chunk by chunk, with the reads of a chunk run on
+    a thread pool. Each chain being processed holds one covariance-sized
+    accumulator, so the memory grows with the number of chains processed
+    at the same time but not with the number of samples.
+
+    Arguments:
+        chains (list of lists of strings): The sample files of each chain,
+            in sample order (see group_chain_files).
+        pixels (list of np.arrays): RING pixels of each component.
+        burnin (int): Number of leading samples of each chain to skip.
+        nside, fields: As for read_sample.
+        chunk_size (int): Number of samples read at a time per chain.
+        num_threads (int): Number of threads reading samples. None means
+            the number of CPUs.
+        num_parallel_chains (int): Number of chains processed at the same
+            time, each with its own accumulator. None means all of them.
+
+    Returns:
+        Tuple (count, mean, covariance) over all chains.
+    """
+    num_threads = num_threads or os.cpu_count()
+    size = sum(len(curr_pixels) for curr_pixels in pixels)
+
+    def read(fname):
+        return read_sample(fname, pixels, nside, fields)
+
+    with futures.ThreadPoolExecutor(max_workers=num_threads) as read_pool:
+
+        def process_chain(files):
+            acc = RunningCovariance(size)
+            files = files[burnin:]
+            for start in range(0, len(files), chunk_size):
+                acc.update(np.array(list(read_pool.map(
+                    read, files[start:start + chunk_size]))))
+            return acc
+
+        num_parallel_chains = num_parallel_chains or max(len(chains), 1)
+        with futures.ThreadPoolExecutor(
+                max_workers=num_parallel_chains) as chain_pool:
+            # The chains are run in batches and each accumulator is merged
+            # and dropped as soon as its batch is done, so that at most
+            # num_parallel_chains of them are held at a time
+            accumulators = (
+                acc for start in range(0, len(chains), num_parallel_chains)
+                for acc in chain_pool.map(
+                    process_chain,
+                    chains[start:start + num_parallel_chains]))
+            return combine(accumulators)
+
+
+def write_mean_cov(prefix, mean, cov, pixels, nside, ordering='ring'):
+    """ Writes the output files of pix2mean_cov.
+
+    These are {prefix}_mean.fits (the mean maps, UNSEEN outside the mask),
+    {prefix}_rms.fits (the square root of the covariance diagonal) and
+    {prefix}_N.unf (the covariance of the masked pixels).
+
+    Arguments:
+        prefix (string): The prefix of the output files.
+        mean, cov: As returned by chain_mean_cov.
+        pixels (list of np.arrays): RING pixels of each component.
+        nside (int): The nside of the maps.
+        ordering (string): The ordering of the covariance matrix. The pixels
+            must be sorted in this ordering (see likelihood.observed_pixels).
+    """
+    npix = 12 * nside ** 2
+    mean_maps = np.full((len(pixels), npix), healpy.UNSEEN)
+    rms_maps = np.full((len(pixels), npix), healpy.UNSEEN)
+    offset = 0
+    rms = np.sqrt(np.diag(cov))
+    for comp, curr_pixels in enumerate(pixels):
+        indices = slice(offset, offset + len(curr_pixels))
+        mean_maps[comp, curr_pixels] = mean[indices]
+        rms_maps[comp, curr_pixels] = rms[indices]
+        offset += len(curr_pixels)
+    covariance.write_signal_map(prefix + '_mean.fits', mean_maps, 'ring')
+    covariance.write_rms_map(prefix + '_rms.fits', rms_maps, 'ring')
+    file_utils.write_covmat(prefix + '_N.unf', cov, ordering,
+                            1 if len(pixels) > 1 else 0)
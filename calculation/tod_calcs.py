@@ -2,37 +2,173 @@ import numpy as np
 import math
 
 def bin_phases(tod, sample_frequency, bin_width, target_period):
+    """ Folds TOD samples into phase bins and sums each bin.
+
+    Sample i goes to bin k_i modulo the number of bins, where k_i is
+    increased by at most one per sample whenever i exceeds the running
+    limit sample_frequency * bin_width * (k_i + 1).
+
+    Arguments:
+        tod (np.array or list of np.arrays): The TOD samples. A 2-D
+            (n_detectors, n_samples) array or a list of TODs (e.g. one per
+            PID, of different lengths) is binned per row, each starting at
+            phase zero. A list of scalars is a single TOD.
+        sample_frequency (float): Samples per unit of time.
+        bin_width (float): Width of each bin, in the same time unit.
+        target_period (float): The folding period, in the same time unit.
+
+    Returns:
+        Array of the binned sums, of length ceil(target_period / bin_width)
+        for a single TOD and of shape (n_tods, num_bins) otherwise.
+    """
     num_bins = math.ceil(target_period / bin_width)
-    binned_data = np.zeros(num_bins)
-    currlim = sample_frequency * bin_width
-    currbin = 0
-    for i, el in enumerate(tod):
-        if i > currlim:
-            currlim += sample_frequency * bin_width
-            currbin += 1
-            currbin = currbin % num_bins
-        binned_data[currbin] += el
-    return binned_data
+    if (isinstance(tod, (list, tuple)) and
+            any(np.ndim(curr_tod) > 0 for curr_tod in tod)):
+        tods = [np.asarray(curr_tod) for curr_tod in tod]
+    else:
+        tod = np.asarray(tod)
+        if tod.ndim == 1:
+            return bin_phases([tod], sample_frequency, bin_width,
+                              target_period)[0]
+        tods = list(tod)
+    lengths = np.array([len(curr_tod) for curr_tod in tods], dtype=np.int64)
+    bins = _phase_bins(lengths.max(initial=0), sample_frequency * bin_width,
+                       num_bins)
+    rows = np.repeat(np.arange(len(tods)), lengths)
+    flat_bins = rows * num_bins + np.concatenate(
+        [bins[:length] for length in lengths] + [bins[:0]])
+    weights = np.concatenate([curr_tod.ravel() for curr_tod in tods] +
+                             [np.zeros(0)])
+    return np.bincount(flat_bins, weights=weights,
+                       minlength=len(tods) * num_bins).reshape(len(tods),
+                                                               num_bins)
 
 
-def downsample_tod(tod, orig_frequency, target_frequency):
-    samples_per_sample = orig_frequency / target_frequency
+def _phase_bins(num_samples, step, num_bins):
+    """ Phase bin of each of the first num_samples samples.
+
+    The limits are accumulated the same way as a running sum would, and
+    the bin counter k_i = min(k_{i-1} + 1, #{limits < i}) is solved in
+    closed form.
+    """
+    limits = np.cumsum(np.full(num_samples + 1, float(step)))
+    samples = np.arange(num_samples)
+    crossed = np.searchsorted(limits, samples, side='left')
+    counter = samples + np.minimum.accumulate(crossed - samples)
+    return counter % num_bins
+
+
+class TodDownsampler(object):
+    """ Streaming downsampler that averages TOD samples into bins.
+
+    Bin j (counting from zero) is closed by the first sample whose index i
+    exceeds (j + 1) * orig_frequency / target_frequency, and at most one
+    bin is closed per sample. The TOD can be fed in chunks of any length;
+    the partially filled bin is carried over to the next chunk, so the
+    output does not depend on how the TOD is split.
+
+    Chunks may have leading dimensions (e.g. detectors), in which case the
+    samples run along the last axis and all leading dimensions are
+    downsampled together.
+    """
+
+    def __init__(self, orig_frequency, target_frequency):
+        self.samples_per_sample = orig_frequency / target_frequency
+        self.reset()
 
-    j = 0
-    curr_count = 0
-    downsampled_tod = []
-    curr_bin = 0
+    def reset(self):
+        "Discards all carried state and starts again at sample zero."
+        self._num_seen = 0
+        self._min_lag = 0
+        self._curr_bin = 0
+        self._curr_sum = None
+        self._curr_count = 0
 
-    for i, el in enumerate(tod):
-        if i > (j+1) * samples_per_sample:
-            curr_bin /= curr_count
-            downsampled_tod.append(curr_bin)
-            j += 1
-            curr_bin = 0
-            curr_count = 0
-        curr_bin += el
-        curr_count += 1
-    return downsampled_tod
+    def update(self, chunk):
+        """ Adds a chunk of samples.
 
+        Arguments:
+            chunk (np.array): The next samples, along the last axis.
+
+        Returns:
+            Array of the means of the bins that were completed by this
+            chunk, along the last axis.
+        """
+        chunk = np.asarray(chunk)
+        num = chunk.shape[-1]
+        if self._curr_sum is None:
+            self._curr_sum = np.zeros(chunk.shape[:-1])
+        if num == 0:
+            return np.zeros(chunk.shape[:-1] + (0,))
+        bins = self._bin_indices(num)
+        starts = np.flatnonzero(np.diff(bins, prepend=bins[0] - 1))
+        sums = np.add.reduceat(chunk, starts, axis=-1, dtype=np.float64)
+        counts = np.diff(np.append(starts, num))
+        if bins[0] == self._curr_bin:
+            sums[..., 0] += self._curr_sum
+            counts[0] += self._curr_count
+        else:
+            # The carried bin was closed by the first sample of this chunk
+            sums = np.concatenate([self._curr_sum[..., None], sums], axis=-1)
+            counts = np.append(self._curr_count, counts)
+        self._curr_bin = bins[-1]
+        self._curr_sum = sums[..., -1]
+        self._curr_count = counts[-1]
+        return sums[..., :-1] / counts[:-1]
+
+    def flush(self):
+        """ Returns the mean of the final, partially filled bin.
+
+        Returns:
+            Array with the mean of the bin along the last axis, which is
+            empty if no samples are pending. The state is reset.
+        """
+        if self._curr_count == 0:
+            shape = () if self._curr_sum is None else self._curr_sum.shape
+            res = np.zeros(shape + (0,))
+        else:
+            res = (self._curr_sum / self._curr_count)[..., None]
+        self.reset()
+        return res
+
+    def _bin_indices(self, num):
+        """ Bin index of the next num samples, updating the sample count.
+
+        With c_i the number of boundaries below sample i, the bin index
+        follows k_i = min(k_{i-1} + 1, c_i), whose solution
+        k_i = i + min_{j <= i} (c_j - j) only needs the running minimum to
+        be carried between chunks.
+        """
+        samples = np.arange(self._num_seen, self._num_seen + num)
+        crossed = self._num_boundaries_below(samples)
+        lag = np.minimum.accumulate(
+            np.minimum(crossed - samples, self._min_lag))
+        self._num_seen += num
+        self._min_lag = lag[-1]
+        return samples + lag
+
+    def _num_boundaries_below(self, samples):
+        """ Number of j >= 0 with (j + 1) * samples_per_sample < sample. """
+        step = self.samples_per_sample
+        count = np.maximum(np.ceil(samples / step) - 1, 0).astype(np.int64)
+        # Correct the estimate for rounding so the boundaries are the
+        # products (j + 1) * step exactly as the sample loop computed them
+        while True:
+            too_low = (count + 1) * step < samples
+            too_high = (count > 0) & (count * step >= samples)
+            if not too_low.any() and not too_high.any():
+                return count
+            count += too_low
+            count -= too_high
+
+
+def downsample_tod(tod, orig_frequency, target_frequency):
+    """ Downsamples a TOD by averaging samples into bins.
 
+    The final, partially filled bin is dropped. See TodDownsampler for the
+    binning and for streaming over chunks.
 
+    Returns:
+        Array of the bin means.
+    """
+    return TodDownsampler(orig_frequency, target_frequency).update(tod)
@@ -1,9 +1,11 @@
+import os
 import astropy.io.fits as pf
 import numpy as np
 import h5py
 import matplotlib.pyplot as plt
 from matplotlib import rcParams, rc
 from matplotlib.ticker import MaxNLocator, StrMethodFormatter, FixedLocator
+from utils import chain_utils
 
 params = {'savefig.dpi'        : 300, # save figures to 300 dpi
 #          'text.usetex': True,
@@ -89,7 +91,8 @@ def load_npipe_gains(channel, initfile='/mn/stornext/u3/eirikgje/data/cassiopeia
 def load_bp_gains(channel, samples, target_files=['/mn/stornext/u3/hke/xsan/commander3/v2/chains_BP7_c10/chain_c0001.h5',
                                                   '/mn/stornext/u3/hke/xsan/commander3/v2/chains_BP7_c11/chain_c0001.h5',
                                                   '/mn/stornext/u3/hke/xsan/commander3/v2/chains_BP7_c12/chain_c0001.h5',
-                                                  '/mn/stornext/u3/hke/xsan/commander3/v2/chains_BP7_c13/chain_c0001.h5']):
+                                                  '/mn/stornext/u3/hke/xsan/commander3/v2/chains_BP7_c13/chain_c0001.h5'],
+                  store_dir='./'):
     if channel == '030':
         dets = ['27M', '27S', '28M', '28S']
     elif channel == '044':
@@ -103,22 +106,22 @@ def load_bp_gains(channel, samples, target_files=['/mn/stornext/u3/hke/xsan/comm
     elif channel == '070':
         dets = ['18M', '18S', '19M', '19S', '20M', '20S', '21M', '21S', '22M', '22S', '23M', '23S']
 
-    data = {}
+    # The gains of all channels of each chain are transposed into a columnar
+    # store once, so that later calls only convert the samples added since
+    gains = []
     for target_file in target_files:
-        f = h5py.File(target_file, mode='r')
-        for j in range(samples+1):
-            for i, det in enumerate(dets):
-                if det not in data:
-                    data[det] = []
-                try:
-                    d = f['{:06d}'.format(j)]['tod'][channel]['gain']
-                except:
-                    continue
-                data[det].append(np.array([np.arange(len(d[i, :])), d[i, :]]))
-        f.close()
+        store_file = store_dir + 'gains_{}.h5'.format(
+            os.path.basename(os.path.dirname(target_file)))
+        chain_utils.update_columnar(target_file, store_file, 'tod/*/gain')
+        gains.append(chain_utils.read_columnar(
+            store_file, 'tod/{}/gain'.format(channel),
+            samples=range(samples+1))[1])
+    gains = np.concatenate(gains)
 
-    for det in dets:
-        data[det] = np.array(data[det])
+    data = {}
+    for i, det in enumerate(dets):
+        pids = np.broadcast_to(np.arange(gains.shape[2]), gains[:, i].shape)
+        data[det] = np.stack([pids, gains[:, i]], axis=1)
 
     return data
 
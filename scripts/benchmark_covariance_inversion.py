@@ -0,0 +1,172 @@
+from utils import file_utils, external_exec_utils, paths
+from calculation import covariance
+import numpy as np
+import argparse
+import os
+import time
+
+
+def create_test_matrix(fname, size, seed=0):
+    """ Writes a random, well-conditioned positive definite matrix.
+
+    The matrix is written row block by row block, so sizes beyond the
+    available memory can be used for the out-of-core runs.
+    """
+    rng = np.random.default_rng(seed)
+    # A diagonally dominant matrix from a banded random factor
+    bandwidth = min(size, 64)
+    factor_band = rng.normal(size=(size, bandwidth)) / np.sqrt(bandwidth)
+
+    def rows(start, stop):
+        res = np.zeros((stop - start, size))
+        for i in range(start, stop):
+            lo = max(0, i - bandwidth + 1)
+            hi = min(size, i + bandwidth)
+            for j in range(lo, hi):
+                res[i - start, j] = _band_dot(factor_band, i, j, bandwidth)
+            res[i - start, i] += 1.
+        return res
+
+    with file_utils.CovmatWriter(fname, size, 'ring', 1) as writer:
+        for start in range(0, size, covariance.DEFAULT_BLOCK_ROWS):
+            writer.write_rows(rows(start, min(
+                start + covariance.DEFAULT_BLOCK_ROWS, size)))
+
+
+def _band_dot(factor_band, i, j, bandwidth):
+    "Element (i, j) of B B^T, where row i of B is nonzero in [i, i + bw)."
+    lo = max(i, j)
+    hi = min(i, j) + bandwidth
+    if hi <= lo:
+        return 0.
+    return np.dot(factor_band[i, lo - i:hi - i], factor_band[j, lo - j:hi - j])
+
+
+def benchmark(matrix_fname, work_dir, memory_budgets, num_threads=None,
+              use_scalapost=False, num_processes=1, in_memory=True):
+    """ Times the available inversion routes on the same matrix.
+
+    The in-memory Cholesky inverse (if run) is the reference for the
+    reported maximum absolute errors.
+
+    Returns:
+        List of (label, seconds, max_error) tuples.
+    """
+    covmat = file_utils.read_covmat(matrix_fname, mmap=True)
+    results = []
+    reference = None
+    if in_memory:
+        start = time.time()
+        reference = covariance.invert(covmat['data'])
+        results.append(('in-memory cholesky', time.time() - start, 0.))
+    for budget in memory_budgets:
+        out_fname = os.path.join(work_dir, 'inv_ooc_{}.unf'.format(budget))
+        start = time.time()
+        covariance.invert_out_of_core(covmat['data'], out_fname,
+                                      covmat['ordering'],
+                                      covmat['polarization'],
+                                      memory_budget=budget,
+                                      num_threads=num_threads)
+        elapsed = time.time() - start
+        results.append(('out-of-core, {} MB'.format(budget // 2 ** 20),
+                        elapsed, _max_error(out_fname, reference)))
+        os.remove(out_fname)
+    if use_scalapost:
+        out_fname = os.path.join(work_dir, 'inv_scalapost.unf')
+        arguments = 'invert LU {} {}'.format(matrix_fname,
+                                             out_fname).split(' ')
+        start = time.time()
+        external_exec_utils.run_external_process(
+            paths.SCALAPOST_PATH, arguments, is_mpi=True,
+            num_processes=num_processes)
+        elapsed = time.time() - start
+        results.append(('scalapost LU, {} processes'.format(num_processes),
+                        elapsed, _max_error(out_fname, reference)))
+        os.remove(out_fname)
+    return results
+
+
+def _max_error(fname, reference):
+    if reference is None:
+        return np.nan
+    inverse = file_utils.read_covmat(fname, mmap=True)['data']
+    error = 0.
+    for start in range(0, len(reference), covariance.DEFAULT_BLOCK_ROWS):
+        stop = start + covariance.DEFAULT_BLOCK_ROWS
+        error = max(error, np.abs(inverse[start:stop] -
+                                  reference[start:stop]).max())
+    return error
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark the in-memory, out-of-core and scalapost inversions of a covariance matrix. Either an existing matrix is used, or a random positive definite matrix of the given size is created in the work directory."
+    )
+    parser.add_argument(
+        'work_dir',
+        type=str,
+        help='The directory where the test and output matrices are written.'
+    )
+    parser.add_argument(
+        '--matrix',
+        dest='matrix',
+        type=str,
+        default=None,
+        help='An existing covariance matrix (unf) to invert.'
+    )
+    parser.add_argument(
+        '--size',
+        dest='size',
+        type=int,
+        default=4096,
+        help='The size of the random test matrix (default 4096)'
+    )
+    parser.add_argument(
+        '--memory_budgets',
+        dest='memory_budgets',
+        nargs='*',
+        type=int,
+        default=[256, 2048],
+        help='Memory budgets (in MB) of the out-of-core runs (default 256 2048)'
+    )
+    parser.add_argument(
+        '--num_threads',
+        dest='num_threads',
+        type=int,
+        default=None,
+        help='Number of threads of the out-of-core runs (default: all CPUs)'
+    )
+    parser.add_argument(
+        '--skip_in_memory',
+        dest='skip_in_memory',
+        action='store_true',
+        help='Do not run the in-memory inversion (errors are then not reported)'
+    )
+    parser.add_argument(
+        '--use_scalapost',
+        dest='use_scalapost',
+        action='store_true',
+        help='Also time the external scalapost LU inversion'
+    )
+    parser.add_argument(
+        '--num_processes',
+        dest='num_processes',
+        default=1,
+        type=int,
+        help='Number of MPI processes for scalapost (default 1)'
+    )
+    args = parser.parse_args()
+    matrix_fname = args.matrix
+    if matrix_fname is None:
+        matrix_fname = os.path.join(args.work_dir,
+                                    'test_covmat_{}.unf'.format(args.size))
+        create_test_matrix(matrix_fname, args.size)
+    results = benchmark(matrix_fname, args.work_dir,
+                        [budget * 2 ** 20 for budget in args.memory_budgets],
+                        num_threads=args.num_threads,
+                        use_scalapost=args.use_scalapost,
+                        num_processes=args.num_processes,
+                        in_memory=not args.skip_in_memory)
+    for label, elapsed, error in results:
+        print('{:<35} {:10.2f} s   max abs error {:.3e}'.format(
+            label, elapsed, error))
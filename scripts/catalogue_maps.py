@@ -0,0 +1,45 @@
+from utils import map_catalogue
+import argparse
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Build or update a header-only catalogue of the map files in a directory. Only files that are new or whose mtime or size have changed since the last run are rescanned.")
+    parser.add_argument(
+        'directory',
+        type=str,
+        help='The directory (searched recursively) containing the map files'
+    )
+    parser.add_argument(
+        'catalogue',
+        type=str,
+        help='The filename of the sqlite catalogue to create or update'
+    )
+    parser.add_argument(
+        '--pattern',
+        dest='pattern',
+        type=str,
+        default='*.fits',
+        help='Glob pattern the map file names must match (default *.fits)'
+    )
+    parser.add_argument(
+        '--extension',
+        dest='extension',
+        type=int,
+        default=1,
+        help='The FITS extension containing the maps (default 1)'
+    )
+    parser.add_argument(
+        '--num_processes',
+        dest='num_processes',
+        type=int,
+        default=None,
+        help='Number of worker processes (default: number of CPUs)'
+    )
+    args = parser.parse_args()
+    fnames = map_catalogue.find_map_files(args.directory, args.pattern)
+    scanned, removed = map_catalogue.update_catalogue(
+        args.catalogue, fnames, extension=args.extension,
+        num_processes=args.num_processes, verbose=True)
+    print("{} files found, {} scanned, {} removed from catalogue".format(
+        len(fnames), scanned, removed))
@@ -0,0 +1,38 @@
+import argparse
+from utils import chain_utils
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Transpose a Commander 3 chain file into a parameter-major store with a sample axis, or add the new samples of the chain to an existing store")
+
+    parser.add_argument(
+        'chain_file',
+        type=str,
+        help='The chain file (e.g. chain_c0001.h5)'
+    )
+    parser.add_argument(
+        'store_file',
+        type=str,
+        help='The store to create or update (must be .h5)'
+    )
+    parser.add_argument(
+        '--datasets',
+        type=str,
+        nargs='+',
+        default=None,
+        help="Glob patterns of the datasets within a sample to convert, e.g. 'tod/*/gain'. Defaults to all datasets when creating the store, and to those already in it when updating."
+    )
+    parser.add_argument(
+        '--chunk-samples',
+        type=int,
+        dest='chunk_samples',
+        default=chain_utils.DEFAULT_CHUNK_SAMPLES,
+        help='Number of samples in a chunk of the store'
+    )
+
+    args = parser.parse_args()
+    num_samples = chain_utils.update_columnar(args.chain_file,
+                                              args.store_file,
+                                              datasets=args.datasets,
+                                              chunk_samples=args.chunk_samples)
+    print('Added {} samples to {}'.format(num_samples, args.store_file))
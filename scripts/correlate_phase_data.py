@@ -28,11 +28,8 @@ for detector in detectors:
 
         data = np.loadtxt(datafile)
 #    tod = data[:, 1]
-        ncorr = data[:, 5]
-        s_tot = data[:, 7]
-
-        binned_ncorr = tc.bin_phases(ncorr, sampling_frequencies[band], bin_width, target_period)
-        binned_s_tot = tc.bin_phases(s_tot, sampling_frequencies[band], bin_width, target_period)
+        # ncorr and s_tot columns
+        binned_ncorr, binned_s_tot = tc.bin_phases(data[:, [5, 7]].T, sampling_frequencies[band], bin_width, target_period)
         random = np.random.rand(len(binned_ncorr))
         corrcoefs.append(np.corrcoef(binned_ncorr, binned_s_tot)[0, 1])
         random_corrcoefs.append(np.corrcoef(binned_ncorr, random)[0, 1])
@@ -1,6 +1,5 @@
-import file_utils
-import external_exec_utils
-import paths
+from utils import file_utils, external_exec_utils, paths
+from calculation import covariance
 import os
 import argparse
 import shutil
@@ -44,9 +43,61 @@ def create_matrix_suite(input_matrix, map2mask, prefix, postfix,
         num_processes=num_processes)
 
 
+def diagonalize_matrix_native(cov_fname, map2mask_fname, out_covname,
+                              block_diagonal=False, compact=False):
+    """ In-process equivalent of diagonalize_matrix.
+
+    Only the per-pixel elements of the (memory-mapped) input matrix are
+    read.
+
+    Arguments:
+        block_diagonal (bool): Keep the correlations between the Stokes
+            components of each pixel instead of only the diagonal.
+        compact (bool): Save the matrix as a compact .npz file (replacing
+            the .unf extension of out_covname) instead of expanding it to a
+            dense matrix file.
+
+    Returns:
+        The file_utils.BlockDiagonalCovariance.
+    """
+    covmat = file_utils.read_covmat(cov_fname, mmap=True)
+    pixels, _, _, _ = covariance.read_map2mask(map2mask_fname)
+    cov = file_utils.BlockDiagonalCovariance.from_covmat(
+        covmat, ncomp=covmat['n'] // len(pixels),
+        diagonal=not block_diagonal)
+    _write_matrix(cov, out_covname, compact)
+    return cov
+
+
+def create_matrix_suite_native(cov, map2mask, prefix, postfix,
+                               compact=False):
+    """ In-process equivalent of create_matrix_suite for a block-diagonal
+    matrix.
+
+    The inverse and inverse square root are computed pixel by pixel, so no
+    dense matrix is ever formed unless it is written out.
+    """
+    inv_fname = '{}covmat_invN_{}.unf'.format(prefix, postfix)
+    _write_matrix(cov.inverse(), inv_fname, compact)
+    sqrtinvfname = '{}covmat_sqrt_invN_{}.unf'.format(prefix, postfix)
+    _write_matrix(cov.inverse_sqrt(), sqrtinvfname, compact)
+    rmsfname = '{}covmat_rms_{}.fits'.format(prefix, postfix)
+    pixels, indices, nside, map_ordering = covariance.read_map2mask(map2mask)
+    covariance.write_rms_map(
+        rmsfname, covariance.diag2rms_maps(cov.diag, pixels, indices, nside),
+        map_ordering)
+
+
+def _write_matrix(cov, fname, compact):
+    if compact:
+        cov.save(os.path.splitext(fname)[0] + '.npz')
+    else:
+        cov.write_covmat(fname)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
-        description="Use scalapost to create a diagonal matrix (in unf form) using the diagonal elements of a full covariance matrix, as well as creating the inverse, sqrt and rms of this diagonal matrix. Supports looping over several variational strings (for example, 30 GHz, 44 GHz, etc.). The input filename should be of the form {prefix}{variational parameter}{postfix}.unf. The output filenames will be of the form {prefix}diagonal_covmat_{N,invN, sqrt_invN,rms}_{midfix}_{variational parameter}_{postfix}.{unf, fits}, where 'fits' is used for the rms and 'unf' for the full matrices."
+        description="Create a diagonal matrix (in unf form) using the diagonal elements of a full covariance matrix, as well as creating the inverse, sqrt and rms of this diagonal matrix. Supports looping over several variational strings (for example, 30 GHz, 44 GHz, etc.). The input filename should be of the form {prefix}{variational parameter}{postfix}.unf. The output filenames will be of the form {prefix}diagonal_covmat_{N,invN, sqrt_invN,rms}_{midfix}_{variational parameter}_{postfix}.{unf, fits}, where 'fits' is used for the rms and 'unf' for the full matrices."
     )
     parser.add_argument(
         'data_dir',
@@ -105,6 +156,24 @@ if __name__ == '__main__':
         type=int,
         help='Number of MPI processes (default 1)'
     )
+    parser.add_argument(
+        '--use_scalapost',
+        dest='use_scalapost',
+        action='store_true',
+        help='Run the external scalapost binary instead of the in-process implementation'
+    )
+    parser.add_argument(
+        '--block_diagonal',
+        dest='block_diagonal',
+        action='store_true',
+        help='Keep the correlations between the Stokes parameters of each pixel (in-process implementation only)'
+    )
+    parser.add_argument(
+        '--compact',
+        dest='compact',
+        action='store_true',
+        help='Store the matrices as compact .npz files instead of dense .unf files (in-process implementation only)'
+    )
     args = parser.parse_args()
     varlist = args.variational_argument
     prefix = args.data_dir + args.output_prefix + 'diagonal_'
@@ -112,6 +181,12 @@ if __name__ == '__main__':
         input_matrix = '{}{}{}.unf'.format(args.data_dir + args.input_prefix, el, args.input_postfix)
         postfix = '{}_{}_{}'.format(args.output_midfix, el, args.output_postfix)
         N_fname = '{}covmat_N_{}.unf'.format(prefix, postfix)
-        diagonalize_matrix(
-            input_matrix, args.data_dir + args.map2mask, N_fname)
-        create_matrix_suite(N_fname, args.data_dir + args.map2mask, prefix, postfix, args.num_processes)
+        if args.use_scalapost:
+            diagonalize_matrix(
+                input_matrix, args.data_dir + args.map2mask, N_fname)
+            create_matrix_suite(N_fname, args.data_dir + args.map2mask, prefix, postfix, args.num_processes)
+        else:
+            cov = diagonalize_matrix_native(
+                input_matrix, args.data_dir + args.map2mask, N_fname,
+                args.block_diagonal, args.compact)
+            create_matrix_suite_native(cov, args.data_dir + args.map2mask, prefix, postfix, args.compact)
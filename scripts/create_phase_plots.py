@@ -20,21 +20,10 @@ for detector in detectors:
         if not os.path.exists(datafile): continue
 
         data = np.loadtxt(datafile)
-        tod = data[:, 1]
-        ncorr = data[:, 5]
-        stot = data[:, 7]
+        # TOD, ncorr and stot columns, binned in one call
+        binned = tc.bin_phases(data[:, [1, 5, 7]].T, sampling_frequencies[band], bin_width, target_period)
 
-        binned_data = tc.bin_phases(tod, sampling_frequencies[band], bin_width, target_period)
-        plt.plot(binned_data)
-        plt.savefig(output_dir + 'tod_phased_{}_pid_{}.png'.format(detector, pid_string))
-        plt.clf()
-
-        binned_data = tc.bin_phases(ncorr, sampling_frequencies[band], bin_width, target_period)
-        plt.plot(binned_data)
-        plt.savefig(output_dir + 'ncorr_phased_{}_pid_{}.png'.format(detector, pid_string))
-        plt.clf()
-
-        binned_data = tc.bin_phases(stot, sampling_frequencies[band], bin_width, target_period)
-        plt.plot(binned_data)
-        plt.savefig(output_dir + 'stot_phased_{}_pid_{}.png'.format(detector, pid_string))
-        plt.clf()
+        for name, binned_data in zip(['tod', 'ncorr', 'stot'], binned):
+            plt.plot(binned_data)
+            plt.savefig(output_dir + '{}_phased_{}_pid_{}.png'.format(name, detector, pid_string))
+            plt.clf()
@@ -1,19 +1,15 @@
-import h5py
 import argparse
+from utils import chain_utils
+
+# The groups of a sample that make up a Commander 3 init file
+INIT_GROUPS = ['ame', 'bandpass', 'cmb', 'dust', 'ff', 'gain', 'md', 'synch',
+               'tod']
+
+
+def extract(filename, iteration, outfilename, groups=INIT_GROUPS):
+    chain_utils.slice_chains(filename, outfilename, iterations=[iteration],
+                             groups=groups, flat=True, num_processes=1)
 
-def extract(filename, iteration, outfilename):
-    f = h5py.File(filename)
-    iteration = '{:06d}'.format(iteration)
-    outfile = h5py.File(outfilename, 'w')
-    f.copy(iteration + '/ame', outfile['/'])
-    f.copy(iteration + '/bandpass', outfile['/'])
-    f.copy(iteration + '/cmb', outfile['/'])
-    f.copy(iteration + '/dust', outfile['/'])
-    f.copy(iteration + '/ff', outfile['/'])
-    f.copy(iteration + '/gain', outfile['/'])
-    f.copy(iteration + '/md', outfile['/'])
-    f.copy(iteration + '/synch', outfile['/'])
-    f.copy(iteration + '/tod', outfile['/'])
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
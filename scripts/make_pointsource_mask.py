@@ -319,4 +319,4 @@ if __name__ == '__main__':
                 'filter_col': args.filter_col})
 
     outmask = parse_and_generate_mask(args.nside, args.ordering, sources, filters)
-    fits_io_utils.write_planck_fullmap(args.mask_fname, outmask)
+    fits_io_utils.write_planck_fullmap_chunked(args.mask_fname, outmask)
@@ -18,15 +18,16 @@ output_dir = data_dir + '/figures/'
 window_size = 500
 
 for band, detset in detectors.items():
-    for detector in detset:
-        a = np.loadtxt(data_dir + 'tod_{}_corrcoefs.dat'.format(detector))
-        b = operations.moving_average(a[:, 1], window_size)
+    corrcoefs = np.array([
+        np.loadtxt(data_dir + 'tod_{}_corrcoefs.dat'.format(detector))[:, 1]
+        for detector in detset])
+    # All detectors of the band are smoothed in one call
+    movavs = operations.moving_average(corrcoefs, window_size, axis=-1)
+    for detector, b in zip(detset, movavs):
         plt.plot(b)
         plt.savefig(output_dir + 'movav_corrcoefs_{}.png'.format(detector))
         plt.clf()
-    for detector in detset:
-        a = np.loadtxt(data_dir + 'tod_{}_corrcoefs.dat'.format(detector))
-        b = operations.moving_average(a[:, 1], window_size)
+    for detector, b in zip(detset, movavs):
         plt.plot(b, label='{}'.format(detector))
     plt.legend()
     plt.savefig(output_dir + 'movav_corrcoefs_band{}.png'.format(band))
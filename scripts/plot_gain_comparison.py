@@ -3,6 +3,7 @@ import numpy as np
 import h5py
 import matplotlib.pyplot as plt
 from matplotlib import rcParams, rc
+from utils import chain_utils
 
 params = {'savefig.dpi'        : 300, # save figures to 300 dpi
           'xtick.top'          : False,
@@ -79,7 +80,8 @@ def load_npipe_gains(channel, initfile='/mn/stornext/u3/eirikgje/data/cassiopeia
 
 #def load_bp_gains(channel, sample, target_file='/mn/stornext/u3/eirikgje/data/cassiopeia/chains_debug/chain_c0001.h5'):
 #def load_bp_gains(channel, sample, target_file='/mn/stornext/u3/eirikgje/data/cassiopeia/chains_debug_saved/chain_c0001.h5'):
-def load_bp_gains(channel, sample, target_file='/mn/stornext/u3/hke/xsan/commander3/v2/chains_BP7_c12/chain_c0001.h5'):
+def load_bp_gains(channel, sample, target_file='/mn/stornext/u3/hke/xsan/commander3/v2/chains_BP7_c12/chain_c0001.h5',
+                  store_file='gains_BP7_c12.h5'):
     if channel == '030':
         dets = ['27M', '27S', '28M', '28S']
     elif channel == '044':
@@ -93,17 +95,16 @@ def load_bp_gains(channel, sample, target_file='/mn/stornext/u3/hke/xsan/command
     elif channel == '070':
         dets = ['18M', '18S', '19M', '19S', '20M', '20S', '21M', '21S', '22M', '22S', '23M', '23S']
 
-    f = h5py.File(target_file, mode='r')
+    # The gains of all channels are transposed into a columnar store once,
+    # so that later calls only convert the samples added since
+    chain_utils.update_columnar(target_file, store_file, 'tod/*/gain')
+    _, gains = chain_utils.read_columnar(store_file,
+                                         'tod/{}/gain'.format(channel),
+                                         samples=range(sample+1))
     data = {}
-    for j in range(sample+1):
-        for i, det in enumerate(dets):
-            if det not in data:
-                data[det] = []
-            d = f['{:06d}'.format(j)]['tod'][channel]['gain']
-            data[det].append(np.array([np.arange(len(d[i, :])), d[i, :]]))
-
-    for det in dets:
-        data[det] = np.array(data[det])
+    for i, det in enumerate(dets):
+        pids = np.broadcast_to(np.arange(gains.shape[2]), gains[:, i].shape)
+        data[det] = np.stack([pids, gains[:, i]], axis=1)
 
     return data
 
@@ -1,7 +1,7 @@
-import healpy
 import matplotlib.pyplot as plt
 import numpy as np
 import argparse
+from utils import fits_io_utils
 
 def plot_things(data_directory, pixel_number, signal_type, sample_range,
                 plot_prefix):
@@ -18,8 +18,8 @@ def plot_things(data_directory, pixel_number, signal_type, sample_range,
              'amp_s'])):
         datapoints = []
         for sample in range(sample_range[0], sample_range[1]):
-            curr_sample = healpy.read_map(data_directory + component + '_c0001_k{:0>5}.fits'.format(sample), field=signal_map[signal_type])
-            datapoints.append(curr_sample[pixel_number])
+            curr_sample = fits_io_utils.read_planck_pixels(data_directory + component + '_c0001_k{:0>5}.fits'.format(sample), [pixel_number], field=signal_map[signal_type])
+            datapoints.append(curr_sample[0])
         datapoints = np.array(datapoints)
         component_points[component] = datapoints
         axes[i].plot(component_points[component], label=component_desc)
@@ -4,8 +4,12 @@ import glob
 import os
 import fileinput
 import random
-import camb
 import numpy as np
+from calculation import camb_grid, cl_emulator, likelihood, sample_statistics
+from utils import file_utils, fits_io_utils
+
+# Maximum multipole of the signal in the gausslike data
+GAUSSLIKE_LMAX = 47
 
 
 def process_parameter_file(base_parameter_file, target_parameter_file, new_parameter_dict={}):
@@ -51,66 +55,37 @@ def run_command(command):
     return
 
 
-def param_recursor(param_range, executor, updater, init_metadata):
-
-    curr_meta = init_metadata
-    curr_param_range_dict = param_range.copy()
-
-    def recurse_params(curr_param_dict, curr_metadata):
-        if curr_param_dict == {}:
-            curr_metadata = executor(curr_metadata)
-            return curr_metadata
-        key, value = curr_param_dict.popitem()
-        print(value)
-        numsteps = round((value[1] - value[0]) / value[2]) + 1
-        for val in np.linspace(value[0], value[1], num=numsteps):
-            curr_metadata = updater(curr_metadata, key, val)
-            curr_metadata = recurse_params(curr_param_dict.copy(), curr_metadata)
-        return curr_metadata
-    return recurse_params(curr_param_range_dict, curr_meta)
-
-
 def map_likelihood(
         base_camb_param_file, base_info_file, target_dir,
         param_range, label, lmin, lmax, like_file,
-        enabled_spectra=['TT', 'TE', 'TB', 'EE', 'EB', 'BB']):
-    metadata = {}
-    metadata['model'] = camb.read_ini(base_camb_param_file)
-    metadata['base_cl_prefix'] = target_dir + 'cls_' + label
-    metadata['currparam'] = []
-    metadata['start_clfile'] = None
-
-    def execute(curr_metadata):
-        results = camb.get_results(curr_metadata['model'])
-        cls = results.get_total_cls(CMB_unit='muK')
-        ells = np.arange(len(cls)).reshape(len(cls), 1)
-        cls = np.append(ells, cls, axis=1)
-        parstring = curr_metadata['currparam'][0] + str(curr_metadata['currparam'][1])
-        clfname = curr_metadata['base_cl_prefix'] + '_' + parstring + '.dat'
-        np.savetxt(clfname, cls)
-        if curr_metadata['start_clfile'] is None:
-            curr_metadata['start_clfile'] = clfname
-        curr_metadata['cl_filelist'].write(str(curr_metadata['currparam'][1]) + ' ' + clfname.split('/')[-1] + '\n')
-        return curr_metadata
-
-    def update(curr_metadata, par_name, par_val):
-            namelist = par_name.split('.')
-            namelist.reverse()
-            model = curr_metadata['model']
-            currobj = model
-            currname = namelist[-1]
-            while len(namelist) > 1:
-                currobj = getattr(currobj, namelist.pop())
-                currname = namelist[-1]
-            setattr(currobj, currname, par_val)
-            curr_metadata['model'] = model
-            curr_metadata['currparam'] = [currname, par_val]
-            return curr_metadata
-
+        enabled_spectra=['TT', 'TE', 'TB', 'EE', 'EB', 'BB'], native=False,
+        num_processes=None, emulator_nodes=None):
+    # The spectra of the grid are cached by their full parameter set, so
+    # they are shared between labels and reruns
+    if emulator_nodes is None:
+        grid = camb_grid.run_grid(base_camb_param_file, param_range,
+                                  target_dir + 'cl_cache/', num_processes)
+    else:
+        grid = emulate_grid(base_camb_param_file, param_range,
+                            target_dir + 'cl_cache/', emulator_nodes,
+                            num_processes)
+    if native:
+        map_likelihood_native(grid, target_dir, label, lmin, lmax,
+                              like_file, enabled_spectra)
+        return
+    base_cl_prefix = target_dir + 'cls_' + label
+    start_clfile = None
     cllist_name = target_dir + 'cllist_' + label + '.dat'
     with open(cllist_name, 'w') as cllistfile:
-        metadata['cl_filelist'] = cllistfile
-        metadata = param_recursor(param_range, execute, update, metadata)
+        for params, cls in grid:
+            # Named after the fastest varying parameter, as before
+            par_name, par_val = list(params.items())[-1]
+            parstring = par_name.split('.')[-1] + str(par_val)
+            clfname = base_cl_prefix + '_' + parstring + '.dat'
+            np.savetxt(clfname, cls)
+            if start_clfile is None:
+                start_clfile = clfname
+            cllistfile.write(str(par_val) + ' ' + clfname.split('/')[-1] + '\n')
 
     commlike = '/mn/stornext/u3/eirikgje/src/Commander/commander1/src/comm_process_resfiles/comm_like_tools'
     base_info_file = target_dir + base_info_file + '.txt'
@@ -123,7 +98,57 @@ def map_likelihood(
     spectrum_flags = ['t' if spec in enabled_spectra else 'f' for spec in spectra]
 
     run_command([commlike, 'fast_par_estimation', curr_info_file,
-                 metadata['start_clfile'], cllist_name, str(lmin), str(lmax)] + spectrum_flags + ['.true.', target_dir + label + '_likelihood.dat'])
+                 start_clfile, cllist_name, str(lmin), str(lmax)] + spectrum_flags + ['.true.', target_dir + label + '_likelihood.dat'])
+
+
+def emulate_grid(base_camb_param_file, param_range, cache_dir, num_nodes,
+                 num_processes=None, num_holdout=4):
+    """ Spectra of a parameter grid from a cl_emulator.ClEmulator.
+
+    CAMB is only run at num_nodes Chebyshev nodes per parameter and at
+    num_holdout random points, which are used to report the interpolation
+    error before the grid is emulated.
+
+    Returns:
+        List of (params, cls) tuples, as camb_grid.run_grid.
+    """
+    bounds = dict((name, value[:2]) for name, value in param_range.items())
+    emulator = cl_emulator.ClEmulator(base_camb_param_file, bounds,
+                                      num_nodes, cache_dir, num_processes)
+    for spec, errors in emulator.validate(num_points=num_holdout).items():
+        if errors['max_rel'] is None:
+            print('Emulator error {}: {:.3e} absolute (the spectrum is '
+                  'zero)'.format(spec, errors['max_abs']))
+        else:
+            print('Emulator error {}: {:.3e} relative, {:.3e} of cosmic '
+                  'variance'.format(spec, errors['max_rel'],
+                                    errors['max_cv']))
+    points = camb_grid.grid_points(param_range)
+    return list(zip(points, emulator.evaluate(points)))
+
+
+def map_likelihood_native(
+        grid, target_dir, label, lmin, lmax, like_file,
+        enabled_spectra=['TT', 'TE', 'TB', 'EE', 'EB', 'BB']):
+    """ In-process equivalent of the likelihood evaluation of map_likelihood.
+
+    The likelihood of the whole grid (as returned by camb_grid.run_grid)
+    is evaluated in one batch with likelihood.GaussianLikelihood. As with
+    fast_par_estimation, the spectra of the first grid point are used for
+    the multipoles and spectra that are not enabled.
+
+    The output file has the value of the fastest varying parameter and
+    the log-likelihood of each grid point.
+    """
+    data = likelihood.read_likelihood_data(target_dir + like_file)
+    param_values = [list(params.values())[-1] for params, _ in grid]
+    cls = [likelihood.cls_from_array(curr_cls, data['lmax'])
+           for _, curr_cls in grid]
+    gausslike = likelihood.GaussianLikelihood(
+        data, cls[0], lmin, lmax, spectra=enabled_spectra)
+    np.savetxt(target_dir + label + '_likelihood.dat',
+               np.column_stack([param_values,
+                                gausslike.log_likelihood(cls)]))
 
 
 def run_likelihood(data_dir,
@@ -141,7 +166,11 @@ def run_likelihood(data_dir,
                    nside=None,
                    full_cov=False,
                    beam_file=None,
-                   fiducial_cl_file=None):
+                   fiducial_cl_file=None,
+                   native=False,
+                   num_processes=None,
+                   emulator_nodes=None,
+                   sample_component='cmb'):
     currdir = os.getcwd()
     data_dir = base_data_dir + data_dir + '/'
     os.chdir(data_dir)
@@ -159,23 +188,51 @@ def run_likelihood(data_dir,
         file_list = glob.glob(chain_dir + 'chain_fg_amps_*')
         burnin = num_samples / 2
         random_seed = random.randint(0, 999999)
-        run_command([commproc, 'pix2mean_cov', chain_dir + label,
-                     str(nside), '3', '1', '3', '3', str(burnin),
-                     '0', '0', str(random_seed), '.true.',
-                     mask_file] + file_list)
-        run_command([scalapost, 'rms2cov',
-                     chain_dir + label+'_rms.fits', '1.',
-                     chain_dir + label+'_rms_N.unf'])
-        run_command([commlike, 'mapcov2gausslike',
-                     chain_dir + label + '_mean.fits',
-                     mask_file,
-#                     chain_dir + label + '_rms_N.unf',
-                     chain_dir + label + '_N.unf',
-                     '.true.', beam_file, fiducial_cl_file,
-                     '47', '0', '47', 'eigen_StoN', '1e-13',
-                     '1e-13', '1.', '0', '0', str(random_seed+1), 'gausslike_' + label])
-    map_likelihood(base_camb_file, base_info_file, data_dir, param_range, label, lmin, lmax, 'gausslike_' + label + '.fits',
-                   enabled_spectra=['TE', 'EE'])
+        if native:
+            mask = fits_io_utils.read_planck_pixels(
+                mask_file, pixel_ranges=[(0, 12 * int(nside) ** 2)],
+                field=None)
+            pixels = likelihood.observed_pixels(mask, 3, 'ring')
+            chains = sample_statistics.group_chain_files(
+                chain_dir + sample_component + '_c*_k*.fits')
+            _, mean, cov = sample_statistics.chain_mean_cov(
+                chains, pixels, burnin=int(burnin), nside=int(nside))
+            sample_statistics.write_mean_cov(chain_dir + label, mean, cov,
+                                             pixels, int(nside))
+            file_utils.BlockDiagonalCovariance.from_diagonal(
+                np.diag(cov), 'ring', 1).write_covmat(
+                    chain_dir + label + '_rms_N.unf')
+        else:
+            run_command([commproc, 'pix2mean_cov', chain_dir + label,
+                         str(nside), '3', '1', '3', '3', str(burnin),
+                         '0', '0', str(random_seed), '.true.',
+                         mask_file] + file_list)
+            run_command([scalapost, 'rms2cov',
+                         chain_dir + label+'_rms.fits', '1.',
+                         chain_dir + label+'_rms_N.unf'])
+        if native:
+            # The S/N basis is cached in the chain directory, so it is only
+            # recomputed when the mask, noise, beam or fiducial spectra change
+            likelihood.write_likelihood_data(
+                'gausslike_' + label + '.npz',
+                likelihood.create_likelihood_data(
+                    chain_dir + label + '_mean.fits', mask_file,
+                    chain_dir + label + '_N.unf', beam_file,
+                    fiducial_cl_file, GAUSSLIKE_LMAX, cache_dir=chain_dir))
+        else:
+            run_command([commlike, 'mapcov2gausslike',
+                         chain_dir + label + '_mean.fits',
+                         mask_file,
+#                         chain_dir + label + '_rms_N.unf',
+                         chain_dir + label + '_N.unf',
+                         '.true.', beam_file, fiducial_cl_file,
+                         str(GAUSSLIKE_LMAX), '0', str(GAUSSLIKE_LMAX),
+                         'eigen_StoN', '1e-13', '1e-13', '1.', '0', '0',
+                         str(random_seed+1), 'gausslike_' + label])
+    like_file = 'gausslike_' + label + ('.npz' if native else '.fits')
+    map_likelihood(base_camb_file, base_info_file, data_dir, param_range, label, lmin, lmax, like_file,
+                   enabled_spectra=['TE', 'EE'], native=native,
+                   num_processes=num_processes, emulator_nodes=emulator_nodes)
 
     os.chdir(currdir)
 
@@ -262,6 +319,35 @@ if __name__ == '__main__':
         help='Whether to run the likelihood with the full covariance matrix. Alternatively, only the diagonal rms elements are used. Only needed if likelihood_type is gausslike.'
     )
 
+    parser.add_argument(
+        '--native',
+        action='store_true',
+        dest='native',
+        help='Create the gausslike data and evaluate the likelihood in-process instead of with comm_like_tools.'
+    )
+
+    parser.add_argument(
+        '--num-processes',
+        type=int,
+        dest='num_processes',
+        default=None,
+        help='Number of processes running CAMB over the parameter grid (default: all CPUs)'
+    )
+    parser.add_argument(
+        '--emulator-nodes',
+        type=int,
+        dest='emulator_nodes',
+        default=None,
+        help='If given, CAMB is only run at this many Chebyshev nodes per parameter (plus a few held-out points to report the error), and the spectra of the grid are interpolated.'
+    )
+    parser.add_argument(
+        '--sample-component',
+        type=str,
+        dest='sample_component',
+        default='cmb',
+        help='With --native and --create-data, the prefix of the per-sample maps in the chain directory ({component}_c0001_k00001.fits etc.) whose mean and covariance are computed (default: cmb)'
+    )
+
     args = parser.parse_args()
     create_data = True if args.create_data else False
     full_cov = True if args.full_cov else False
@@ -277,4 +363,8 @@ if __name__ == '__main__':
                    nside=args.nside,
                    full_cov=full_cov,
                    beam_file=args.beam_file,
-                   fiducial_cl_file=args.fiducial_cl_file)
+                   fiducial_cl_file=args.fiducial_cl_file,
+                   native=args.native,
+                   num_processes=args.num_processes,
+                   emulator_nodes=args.emulator_nodes,
+                   sample_component=args.sample_component)
@@ -0,0 +1,75 @@
+import argparse
+from utils import chain_utils
+
+
+def parse_iteration(value):
+    """ Parses an iteration argument: a sample number (negative counts from
+    the last sample), or START:STOP for a slice of the samples. """
+    if ':' not in value:
+        return int(value)
+    start, stop = [int(part) if part else None for part in value.split(':')]
+    return slice(start, stop)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Extract samples and groups from one or more Commander 3 chain files into a new h5 file")
+
+    parser.add_argument(
+        'out_file',
+        type=str,
+        help='The name of the output file (must be .h5)'
+    )
+    parser.add_argument(
+        'chain_files',
+        type=str,
+        nargs='+',
+        help='The chain files to extract from'
+    )
+    parser.add_argument(
+        '--iterations',
+        type=parse_iteration,
+        nargs='+',
+        default=None,
+        help="The iterations to extract from each chain: sample numbers (negative counts from the last sample) or START:STOP slices of the samples, e.g. --iterations=-50: for the last 50 (a value starting with '-' and holding a ':' must be given with '='). Defaults to all."
+    )
+    parser.add_argument(
+        '--groups',
+        type=str,
+        nargs='+',
+        default=None,
+        help="Glob patterns of the groups or datasets to extract from each sample, e.g. 'cmb' 'tod/*/gain'. Defaults to whole samples."
+    )
+    parser.add_argument(
+        '--thinning',
+        type=int,
+        default=1,
+        help='Keep every n-th selected sample of each chain, counted from the last one'
+    )
+    parser.add_argument(
+        '--virtual',
+        action='store_true',
+        help='Write virtual datasets referring to the chain files instead of copies'
+    )
+    parser.add_argument(
+        '--flat',
+        action='store_true',
+        help='Write the contents of the (single) extracted sample at the root of the file, as an init file'
+    )
+    parser.add_argument(
+        '--num-processes',
+        type=int,
+        dest='num_processes',
+        default=None,
+        help='Number of processes copying samples (default: one per chain)'
+    )
+
+    args = parser.parse_args()
+    plan = chain_utils.slice_chains(args.chain_files, args.out_file,
+                                    iterations=args.iterations,
+                                    groups=args.groups,
+                                    thinning=args.thinning,
+                                    virtual=args.virtual, flat=args.flat,
+                                    num_processes=args.num_processes)
+    for chain_file, sample, group in plan:
+        print('{} sample {} -> {}'.format(chain_file, sample, group))
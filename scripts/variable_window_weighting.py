@@ -1,32 +1,42 @@
+import numpy as np
 from utils import operations
 
 
 freq = '030'
-detector = 1
-pids = np.loadtxt('/home/eirik/temp/pid_ranges_030.dat')
-pid_filter = np.where(pids[:, 0] == detector)
-pids = pids[pid_filter, 2]
-sws = np.loadtxt('/home/eirik/temp/smoothing_windows030.dat')
-sw_filter = np.where(sws[:, 0] == detector)
-sws = sws[sw_filter, 2]
-g_data = np.loadtxt('/home/eirik/temp/gain_030.dat')
-gain_filter = np.where(g_data[:, 0] == detector)
-gains = g_data[gain_filter, 2]
-invsigsquared = g_data[gain_filter, 3]
-
-def pid_range_smoothing(gains, pids, invsigsquared, sw):
-    for i in range(len(pids)):
-        curr_start = pids[i]
-        if i + 1 >= len(pids):
-            curr_end = len(gains)
-        else:
-            curr_end = pids[i + 1]
-        if curr_end == 0 curr_end = len(gains)
-        curr_gains = gains[curr_start-1:curr_end]
-
-
-def padded_moving_average_variable_windows(data, weights, windows):
-    padded_data = pad_data(data, max(windows))
-    padded_weights = pad_data(weights, max(windows))
-    for i, window in enumerate(windows):
+data_dir = '/home/eirik/temp/'
+pid_ranges = np.loadtxt(data_dir + 'pid_ranges_{}.dat'.format(freq))
+sws = np.loadtxt(data_dir + 'smoothing_windows{}.dat'.format(freq))
+g_data = np.loadtxt(data_dir + 'gain_{}.dat'.format(freq))
 
+
+def pid_range_smoothing(gains, pid_starts, invsigsquared, sw):
+    """ Smooths gains with per-sample windows inside each PID range.
+
+    Arguments:
+        gains (np.array): The gain of each sample.
+        pid_starts (np.array): 1-based index of the first sample of each PID
+            range. A value of 0 marks an unused entry.
+        invsigsquared (np.array): Inverse variance of each gain, used as
+            weights.
+        sw (np.array): Smoothing window of each sample.
+
+    Returns:
+        Array of the smoothed gains.
+    """
+    pid_starts = pid_starts[pid_starts > 0].astype(int) - 1
+    return operations.segmented_moving_average(gains, invsigsquared, sw,
+                                               segment_starts=pid_starts)
+
+
+smoothed = []
+for detector in np.unique(g_data[:, 0]):
+    gain_filter = g_data[:, 0] == detector
+    smoothed_gains = pid_range_smoothing(
+        g_data[gain_filter, 2], pid_ranges[pid_ranges[:, 0] == detector, 2],
+        g_data[gain_filter, 3], sws[sws[:, 0] == detector, 2])
+    curr_data = g_data[gain_filter, :3].copy()
+    curr_data[:, 2] = smoothed_gains
+    smoothed.append(curr_data)
+
+np.savetxt(data_dir + 'smoothed_gain_{}.dat'.format(freq),
+           np.concatenate(smoothed))
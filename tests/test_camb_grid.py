@@ -0,0 +1,44 @@
+import pytest
+
+camb = pytest.importorskip('camb')
+
+from calculation import camb_grid
+
+
+def test_grid_points():
+    points = camb_grid.grid_points({'InitPower.r': [0., 0.1, 0.05],
+                                    'Reion.optical_depth': [0.05, 0.06,
+                                                            0.01]})
+    assert points == [
+        {'Reion.optical_depth': 0.05, 'InitPower.r': 0.},
+        {'Reion.optical_depth': 0.05, 'InitPower.r': 0.05},
+        {'Reion.optical_depth': 0.05, 'InitPower.r': 0.1},
+        {'Reion.optical_depth': 0.06, 'InitPower.r': 0.},
+        {'Reion.optical_depth': 0.06, 'InitPower.r': 0.05},
+        {'Reion.optical_depth': 0.06, 'InitPower.r': 0.1}]
+
+
+def test_point_key_hashes_resolved_parameters(tmp_path, monkeypatch):
+    # The parameter file only includes another one, so its text never
+    # changes while the parameters it resolves to do
+    fname = str(tmp_path / 'params.ini')
+    with open(fname, 'w') as f:
+        f.write('DEFAULT(base.ini)\n')
+    resolved = {'H0': 67.}
+
+    def read_ini(ini_fname):
+        assert ini_fname == fname
+        model = camb.CAMBparams()
+        model.set_cosmology(H0=resolved['H0'])
+        return model
+
+    monkeypatch.setattr(camb_grid.camb, 'read_ini', read_ini)
+    point = {'Reion.optical_depth': 0.05}
+    key = camb_grid.point_key(fname, point)
+    assert camb_grid.point_key(fname, dict(point)) == key
+    assert camb_grid.point_key(fname, {'Reion.optical_depth': 0.06}) != key
+    resolved['H0'] = 70.
+    assert camb_grid.point_key(fname, point) != key
+    resolved['H0'] = 67.
+    monkeypatch.setattr(camb_grid.camb, '__version__', '0.0.0')
+    assert camb_grid.point_key(fname, point) != key
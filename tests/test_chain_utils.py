@@ -0,0 +1,294 @@
+import h5py
+import numpy as np
+import pytest
+
+from utils import chain_utils
+
+NDET, NPID = 3, 5
+
+
+def _sample_values(number):
+    rng = np.random.default_rng(number)
+    return {'tod/030/gain': rng.normal(size=(NDET, NPID)),
+            'tod/030/accept': rng.integers(0, 2, NDET).astype(np.int32),
+            'cmb/amp_alm': rng.normal(size=(3, 4)),
+            'chisq': np.float64(number)}
+
+
+def _add_samples(fname, numbers, skip=()):
+    with h5py.File(fname, 'a') as chain:
+        for number in numbers:
+            group = chain.require_group('{:06d}'.format(number))
+            group.attrs['number'] = number
+            for path, value in _sample_values(number).items():
+                if path not in skip:
+                    group.create_dataset(path, data=value)
+
+
+def _stack(path, numbers):
+    return np.array([_sample_values(number)[path] for number in numbers])
+
+
+def test_update_columnar_append(tmp_path):
+    chain_fname = str(tmp_path / 'chain_c0001.h5')
+    store_fname = str(tmp_path / 'store.h5')
+    _add_samples(chain_fname, range(1, 6))
+    # A small buffer writes the samples in several batches
+    assert chain_utils.update_columnar(chain_fname, store_fname,
+                                       chunk_samples=2,
+                                       buffer_bytes=200) == 5
+    with h5py.File(store_fname, 'r') as store:
+        assert list(store.attrs['datasets']) == [
+            'chisq', 'cmb/amp_alm', 'tod/030/accept', 'tod/030/gain']
+        assert store['tod/030/gain'].chunks[0] == 2
+        assert store['tod/030/gain'].compression == 'gzip'
+    assert chain_utils.update_columnar(chain_fname, store_fname) == 0
+
+    _add_samples(chain_fname, range(6, 9))
+    assert chain_utils.update_columnar(chain_fname, store_fname) == 3
+    numbers = list(range(1, 9))
+    for path in ('tod/030/gain', 'tod/030/accept', 'chisq'):
+        samples, values = chain_utils.read_columnar(store_fname, path)
+        np.testing.assert_array_equal(samples, numbers)
+        np.testing.assert_array_equal(values, _stack(path, numbers))
+
+
+def test_update_columnar_stops_at_incomplete_sample(tmp_path):
+    chain_fname = str(tmp_path / 'chain_c0001.h5')
+    store_fname = str(tmp_path / 'store.h5')
+    _add_samples(chain_fname, range(1, 4))
+    # Sample 4 is still being written
+    _add_samples(chain_fname, [4], skip=['tod/030/gain'])
+    _add_samples(chain_fname, [5])
+    assert chain_utils.update_columnar(chain_fname, store_fname,
+                                       datasets='tod/*') == 3
+    with h5py.File(chain_fname, 'a') as chain:
+        chain['000004'].create_dataset(
+            'tod/030/gain', data=_sample_values(4)['tod/030/gain'])
+    assert chain_utils.update_columnar(chain_fname, store_fname,
+                                       datasets='tod/*') == 2
+    samples, values = chain_utils.read_columnar(store_fname, 'tod/030/gain')
+    np.testing.assert_array_equal(samples, range(1, 6))
+    np.testing.assert_array_equal(values, _stack('tod/030/gain',
+                                                 range(1, 6)))
+
+
+def test_update_columnar_truncates_interrupted_update(tmp_path):
+    chain_fname = str(tmp_path / 'chain_c0001.h5')
+    store_fname = str(tmp_path / 'store.h5')
+    _add_samples(chain_fname, range(1, 4))
+    chain_utils.update_columnar(chain_fname, store_fname)
+    # An update that wrote some datasets but not the sample numbers
+    with h5py.File(store_fname, 'a') as store:
+        for path in ('tod/030/gain', 'chisq'):
+            dset = store[path]
+            dset.resize(len(dset) + 2, axis=0)
+            dset[-2:] = -1
+    _add_samples(chain_fname, range(4, 6))
+    assert chain_utils.update_columnar(chain_fname, store_fname) == 2
+    for path in ('tod/030/gain', 'tod/030/accept', 'chisq'):
+        samples, values = chain_utils.read_columnar(store_fname, path)
+        np.testing.assert_array_equal(samples, range(1, 6))
+        np.testing.assert_array_equal(values, _stack(path, range(1, 6)))
+
+
+def test_update_columnar_dataset_errors(tmp_path):
+    chain_fname = str(tmp_path / 'chain_c0001.h5')
+    store_fname = str(tmp_path / 'store.h5')
+    _add_samples(chain_fname, range(1, 3))
+    with pytest.raises(ValueError):
+        chain_utils.update_columnar(chain_fname, store_fname,
+                                    datasets='nothing/*')
+    chain_utils.update_columnar(chain_fname, str(tmp_path / 'gain.h5'),
+                                datasets='tod/*/gain')
+    with pytest.raises(ValueError):
+        chain_utils.update_columnar(chain_fname, str(tmp_path / 'gain.h5'),
+                                    datasets='tod/*')
+    assert chain_utils.update_columnar(
+        chain_fname, str(tmp_path / 'gain.h5'),
+        datasets=['tod/030/gain']) == 0
+
+
+@pytest.mark.parametrize('samples, expected', [
+    (None, [1, 2, 3, 4, 5, 6]),
+    ([2, 3, 4], [2, 3, 4]),
+    (range(2, 5), [2, 3, 4]),
+    ([1, 4, 6, 99], [1, 4, 6]),
+    ([99], [])])
+def test_read_columnar(tmp_path, samples, expected):
+    chain_fname = str(tmp_path / 'chain_c0001.h5')
+    store_fname = str(tmp_path / 'store.h5')
+    _add_samples(chain_fname, range(1, 7))
+    chain_utils.update_columnar(chain_fname, store_fname, chunk_samples=4)
+    numbers, values = chain_utils.read_columnar(store_fname, 'tod/030/gain',
+                                                index=1, samples=samples)
+    np.testing.assert_array_equal(numbers, expected)
+    assert values.shape == (len(expected), NPID)
+    if expected:
+        np.testing.assert_array_equal(
+            values, _stack('tod/030/gain', expected)[:, 1])
+    numbers, values = chain_utils.read_columnar(
+        store_fname, 'tod/030/gain', index=(slice(None), 3),
+        samples=samples)
+    assert values.shape == (len(expected), NDET)
+    if expected:
+        np.testing.assert_array_equal(
+            values, _stack('tod/030/gain', expected)[:, :, 3])
+
+
+INIT_GROUPS = ['ame', 'bandpass', 'cmb', 'dust', 'ff', 'gain', 'md',
+               'synch', 'tod']
+
+
+def _write_init_chain(fname, numbers, seed=0):
+    rng = np.random.default_rng(seed)
+    with h5py.File(fname, 'w') as chain:
+        for number in numbers:
+            sample = chain.create_group('{:06d}'.format(number))
+            sample.create_dataset('chisq', data=float(number))
+            for name in INIT_GROUPS:
+                group = sample.create_group(name)
+                group.attrs['component'] = name
+                group.create_dataset('amp', data=rng.normal(size=(4, 6)),
+                                     chunks=(2, 6))
+                group.create_dataset('nu_ref', data=rng.normal())
+            sample['tod'].create_dataset('030/gain',
+                                         data=rng.normal(size=(NDET, NPID)))
+            sample['tod/030'].attrs['band'] = 30
+            sample['tod'].create_dataset(
+                'labels', data=['a', 'bc'], dtype=h5py.string_dtype())
+
+
+def _contents(group):
+    "Paths, attributes and data of everything below an HDF5 group."
+    res = {}
+
+    def visit(name, obj):
+        attrs = dict(obj.attrs)
+        if isinstance(obj, h5py.Dataset):
+            res[name] = (attrs, obj[()].tolist() if obj.shape else obj[()])
+        else:
+            res[name] = (attrs, None)
+
+    group.visititems(visit)
+    return res
+
+
+@pytest.mark.parametrize('iterations, thinning, expected', [
+    (None, 1, [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]),
+    (3, 1, [3]),
+    (-1, 1, [10]),
+    ([-3, 2, 2], 1, [2, 8]),
+    (range(4, 7), 1, [4, 5, 6]),
+    ([(8, 100), (0, 2)], 1, [1, 8, 9, 10]),
+    (slice(-4, None), 1, [7, 8, 9, 10]),
+    (slice(None, None, 3), 1, [1, 4, 7, 10]),
+    (None, 3, [1, 4, 7, 10]),
+    (range(1, 11, 4), 1, [1, 5, 9]),
+    (slice(2, 8), 4, [4, 8])])
+def test_select_samples(iterations, thinning, expected):
+    numbers = list(range(1, 11))
+    assert chain_utils.select_samples(numbers, iterations,
+                                      thinning) == expected
+
+
+@pytest.mark.parametrize('iterations', [11, [0], -11])
+def test_select_samples_errors(iterations):
+    with pytest.raises(ValueError):
+        chain_utils.select_samples(range(1, 11), iterations)
+
+
+@pytest.mark.parametrize('virtual, num_processes', [
+    (True, None), (False, 1), (False, 3)])
+def test_slice_chains(tmp_path, virtual, num_processes):
+    chain_fnames = [str(tmp_path / 'chain_c{:04d}.h5'.format(chain))
+                    for chain in (1, 2)]
+    _write_init_chain(chain_fnames[0], range(1, 6), seed=1)
+    _write_init_chain(chain_fnames[1], range(1, 4), seed=2)
+    out_fname = str(tmp_path / 'out.h5')
+    plan = chain_utils.slice_chains(
+        chain_fnames, out_fname, iterations=[slice(-2, None)],
+        groups=['cmb', 'tod/*/gain', 'tod/labels'], virtual=virtual,
+        num_processes=num_processes)
+    assert plan == [(chain_fnames[0], 4, '000000'),
+                    (chain_fnames[0], 5, '000001'),
+                    (chain_fnames[1], 2, '000002'),
+                    (chain_fnames[1], 3, '000003')]
+    with h5py.File(out_fname, 'r') as out:
+        assert sorted(out) == ['000000', '000001', '000002', '000003']
+        for fname, number, target in plan:
+            group = out[target]
+            assert group.attrs['chain'] == fname
+            assert group.attrs['sample'] == number
+            with h5py.File(fname, 'r') as chain:
+                source = chain['{:06d}'.format(number)]
+                expected = _contents(source)
+                expected = dict(
+                    (name, value) for name, value in expected.items()
+                    if name.split('/')[0] == 'cmb' or name in (
+                        'tod', 'tod/030', 'tod/030/gain', 'tod/labels'))
+                # Parent groups of matched datasets are created empty
+                expected['tod'] = ({}, None)
+                expected['tod/030'] = ({}, None)
+                assert _contents(group) == expected
+            assert group['cmb/amp'].is_virtual == virtual
+            if not virtual:
+                assert group['cmb/amp'].compression == 'gzip'
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        'chain_c0001.h5', 'chain_c0002.h5', 'out.h5']
+
+
+def test_slice_chains_flat(tmp_path):
+    chain_fname = str(tmp_path / 'chain_c0001.h5')
+    _write_init_chain(chain_fname, range(1, 4))
+    out_fname = str(tmp_path / 'out.h5')
+    with pytest.raises(ValueError):
+        chain_utils.slice_chains(chain_fname, out_fname, flat=True)
+    plan = chain_utils.slice_chains(chain_fname, out_fname, iterations=-1,
+                                    flat=True, num_processes=1)
+    assert plan == [(chain_fname, 3, '/')]
+    with h5py.File(out_fname, 'r') as out, \
+            h5py.File(chain_fname, 'r') as chain:
+        assert _contents(out) == _contents(chain['000003'])
+        assert 'chain' not in out.attrs
+
+
+@pytest.mark.parametrize('virtual, num_processes', [
+    (True, None), (False, 1), (False, 2)])
+def test_slice_chains_pattern_matches_nothing(tmp_path, virtual,
+                                              num_processes):
+    chain_fnames = [str(tmp_path / 'chain_c{:04d}.h5'.format(chain))
+                    for chain in (1, 2)]
+    for chain_fname in chain_fnames:
+        _write_init_chain(chain_fname, range(1, 4))
+    with pytest.raises(ValueError, match='No'):
+        chain_utils.slice_chains(chain_fnames, str(tmp_path / 'out.h5'),
+                                 groups=['cmb', 'nothing'], virtual=virtual,
+                                 num_processes=num_processes)
+    # Neither temporary files nor a partial output are left behind
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        'chain_c0001.h5', 'chain_c0002.h5']
+
+
+def _old_extract(filename, iteration, outfilename):
+    "The nine copies extract_chain.extract used to make."
+    f = h5py.File(filename, 'r')
+    iteration = '{:06d}'.format(iteration)
+    outfile = h5py.File(outfilename, 'w')
+    for name in INIT_GROUPS:
+        f.copy(iteration + '/' + name, outfile['/'])
+    outfile.close()
+    f.close()
+
+
+def test_extract_chain(tmp_path):
+    extract_chain = pytest.importorskip('scripts.extract_chain')
+    chain_fname = str(tmp_path / 'chain_c0001.h5')
+    _write_init_chain(chain_fname, range(1, 4))
+    _old_extract(chain_fname, 2, str(tmp_path / 'old.h5'))
+    extract_chain.extract(chain_fname, 2, str(tmp_path / 'new.h5'))
+    with h5py.File(str(tmp_path / 'old.h5'), 'r') as old, \
+            h5py.File(str(tmp_path / 'new.h5'), 'r') as new:
+        assert sorted(new) == INIT_GROUPS
+        assert dict(new.attrs) == dict(old.attrs)
+        assert _contents(new) == _contents(old)
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('camb')
+
+from calculation import camb_grid, cl_emulator
+
+
+def _run_points(base_param_file, points, cache_dir, num_processes=None):
+    # Smooth spectra in l and tau, with BB identically zero as for r = 0
+    ells = np.arange(101.)
+    results = []
+    for point in points:
+        tau = point['Reion.optical_depth']
+        tt = 1000. * np.exp(-ells / 50.)
+        ee = 0.05 + 1e3 * tau ** 2 * np.exp(-ells / 5.)
+        te = 0.3 * np.sqrt(tt * ee)
+        cls = np.column_stack([ells, tt, ee, np.zeros_like(ells), te])
+        cls[:2, 1:] = 0.
+        results.append((point, cls))
+    return results
+
+
+@pytest.fixture
+def emulator(monkeypatch, tmp_path):
+    monkeypatch.setattr(camb_grid, 'run_points', _run_points)
+    return cl_emulator.ClEmulator('params.ini',
+                                  {'Reion.optical_depth': (0.03, 0.08)}, 8,
+                                  str(tmp_path))
+
+
+def test_emulator_reproduces_nodes(emulator):
+    nodes = cl_emulator.chebyshev_nodes(0.03, 0.08, 8)
+    points = [{'Reion.optical_depth': tau} for tau in nodes]
+    expected = np.array([cls for _, cls in _run_points(None, points, None)])
+    np.testing.assert_allclose(emulator.evaluate(points), expected,
+                               rtol=1e-8, atol=1e-10)
+    np.testing.assert_allclose(emulator(points[0]), expected[0], rtol=1e-8,
+                               atol=1e-10)
+
+
+def test_validate_zero_spectrum(emulator):
+    report = emulator.validate(num_points=4)
+    for spec in ('TT', 'EE', 'TE'):
+        assert 0 <= report[spec]['max_rel'] < 1e-3
+        assert np.isfinite(report[spec]['max_cv'])
+    assert report['BB']['max_rel'] is None
+    assert report['BB']['max_cv'] is None
+    assert report['BB']['max_abs'] < 1e-8
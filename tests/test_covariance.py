@@ -0,0 +1,122 @@
+import os
+import subprocess
+import sys
+
+import healpy
+import numpy as np
+import pytest
+import scipy.linalg
+
+from calculation import covariance
+from utils import file_utils
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _covmat(n, seed=0):
+    rng = np.random.default_rng(seed)
+    mat = rng.normal(size=(n, n))
+    return np.dot(mat, mat.T) + n * np.eye(n)
+
+
+def _write_map2mask(fname, nside, nobs, seed=0):
+    rng = np.random.default_rng(seed)
+    pixels = np.sort(rng.choice(12 * nside ** 2, nobs, replace=False))
+    map2mask = np.full(12 * nside ** 2, -1.)
+    map2mask[pixels] = np.arange(1, nobs + 1)
+    healpy.write_map(fname, map2mask, dtype=np.float64, overwrite=True)
+    return pixels
+
+
+@pytest.mark.parametrize('method', ['cholesky', 'lu', 'eigen'])
+def test_invert(method):
+    mat = _covmat(40)
+    inverse = covariance.invert(mat, method=method, block_rows=7)
+    np.testing.assert_allclose(np.dot(inverse, mat), np.eye(40), atol=1e-10)
+    np.testing.assert_array_equal(mat, _covmat(40))
+
+
+def test_matrix_power():
+    mat = _covmat(30)
+    root = covariance.sqrt(mat)
+    np.testing.assert_allclose(np.dot(root, root), mat, rtol=1e-10)
+    inv_root = covariance.inverse_sqrt(mat)
+    np.testing.assert_allclose(np.dot(inv_root, root), np.eye(30),
+                               atol=1e-10)
+
+
+def test_invert_out_of_core(tmp_path):
+    n = 50
+    mat = _covmat(n)
+    fname = str(tmp_path / 'cov.unf')
+    file_utils.write_covmat(fname, mat, 'ring', 1)
+    covmat = file_utils.read_covmat(fname, mmap=True)
+    # A budget of a few rows forces several panels
+    out_fname = str(tmp_path / 'inv.unf')
+    covariance.invert_out_of_core(covmat['data'], out_fname, 'ring', 1,
+                                  memory_budget=8 * n * 12, num_threads=2)
+    inverse = file_utils.read_covmat(out_fname)
+    np.testing.assert_allclose(inverse['data'], np.linalg.inv(mat),
+                               rtol=1e-8, atol=1e-12)
+    assert not os.path.exists(out_fname + '.factor.npy')
+
+
+
+@pytest.mark.parametrize('rows', [1, 7, 50])
+def test_cholesky_solve(tmp_path, rows):
+    n = 50
+    mat = _covmat(n)
+    factor = scipy.linalg.cholesky(mat)
+    rng = np.random.default_rng(3)
+    vector = rng.normal(size=n)
+    block = rng.normal(size=(n, 4))
+    # Leading zero rows skip part of the forward pass
+    block[:23] = 0
+    # Panels of 'rows' rows; 7 does not divide n
+    budget = 8 * n * rows
+    for rhs in (vector, block, rng.normal(size=(n, 1)), np.zeros(n)):
+        res = covariance.cholesky_solve(factor, rhs, memory_budget=budget)
+        assert res.shape == rhs.shape
+        np.testing.assert_allclose(res,
+                                   scipy.linalg.cho_solve((factor, False),
+                                                          rhs),
+                                   rtol=1e-10, atol=1e-14)
+    np.testing.assert_array_equal(block[:23], 0)
+
+    # The factor of cholesky_out_of_core, read back memory-mapped
+    factor_fname = str(tmp_path / 'factor.npy')
+    covariance.cholesky_out_of_core(mat, factor_fname, memory_budget=budget,
+                                    num_threads=2)
+    mapped = np.load(factor_fname, mmap_mode='r')
+    np.testing.assert_allclose(
+        covariance.cholesky_solve(mapped, block, memory_budget=budget),
+        scipy.linalg.cho_solve((factor, False), block), rtol=1e-10,
+        atol=1e-14)
+
+def test_diagonal_matrix_suite_native(tmp_path):
+    nside, nobs = 4, 20
+    pixels = _write_map2mask(str(tmp_path / 'map2mask.fits'), nside, nobs)
+    mat = _covmat(3 * nobs)
+    file_utils.write_covmat(str(tmp_path / 'cov_30.unf'), mat, 'ring', 3)
+    command = [sys.executable,
+               os.path.join(REPO_DIR, 'scripts',
+                            'create_diagonal_matrix_suite.py'),
+               str(tmp_path) + '/', 'map2mask.fits', '--input_prefix', 'cov_',
+               '--variational_argument', '30', '--output_midfix', 'test']
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    # The second run overwrites the outputs of the first
+    for _ in range(2):
+        subprocess.check_call(command, env=env)
+
+    prefix = str(tmp_path / 'diagonal_covmat_{}_test_30_.{}')
+    diag = np.diag(mat)
+    for name, expected in [('N', diag), ('invN', 1 / diag),
+                           ('sqrt_invN', 1 / np.sqrt(diag))]:
+        covmat = file_utils.read_covmat(prefix.format(name, 'unf'))
+        np.testing.assert_allclose(covmat['data'], np.diag(expected))
+        assert covmat['polarization'] == 3
+    rms = healpy.read_map(prefix.format('rms', 'fits'), field=None)
+    for comp in range(3):
+        np.testing.assert_allclose(rms[comp, pixels],
+                                   np.sqrt(diag[comp * nobs:(comp + 1) * nobs]))
+    assert np.all(np.delete(rms, pixels, axis=1) == healpy.UNSEEN)
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+from calculation import covariance
+from utils import file_utils
+
+
+def _blocks(nobs, ncomp, diagonal=False, seed=0):
+    rng = np.random.default_rng(seed)
+    if diagonal:
+        blocks = np.zeros((nobs, ncomp, ncomp))
+        comps = np.arange(ncomp)
+        blocks[:, comps, comps] = rng.uniform(0.5, 2, size=(nobs, ncomp))
+        return blocks
+    mat = rng.normal(size=(nobs, ncomp, ncomp))
+    return np.matmul(mat, mat.transpose(0, 2, 1)) + ncomp * np.eye(ncomp)
+
+
+def _dense(blocks):
+    "All pixels of one component before the next, coupled within a pixel."
+    nobs, ncomp, _ = blocks.shape
+    mat = np.zeros((nobs * ncomp, nobs * ncomp))
+    for pixel in range(nobs):
+        for i in range(ncomp):
+            for j in range(ncomp):
+                mat[i * nobs + pixel, j * nobs + pixel] = blocks[pixel, i, j]
+    return mat
+
+
+CASES = [(7, 1, False), (9, 3, False), (9, 3, True), (5, 2, False)]
+
+
+@pytest.mark.parametrize('nobs,ncomp,diagonal', CASES)
+def test_block_diagonal_matches_dense(nobs, ncomp, diagonal):
+    blocks = _blocks(nobs, ncomp, diagonal)
+    cov = file_utils.BlockDiagonalCovariance(blocks, 'ring', 1)
+    mat = _dense(blocks)
+    np.testing.assert_array_equal(cov.to_dense(), mat)
+    assert cov.n == nobs * ncomp
+    assert cov.is_diagonal() == (diagonal or ncomp == 1)
+    np.testing.assert_array_equal(cov.diag, np.diag(mat))
+    np.testing.assert_allclose(cov.rms(),
+                               np.sqrt(np.diag(mat)).reshape(ncomp, nobs))
+
+    np.testing.assert_allclose(cov.inverse().to_dense(),
+                               covariance.invert(mat), rtol=1e-10,
+                               atol=1e-12)
+    np.testing.assert_allclose(cov.sqrt().to_dense(), covariance.sqrt(mat),
+                               rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(cov.inverse_sqrt().to_dense(),
+                               covariance.inverse_sqrt(mat), rtol=1e-10,
+                               atol=1e-12)
+    for power in (2, -1, 1.5):
+        np.testing.assert_allclose(cov.power(power).to_dense(),
+                                   covariance.matrix_power(mat, power),
+                                   rtol=1e-10, atol=1e-12)
+    assert cov.sqrt().ordering == 'ring'
+    assert cov.sqrt().polarization == 1
+
+
+def test_block_diagonal_negative_eigenvalues():
+    blocks = _blocks(4, 2)
+    blocks[1] *= -1
+    cov = file_utils.BlockDiagonalCovariance(blocks, 'ring', 1)
+    with pytest.raises(np.linalg.LinAlgError):
+        cov.sqrt()
+    np.testing.assert_allclose(cov.power(2).to_dense(),
+                               np.linalg.matrix_power(_dense(blocks), 2),
+                               rtol=1e-12)
+    diag = file_utils.BlockDiagonalCovariance.from_diagonal(
+        [1., -1., 2.], 'ring', 1)
+    with pytest.raises(np.linalg.LinAlgError):
+        diag.inverse_sqrt()
+
+
+@pytest.mark.parametrize('nobs,ncomp,diagonal', CASES)
+def test_block_diagonal_files(tmp_path, nobs, ncomp, diagonal):
+    cov = file_utils.BlockDiagonalCovariance(_blocks(nobs, ncomp, diagonal),
+                                             'nest', 3)
+    npz_fname = str(tmp_path / 'cov.npz')
+    cov.save(npz_fname)
+    loaded = file_utils.BlockDiagonalCovariance.load(npz_fname)
+    np.testing.assert_array_equal(loaded.blocks, cov.blocks)
+    assert loaded.ordering == 'nest'
+    assert loaded.polarization == 3
+
+    fname = str(tmp_path / 'cov.dat')
+    dense_fname = str(tmp_path / 'dense.dat')
+    cov.write_covmat(fname, block_rows=4)
+    file_utils.write_covmat(dense_fname, cov.to_dense(), 'nest', 3)
+    with open(fname, 'rb') as f, open(dense_fname, 'rb') as g:
+        assert f.read() == g.read()
+
+    for mmap in (False, True):
+        covmat = file_utils.read_covmat(fname, mmap=mmap)
+        read = file_utils.BlockDiagonalCovariance.from_covmat(covmat, ncomp)
+        np.testing.assert_array_equal(read.blocks, cov.blocks)
+        assert read.ordering == 'nest'
+    diag = file_utils.BlockDiagonalCovariance.from_covmat(covmat, ncomp,
+                                                          diagonal=True)
+    np.testing.assert_array_equal(diag.to_dense(), np.diag(cov.diag))
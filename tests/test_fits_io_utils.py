@@ -0,0 +1,220 @@
+import astropy.io.fits as pf
+import healpy
+import numpy as np
+import pytest
+
+from utils import fits_io_utils, map_utils
+
+
+def _fullmap(nside=2, column_units=None):
+    npix = 12 * nside ** 2
+    data = [np.arange(npix, dtype=np.float64),
+            np.arange(npix, dtype=np.float64) * 2]
+    kwargs = {}
+    if column_units is None:
+        column_units = ['', '']
+        kwargs['column_properties'] = {'signal_i': [0], 'signal_q': [1],
+                                       'unitless': [0, 1]}
+    else:
+        kwargs['column_properties'] = {'signal_i': [0], 'signal_q': [1]}
+    return map_utils.bundle_fullmap(data, ordering='ring',
+                                    column_units=column_units,
+                                    column_names=['I_STOKES', 'Q_STOKES'],
+                                    comments=['A comment'], **kwargs)
+
+
+def _column_keys(fname):
+    header = pf.getheader(fname, 1)
+    return [key for key in header.keys()
+            if key[:5] in ('TTYPE', 'TFORM', 'TUNIT')]
+
+
+def test_write_planck_fullmap_overwrites(tmp_path):
+    fname = str(tmp_path / 'map.fits')
+    fmap = _fullmap()
+    fits_io_utils.write_planck_fullmap(fname, fmap)
+    fmap['data'] = [col + 1 for col in fmap['data']]
+    fits_io_utils.write_planck_fullmap(fname, fmap)
+    np.testing.assert_array_equal(healpy.read_map(fname, field=1),
+                                  fmap['data'][1])
+    header = pf.getheader(fname, 1)
+    assert header['NSIDE'] == 2
+    assert header['ORDERING'] == 'RING'
+    assert 'A comment' in str(header['COMMENT'])
+
+
+def test_write_planck_fullmap_groups_column_cards(tmp_path):
+    fname = str(tmp_path / 'map.fits')
+    fits_io_utils.write_planck_fullmap(fname, _fullmap())
+    assert _column_keys(fname) == ['TTYPE1', 'TFORM1', 'TUNIT1',
+                                   'TTYPE2', 'TFORM2', 'TUNIT2']
+    chunked_fname = str(tmp_path / 'chunked.fits')
+    fits_io_utils.write_planck_fullmap_chunked(chunked_fname, _fullmap(),
+                                               chunk_size=10)
+    assert _column_keys(chunked_fname) == _column_keys(fname)
+    np.testing.assert_array_equal(pf.getdata(chunked_fname, 1)['Q_STOKES'],
+                                  pf.getdata(fname, 1)['Q_STOKES'])
+
+
+def test_write_planck_fullmap_units(tmp_path):
+    fname = str(tmp_path / 'map.fits')
+    fits_io_utils.write_planck_fullmap(fname,
+                                       _fullmap(column_units=['ukcmb', 'kcmb']))
+    header = pf.getheader(fname, 1)
+    assert header['TUNIT1'] == 'uK_CMB'
+    assert header['TUNIT2'] == 'K_CMB'
+    assert _column_keys(fname)[2] == 'TUNIT1'
+
+
+def test_read_planck_fullmap_lazy(tmp_path):
+    fname = str(tmp_path / 'map.fits')
+    fmap = _fullmap(column_units=['ukcmb', 'ukcmb'])
+    fits_io_utils.write_planck_fullmap(fname, fmap)
+    eager = fits_io_utils.read_planck_fullmap(fname, None, field=1,
+                                              verbose=False)
+    lazy = fits_io_utils.read_planck_fullmap(fname, None, field=1,
+                                             verbose=False, lazy=True)
+    assert isinstance(lazy['data'], fits_io_utils.LazyMapColumns)
+    assert not lazy['data'].is_decoded(0)
+    np.testing.assert_array_equal(lazy['data'].read_block(0, 3, 9),
+                                  fmap['data'][1][3:9])
+    np.testing.assert_array_equal(lazy['data'][0], eager['data'][0])
+    assert lazy['data'].is_decoded(0)
+    assert lazy['column_properties'] == {'signal_q': [0]}
+    assert lazy['column_units'] == ['ukcmb']
+    assert lazy['column_names'] == ['Q_STOKES']
+
+    nested = fits_io_utils.read_planck_fullmap(fname, None, field=None,
+                                               nest=True, verbose=False,
+                                               lazy=True)
+    np.testing.assert_array_equal(
+        nested['data'][1], healpy.reorder(fmap['data'][1], r2n=True))
+    assert nested['ordering'] == 'nested'
+
+
+def test_read_planck_fullmap_reorders_all_columns(tmp_path):
+    fname = str(tmp_path / 'map.fits')
+    fmap = _fullmap(nside=4)
+    fits_io_utils.write_planck_fullmap(fname, fmap)
+    nested = fits_io_utils.read_planck_fullmap(fname, None, field=None,
+                                               nest=True, verbose=False)
+    assert nested['ordering'] == 'nested'
+    for i in range(2):
+        np.testing.assert_array_equal(
+            nested['data'][i], healpy.read_map(fname, field=i, nest=True))
+
+    nested_fname = str(tmp_path / 'nested.fits')
+    fits_io_utils.write_planck_fullmap(nested_fname, nested)
+    ring = fits_io_utils.read_planck_fullmap(nested_fname, None,
+                                             field=[1, 0], verbose=False)
+    assert ring['ordering'] == 'ring'
+    np.testing.assert_array_equal(ring['data'], fmap['data'][::-1])
+    kept = fits_io_utils.read_planck_fullmap(nested_fname, None, field=None,
+                                             nest=None, verbose=False)
+    assert kept['ordering'] == 'nested'
+    np.testing.assert_array_equal(kept['data'], nested['data'])
+
+
+def test_read_planck_fullmap_array(tmp_path):
+    fname = str(tmp_path / 'map.fits')
+    fmap = _fullmap(nside=4)
+    fits_io_utils.write_planck_fullmap(fname, fmap)
+    eager = fits_io_utils.read_planck_fullmap(fname, None, field=None,
+                                              nest=True, verbose=False)
+    marr = fits_io_utils.read_planck_fullmap(fname, None, field=None,
+                                             nest=True, verbose=False,
+                                             array=True)
+    assert isinstance(marr, map_utils.MapArray)
+    assert marr.data.shape == (2, 12 * 4 ** 2)
+    np.testing.assert_array_equal(marr.data, eager['data'])
+    assert marr.ordering == 'nested'
+    assert marr.column_properties == eager['column_properties']
+    assert marr.column_names == eager['column_names']
+    q = marr.select_property('signal_q')
+    np.testing.assert_array_equal(q[0], eager['data'][1])
+    assert np.shares_memory(q[0], marr.data)
+
+    ring = fits_io_utils.read_planck_fullmap(fname, None, field=[1, 0],
+                                             verbose=False, array=True)
+    np.testing.assert_array_equal(ring.data, fmap['data'][::-1])
+    eager_ring = fits_io_utils.read_planck_fullmap(fname, None, field=[1, 0],
+                                                   verbose=False)
+    assert ring.to_fullmap()['column_names'] == eager_ring['column_names']
+    try:
+        fits_io_utils.read_planck_fullmap(fname, None, lazy=True, array=True)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('lazy and array should not be combined')
+
+
+def _healpy_file(tmp_path, nest, nside=16):
+    "Two columns of different types, written with repeat counts (1024E)."
+    rng = np.random.default_rng(5)
+    maps = [rng.normal(size=12 * nside ** 2) for _ in range(3)]
+    maps[1][::17] = healpy.UNSEEN
+    fname = str(tmp_path / ('nested.fits' if nest else 'ring.fits'))
+    healpy.write_map(fname, maps, nest=nest,
+                     dtype=[np.float32, np.float64, np.float32])
+    return fname
+
+
+def _pixel_subsets(npix):
+    rng = np.random.default_rng(6)
+    pixels = rng.choice(npix, 200, replace=False)
+    # Unsorted, repeated and edge pixels
+    pixels = np.concatenate([pixels, pixels[:5], [0, npix - 1]])
+    ranges = [(0, 3), (1020, 1030), (npix - 7, npix)]
+    expected = np.concatenate([pixels] + [np.arange(*r) for r in ranges])
+    return pixels, ranges, expected
+
+
+@pytest.mark.parametrize('file_nest', [False, True])
+@pytest.mark.parametrize('nest', [False, True, None])
+def test_read_planck_pixels_matches_healpy(tmp_path, file_nest, nest):
+    fname = _healpy_file(tmp_path, file_nest)
+    assert pf.getheader(fname, 1)['TFORM1'] == '1024E'
+    npix = 12 * 16 ** 2
+    pixels, ranges, all_pixels = _pixel_subsets(npix)
+    read_nest = file_nest if nest is None else nest
+    full = [healpy.read_map(fname, field=ff, nest=read_nest,
+                            dtype=np.float64) for ff in range(3)]
+
+    single = fits_io_utils.read_planck_pixels(fname, pixels=pixels, field=1,
+                                              nest=nest)
+    assert single.shape == (len(pixels),)
+    np.testing.assert_array_equal(single, full[1][pixels])
+
+    ranged = fits_io_utils.read_planck_pixels(fname, pixel_ranges=ranges,
+                                              field=0, nest=nest)
+    np.testing.assert_array_equal(ranged, full[0][all_pixels[len(pixels):]])
+
+    multi = fits_io_utils.read_planck_pixels(fname, pixels=pixels,
+                                             pixel_ranges=ranges,
+                                             field=[2, 0], nest=nest)
+    assert multi.shape == (2, len(all_pixels))
+    np.testing.assert_array_equal(multi[0], full[2][all_pixels])
+    np.testing.assert_array_equal(multi[1], full[0][all_pixels])
+
+    every = fits_io_utils.read_planck_pixels(fname, pixel_ranges=[(0, npix)],
+                                             field=None, nest=nest,
+                                             dtype=np.float32)
+    assert every.dtype == np.float32
+    np.testing.assert_array_equal(every, np.array(full, dtype=np.float32))
+
+
+def test_read_planck_pixels_single_element_rows(tmp_path):
+    fname = str(tmp_path / 'map.fits')
+    fmap = _fullmap(nside=4)
+    fits_io_utils.write_planck_fullmap(fname, fmap)
+    pixels = [5, 191, 0, 5]
+    np.testing.assert_array_equal(
+        fits_io_utils.read_planck_pixels(fname, pixels=pixels, field=[0, 1]),
+        np.array(fmap['data'])[:, pixels])
+    np.testing.assert_array_equal(
+        fits_io_utils.read_planck_pixels(fname, pixels=pixels, field=1,
+                                         nest=True),
+        healpy.read_map(fname, field=1, nest=True)[pixels])
+    for kwargs in ({}, {'pixels': [192]}, {'pixel_ranges': [(-1, 2)]}):
+        with pytest.raises(ValueError):
+            fits_io_utils.read_planck_pixels(fname, **kwargs)
@@ -0,0 +1,155 @@
+import copy
+import pickle
+
+import pytest
+
+from utils import backend_defaults, fits_utils
+
+CARDS = [('NSIDE', 4, ''), ('ORDERING', 'RING', ''), ('TFIELDS', 3, ''),
+         ('TTYPE1', 'I_STOKES', ''), ('TFORM1', 'D', ''),
+         ('TUNIT1', 'uK_CMB', ''),
+         ('TTYPE2', 'Q_STOKES', ''), ('TFORM2', 'D', ''),
+         ('TUNIT2', 'uK_CMB', ''),
+         ('TTYPE3', 'QQ_COV', ''), ('TFORM3', 'E', ''),
+         ('TUNIT3', '(uK_CMB)^2', ''),
+         ('COMMENT', 'First', ''), ('COMMENT', 'Second', '')]
+
+
+def _check_index(header):
+    assert header.positions['TFIELDS'] == [2]
+    assert header.positions['COMMENT'] == [12, 13]
+    assert header.column_types == ['I_STOKES', 'Q_STOKES', 'QQ_COV']
+    assert header.column_units == ['uK_CMB', 'uK_CMB', '(uK_CMB)^2']
+    fits_utils.replace_hdu_header_value(header, 'TFIELDS', 3)
+    assert header.get_value('NSIDE') == 4
+
+
+def test_indexed_header_index():
+    header = fits_utils.IndexedHeader(CARDS)
+    assert list(header) == CARDS
+    _check_index(header)
+    header.append(('EXTNAME', 'xtension', ''))
+    assert header.get_value('EXTNAME') == 'xtension'
+    del header[0]
+    assert header.get_value('NSIDE', default_value=None) is None
+    assert header.positions['TFIELDS'] == [1]
+
+
+@pytest.mark.parametrize('copier', [
+    copy.copy, copy.deepcopy,
+    lambda header: pickle.loads(pickle.dumps(header))])
+def test_indexed_header_copies(copier):
+    header = fits_utils.IndexedHeader(CARDS)
+    copied = copier(header)
+    assert isinstance(copied, fits_utils.IndexedHeader)
+    assert list(copied) == CARDS
+    _check_index(copied)
+    copied.append(('EXTNAME', 'xtension', ''))
+    assert 'EXTNAME' not in header.positions
+
+
+def test_resolve_hdu_column_properties():
+    props = fits_utils.resolve_hdu_column_properties(CARDS, None)
+    assert props == {'signal_i': [0], 'signal_q': [1],
+                     'covariance_qq': [2], 'squared': [2]}
+    props = fits_utils.resolve_hdu_column_properties(CARDS, None,
+                                                     column_filter=[1, 2])
+    assert props == {'signal_q': [0], 'covariance_qq': [1], 'squared': [1]}
+    assert fits_utils.resolve_hdu_column_units(CARDS, None) == [
+        'ukcmb', 'ukcmb', 'ukcmb^2']
+    assert fits_utils.extract_hdu_column_types(CARDS, [0]) == ['I_STOKES']
+
+
+def test_resolve_hdu_column_properties_unresolvable():
+    cards = [('TFIELDS', 1, ''), ('TTYPE1', 'SOMETHING', ''),
+             ('TFORM1', 'D', '')]
+    with pytest.raises(ValueError):
+        fits_utils.resolve_hdu_column_properties(cards, None)
+
+
+def test_resolve_hdulist_column_properties():
+    headers = [[('EXTNAME', 'I_STOKES', ''), ('UNITS', 'K_CMB', '')],
+               [('EXTNAME', 'HITS', ''), ('UNITS', '', '')]]
+    assert fits_utils.resolve_hdulist_column_properties(headers, None) == {
+        'signal_i': [0], 'hits': [1], 'unitless': [1]}
+    assert fits_utils.resolve_hdulist_column_units(headers, None) == [
+        'kcmb', '']
+    assert fits_utils.extract_hdulist_column_types(headers) == [
+        'I_STOKES', 'HITS']
+
+
+def test_backend_units_round_trip():
+    fmap = {'column_units': ['ukcmb', 'kcmb^2', 'mjysr', ''],
+            'column_properties': {'squared': [1], 'unitless': [3]}}
+    fits_units = fits_utils.get_fits_ready_units(fmap)
+    assert [backend_defaults.get_backend_unit(unit) for unit in fits_units] \
+        == fmap['column_units']
+    assert backend_defaults.get_backend_unit('K', {'K': 'kcmb'}) == 'kcmb'
+
+
+def _assert_fresh_index(header):
+    fresh = fits_utils.IndexedHeader(list(header))
+    assert header.positions == fresh.positions
+    assert header.column_types == fresh.column_types
+    assert header.column_units == fresh.column_units
+    assert header.column_formats == fresh.column_formats
+
+
+@pytest.mark.parametrize('modify', [
+    lambda header: header.reverse(),
+    lambda header: header.sort(),
+    lambda header: header.sort(key=lambda card: str(card[1]), reverse=True),
+    lambda header: header.clear(),
+    lambda header: header.__imul__(2),
+    lambda header: header.insert(1, ('TTYPE4', 'U_STOKES', '')),
+    lambda header: header.pop(3),
+    lambda header: header.remove(CARDS[4])])
+def test_indexed_header_list_methods(modify):
+    header = fits_utils.IndexedHeader([tuple(card) for card in CARDS])
+    modify(header)
+    _assert_fresh_index(header)
+
+
+def test_indexed_header_reverse_and_clear():
+    header = fits_utils.IndexedHeader([['TTYPE1', 'I', ''],
+                                       ['NSIDE', 16, '']])
+    header.reverse()
+    assert header.get_value('NSIDE') == 16
+    header.clear()
+    assert header.get_value('NSIDE', default_value=None) is None
+    assert header.column_types == []
+
+
+def test_indexed_header_copy_method():
+    header = fits_utils.IndexedHeader(CARDS)
+    copied = header.copy()
+    assert isinstance(copied, fits_utils.IndexedHeader)
+    _check_index(copied)
+    copied.append(('EXTNAME', 'xtension', ''))
+    assert 'EXTNAME' not in header.positions
+
+
+@pytest.mark.parametrize('idx, card', [
+    (0, ('NSIDE', 8, '')),
+    (-1, ('HISTORY', 'Replaced', '')),
+    (12, ('EXTNAME', 'xtension', '')),
+    (3, ('TTYPE1', 'T', '')),
+    (5, ('TUNIT2', 'K_CMB', '')),
+    (4, ('TTYPE5', 'HITS', '')),
+    (2, ('TFIELDS', 5, '')),
+    (1, ('TTYPE2', 'U_STOKES', '')),
+    (slice(0, 2), [('NSIDE', 8, ''), ('TTYPE1', 'T', '')])])
+def test_indexed_header_setitem(idx, card):
+    header = fits_utils.IndexedHeader(CARDS)
+    header[idx] = card
+    _assert_fresh_index(header)
+    assert list(header)[idx] == card
+
+
+def test_indexed_header_setitem_out_of_range():
+    header = fits_utils.IndexedHeader(CARDS)
+    with pytest.raises(IndexError):
+        header[len(CARDS)] = ('NSIDE', 8, '')
+    with pytest.raises(IndexError):
+        header[-len(CARDS) - 1] = ('NSIDE', 8, '')
+    assert list(header) == CARDS
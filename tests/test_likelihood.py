@@ -0,0 +1,237 @@
+import os
+
+import healpy
+import numpy as np
+import pytest
+from scipy.special import eval_legendre
+
+from calculation import likelihood
+
+NSIDE = 2
+LMAX = 5
+
+
+def _cls(scale=1., seed=0):
+    rng = np.random.default_rng(seed)
+    cls = {}
+    for spec in likelihood.SPECTRA:
+        cls[spec] = np.zeros(LMAX + 1)
+    ells = np.arange(LMAX + 1)
+    cls['TT'][:] = scale * rng.uniform(1, 2, LMAX + 1) / (ells + 1.) ** 2
+    cls['EE'][2:] = scale * rng.uniform(0.1, 0.2, LMAX - 1) / ells[2:] ** 2
+    cls['BB'][2:] = scale * rng.uniform(0.01, 0.02, LMAX - 1) / ells[2:] ** 2
+    cls['TE'][2:] = 0.3 * np.sqrt(cls['TT'][2:] * cls['EE'][2:])
+    return cls
+
+
+def _mask(num_pixels=9):
+    mask = np.zeros(12 * NSIDE ** 2)
+    mask[np.random.default_rng(1).choice(len(mask), num_pixels,
+                                         replace=False)] = 1
+    return mask
+
+
+def _noise(size, seed=2):
+    mat = np.random.default_rng(seed).normal(size=(size, size))
+    return 0.01 * (np.dot(mat, mat.T) / size + np.eye(size))
+
+
+def _dense_log_likelihood(data, cov):
+    sign, logdet = np.linalg.slogdet(cov)
+    assert sign > 0
+    return -0.5 * (np.dot(data, np.linalg.solve(cov, data)) + logdet)
+
+
+def test_observed_pixels():
+    mask = _mask()
+    ring = likelihood.observed_pixels(mask, 3)
+    assert len(ring) == 3
+    np.testing.assert_array_equal(ring[0], np.flatnonzero(mask))
+    nest = likelihood.observed_pixels(mask, 1, 'nested')[0]
+    assert sorted(nest) == sorted(ring[0])
+    assert np.all(np.diff(healpy.ring2nest(NSIDE, nest)) > 0)
+
+
+def test_signal_covariance_temperature_legendre():
+    pixels = likelihood.observed_pixels(_mask(), 1)
+    harmonics = likelihood.pixel_harmonics(NSIDE, pixels, LMAX)
+    assert set(harmonics) == {'ells', 'T'}
+    cls = _cls()
+    cov = likelihood.signal_covariance(harmonics, cls)
+    vecs = np.array(healpy.pix2vec(NSIDE, pixels[0]))
+    cosang = np.clip(np.dot(vecs.T, vecs), -1, 1)
+    expected = sum((2 * ell + 1) / (4 * np.pi) * cls['TT'][ell] *
+                   eval_legendre(ell, cosang) for ell in range(LMAX + 1))
+    np.testing.assert_allclose(cov, expected, rtol=1e-10, atol=1e-14)
+
+
+def test_pixel_harmonics_reproduce_alm2map():
+    pixels = likelihood.observed_pixels(_mask(), 3)
+    harmonics = likelihood.pixel_harmonics(NSIDE, pixels, LMAX)
+    alms = healpy.synalm([_cls()[spec] for spec in
+                          ('TT', 'EE', 'BB', 'TE', 'EB', 'TB')],
+                         lmax=LMAX, new=True)
+    # The real degrees of freedom of each multipole, in the column order
+    coeffs = {field: [] for field in 'TEB'}
+    for ell in range(LMAX + 1):
+        for m in range(ell + 1):
+            idx = healpy.Alm.getidx(LMAX, ell, m)
+            for field, alm in zip('TEB', alms):
+                if m == 0:
+                    coeffs[field].append(alm[idx].real)
+                else:
+                    coeffs[field].extend([2 ** 0.5 * alm[idx].real,
+                                          2 ** 0.5 * alm[idx].imag])
+    maps = healpy.alm2map(alms, NSIDE, lmax=LMAX, pol=True)
+    expected = np.concatenate([curr_map[curr_pixels] for curr_map,
+                               curr_pixels in zip(maps, pixels)])
+    res = sum(np.dot(harmonics[field], coeffs[field]) for field in 'TEB')
+    np.testing.assert_allclose(res, expected, atol=1e-12)
+
+
+def test_signal_covariance_polarization_variance():
+    # <Q^2 + U^2> = sum_l (2l + 1) / 4pi (C_l^EE + C_l^BB) in every pixel
+    pixels = likelihood.observed_pixels(_mask(), 2)
+    harmonics = likelihood.pixel_harmonics(NSIDE, pixels, LMAX)
+    assert set(harmonics) == {'ells', 'E', 'B'}
+    cls = _cls()
+    cov = likelihood.signal_covariance(harmonics, cls)
+    num = len(pixels[0])
+    ells = np.arange(LMAX + 1)
+    expected = np.sum((2 * ells + 1) / (4 * np.pi) * (cls['EE'] + cls['BB']))
+    np.testing.assert_allclose(
+        np.diag(cov)[:num] + np.diag(cov)[num:], expected, rtol=1e-10)
+    np.testing.assert_allclose(cov, cov.T, atol=1e-15)
+
+
+def test_ston_basis_full_threshold_keeps_likelihood():
+    pixels = likelihood.observed_pixels(_mask(), 3)
+    harmonics = likelihood.pixel_harmonics(NSIDE, pixels, LMAX)
+    size = sum(len(curr) for curr in pixels)
+    noise = _noise(size)
+    basis, eigvals = likelihood.ston_basis(
+        likelihood.signal_covariance(harmonics, _cls()), noise, threshold=0)
+    np.testing.assert_allclose(np.dot(basis.T, np.dot(noise, basis)),
+                               np.eye(len(eigvals)), atol=1e-8)
+    assert np.all(np.diff(eigvals) <= 0)
+    data = np.random.default_rng(3).normal(size=size)
+    compressed = np.dot(basis.T, data)
+    # Up to a constant (the log det of the noise, and the modes without
+    # signal), the likelihood is the same in the compressed basis
+    diffs = []
+    for seed, scale in [(0, 1.), (4, 0.5), (5, 3.)]:
+        signal = likelihood.signal_covariance(harmonics, _cls(scale, seed))
+        full = _dense_log_likelihood(data, signal + noise)
+        projected = _dense_log_likelihood(
+            compressed, np.dot(basis.T, np.dot(signal + noise, basis)))
+        diffs.append(full - projected)
+    np.testing.assert_allclose(diffs, diffs[0], rtol=1e-8)
+
+
+def _compress(cache_dir, cls=None, seed=6):
+    mask = _mask()
+    size = 3 * int(mask.sum())
+    maps = np.random.default_rng(seed).normal(size=(3, 12 * NSIDE ** 2))
+    covmat = {'data': _noise(size), 'ordering': 'ring', 'n': size}
+    return likelihood.ston_compress(maps, mask, covmat, None,
+                                    cls or _cls(), LMAX, pixwin=False,
+                                    cache_dir=cache_dir)
+
+
+def test_ston_compress_cache(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path)
+    res = _compress(cache_dir)
+    fnames = os.listdir(cache_dir)
+    assert fnames == ['ston_{}.npz'.format(res['key'])]
+
+    def fail(*args, **kwargs):
+        raise AssertionError("The basis was recomputed")
+
+    # Equal inputs (another map) reuse the cached basis
+    with monkeypatch.context() as patch:
+        patch.setattr(likelihood, 'pixel_harmonics', fail)
+        cached = _compress(cache_dir, seed=7)
+    assert cached['key'] == res['key']
+    np.testing.assert_array_equal(cached['basis'], res['basis'])
+    assert not np.allclose(cached['data'], res['data'])
+    # Other fiducial spectra give another key and a new basis
+    changed = _compress(cache_dir, cls=_cls(2.))
+    assert changed['key'] != res['key']
+    assert len(os.listdir(cache_dir)) == 2
+    no_cache = _compress(None)
+    assert no_cache['key'] == res['key']
+    np.testing.assert_allclose(no_cache['basis'], res['basis'])
+
+
+def test_likelihood_data_round_trip(tmp_path):
+    res = _compress(None)
+    fname = str(tmp_path / 'like.npz')
+    likelihood.write_likelihood_data(fname, res)
+    read = likelihood.read_likelihood_data(fname)
+    assert set(read) == set(res)
+    assert set(read['harmonics']) == set(res['harmonics'])
+    for field, value in res['harmonics'].items():
+        np.testing.assert_array_equal(read['harmonics'][field], value)
+    for key in ('basis', 'eigenvalues', 'data'):
+        np.testing.assert_array_equal(read[key], res[key])
+    for key in ('nside', 'lmax', 'components', 'key'):
+        assert read[key] == res[key]
+        assert type(read[key]) is type(res[key])
+
+
+def _point_cls(fiducial, lmin, lmax, spectra, seed):
+    rng = np.random.default_rng(seed)
+    cls = dict((spec, value.copy()) for spec, value in fiducial.items())
+    for spec in spectra:
+        cls[spec][lmin:lmax + 1] *= rng.uniform(0.5, 1.5, lmax - lmin + 1)
+    return cls
+
+
+@pytest.mark.parametrize('lmin, lmax, spectra', [
+    (0, LMAX, likelihood.SPECTRA),
+    (2, 4, ('TT', 'EE', 'TE')),
+    (3, 3, ('BB',))])
+def test_gaussian_likelihood(lmin, lmax, spectra):
+    data = _compress(None)
+    fiducial = _cls()
+    points = [_point_cls(fiducial, lmin, lmax, spectra, seed)
+              for seed in range(5)]
+    gausslike = likelihood.GaussianLikelihood(data, fiducial, lmin, lmax,
+                                              spectra, num_threads=2,
+                                              batch_size=2)
+    size = len(data['data'])
+    expected = []
+    for cls in points:
+        # Dense covariance of the compressed data, where the noise is the
+        # identity
+        cov = np.eye(size) + likelihood.signal_covariance(data['harmonics'],
+                                                          cls)
+        expected.append(_dense_log_likelihood(data['data'], cov))
+    np.testing.assert_allclose(gausslike.log_likelihood(points), expected,
+                               rtol=1e-10)
+    # The projections of the varied terms, with the fixed part, give the
+    # covariance of each point
+    coeffs = gausslike._coefficients(points)
+    for cls, curr_coeffs in zip(points, coeffs):
+        cov = (gausslike._fixed +
+               np.tensordot(curr_coeffs, gausslike._projections, axes=1))
+        np.testing.assert_allclose(
+            cov, np.eye(size) + likelihood.signal_covariance(
+                data['harmonics'], cls), rtol=1e-10, atol=1e-12)
+    stacked = np.array([[cls[spec] for spec in likelihood.SPECTRA]
+                        for cls in points])
+    np.testing.assert_allclose(gausslike.log_likelihood(stacked), expected,
+                               rtol=1e-10)
+
+
+def test_gaussian_likelihood_not_positive_definite():
+    data = _compress(None)
+    fiducial = _cls()
+    gausslike = likelihood.GaussianLikelihood(data, fiducial, 2, LMAX,
+                                              ('TT',), num_threads=1)
+    bad = _point_cls(fiducial, 2, LMAX, (), 0)
+    bad['TT'][2:] = -1e3
+    res = gausslike.log_likelihood([fiducial, bad])
+    assert np.isfinite(res[0]) and res[1] == -np.inf
+    with pytest.raises(ValueError):
+        likelihood.GaussianLikelihood(data, fiducial, 2, LMAX + 1)
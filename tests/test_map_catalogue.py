@@ -0,0 +1,81 @@
+import os
+import subprocess
+import sys
+
+import healpy
+import numpy as np
+
+from utils import fits_io_utils, map_catalogue, map_utils
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _write_maps(directory):
+    nside = 4
+    npix = 12 * nside ** 2
+    os.makedirs(os.path.join(directory, 'sub'))
+    fmap = map_utils.bundle_fullmap(
+        [np.zeros(npix), np.ones(npix)], ordering='ring',
+        column_units=['ukcmb', 'ukcmb^2'],
+        column_properties={'signal_i': [0], 'covariance_ii': [1],
+                           'squared': [1]},
+        column_names=['I_STOKES', 'II_COV'])
+    fits_io_utils.write_planck_fullmap(
+        os.path.join(directory, 'planck.fits'), fmap)
+    healpy.write_map(os.path.join(directory, 'sub', 'healpy.fits'),
+                     [np.zeros(12 * 2 ** 2)] * 3, nest=True, dtype=np.float64)
+    with open(os.path.join(directory, 'broken.fits'), 'w') as f:
+        f.write('not a FITS file')
+
+
+def test_catalogue_entry(tmp_path):
+    _write_maps(str(tmp_path))
+    entry = map_catalogue.catalogue_entry(str(tmp_path / 'planck.fits'))
+    assert entry['error'] is None
+    assert entry['nside'] == 4
+    assert entry['ordering'] == 'ring'
+    assert entry['column_names'] == ['I_STOKES', 'II_COV']
+    assert entry['column_properties'] == {'signal_i': [0],
+                                          'covariance_ii': [1],
+                                          'squared': [1]}
+    entry = map_catalogue.catalogue_entry(str(tmp_path / 'broken.fits'))
+    assert entry['error'] is not None
+    assert entry['nside'] is None
+
+
+def test_update_catalogue(tmp_path):
+    _write_maps(str(tmp_path))
+    db_fname = str(tmp_path / 'cat.db')
+    fnames = map_catalogue.find_map_files(str(tmp_path))
+    assert len(fnames) == 3
+    assert map_catalogue.update_catalogue(db_fname, fnames,
+                                          num_processes=2) == (3, 0)
+    # Nothing changed, so nothing is rescanned
+    assert map_catalogue.update_catalogue(db_fname, fnames,
+                                          num_processes=1) == (0, 0)
+    entries = map_catalogue.query_catalogue(db_fname)
+    assert [os.path.basename(entry['path']) for entry in entries] == [
+        'broken.fits', 'planck.fits', 'healpy.fits']
+    healpy_entry = map_catalogue.query_catalogue(db_fname, nside=2)[0]
+    assert healpy_entry['ordering'] == 'nested'
+    assert healpy_entry['column_properties'] == {
+        'signal_i': [0], 'signal_q': [1], 'signal_u': [2],
+        'unitless': [0, 1, 2]}
+    assert [entry['path'] for entry in map_catalogue.query_catalogue(
+        db_fname, column_name='II_COV')] == [str(tmp_path / 'planck.fits')]
+
+    os.remove(str(tmp_path / 'broken.fits'))
+    assert map_catalogue.update_catalogue(
+        db_fname, map_catalogue.find_map_files(str(tmp_path))) == (0, 1)
+
+
+def test_catalogue_maps_script(tmp_path):
+    _write_maps(str(tmp_path / 'maps'))
+    db_fname = str(tmp_path / 'cat.db')
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    output = subprocess.check_output(
+        [sys.executable, os.path.join(REPO_DIR, 'scripts', 'catalogue_maps.py'),
+         str(tmp_path / 'maps'), db_fname, '--num_processes', '1'],
+        env=env, universal_newlines=True)
+    assert '3 files found, 3 scanned, 0 removed' in output
+    assert len(map_catalogue.query_catalogue(db_fname, ordering='ring')) == 1
@@ -0,0 +1,111 @@
+import healpy
+import numpy as np
+import pytest
+
+from utils import fits_io_utils, map_expressions as me, map_utils
+
+NSIDE = 8
+NPIX = 12 * NSIDE ** 2
+# 7 and 100 do not divide npix, the last one is larger than the map
+BLOCKS = [(7, 1), (7, 3), (100, 1), (100, 4), (256, 2), (NPIX + 5, 2)]
+
+
+def _maps(seed=0):
+    rng = np.random.default_rng(seed)
+    a = rng.normal(size=NPIX)
+    b = rng.uniform(0.5, 2, size=NPIX)
+    return a, b
+
+
+@pytest.mark.parametrize('block_size,num_threads', BLOCKS)
+def test_evaluate_matches_numpy(block_size, num_threads):
+    a, b = _maps()
+    la, lb = me.lazy(a), me.lazy(b)
+    expr = me.where((la > 0) & ~(lb > 1.5), 2 * la / lb - 1,
+                    abs(-la) ** 0.5 + me.apply(np.exp, lb))
+    expected = np.where((a > 0) & ~(b > 1.5), 2 * a / b - 1,
+                        np.abs(-a) ** 0.5 + np.exp(b))
+    np.testing.assert_allclose(expr.evaluate(block_size=block_size,
+                                             num_threads=num_threads),
+                               expected, rtol=1e-14)
+
+    out = np.zeros(NPIX)
+    ret = (1 - la).evaluate(block_size=block_size, num_threads=num_threads,
+                            out=out)
+    assert ret is out
+    np.testing.assert_array_equal(out, 1 - a)
+
+
+@pytest.mark.parametrize('block_size,num_threads', BLOCKS)
+def test_reductions_match_numpy(block_size, num_threads):
+    a, b = _maps()
+    expr = me.lazy(a) * me.lazy(b)
+    kwargs = {'block_size': block_size, 'num_threads': num_threads}
+    np.testing.assert_allclose(expr.sum(**kwargs), np.sum(a * b), rtol=1e-12)
+    np.testing.assert_allclose(expr.mean(**kwargs), np.mean(a * b),
+                               rtol=1e-12)
+    assert (expr > 0).count_nonzero(**kwargs) == np.count_nonzero(a * b > 0)
+    np.testing.assert_array_equal(expr.quantile([0.1, 0.5, 0.9], **kwargs),
+                                  np.quantile(a * b, [0.1, 0.5, 0.9]))
+
+
+@pytest.mark.parametrize('ordering', ['ring', 'nested'])
+@pytest.mark.parametrize('nside_out', [2, 4, 32])
+@pytest.mark.parametrize('block_size,num_threads', BLOCKS)
+def test_ud_grade_matches_healpy(ordering, nside_out, block_size,
+                                 num_threads):
+    a, b = _maps()
+    a[::13] = healpy.UNSEEN
+    # A low resolution pixel with only bad sub-pixels
+    a[:16] = healpy.UNSEEN
+    order = 'NESTED' if ordering == 'nested' else 'RING'
+    expr = me.ud_grade(me.lazy(a, ordering=ordering) + 0, nside_out)
+    assert expr.nside == nside_out
+    assert expr.ordering == ordering
+    expected = healpy.ud_grade(a, nside_out, order_in=order)
+    np.testing.assert_allclose(expr.evaluate(block_size=block_size,
+                                             num_threads=num_threads),
+                               expected, rtol=1e-14)
+
+    combined = me.ud_grade(me.lazy(b, ordering=ordering), nside_out) * 2
+    np.testing.assert_allclose(
+        combined.sum(block_size=block_size, num_threads=num_threads),
+        np.sum(healpy.ud_grade(b, nside_out, order_in=order) * 2),
+        rtol=1e-12)
+
+
+def test_lazy_fullmap_source(tmp_path):
+    a, b = _maps()
+    fmap = map_utils.bundle_fullmap([a, b], ordering='ring',
+                                    column_properties={'signal_i': [0],
+                                                       'signal_q': [1]},
+                                    column_units=['ukcmb', 'ukcmb'],
+                                    column_names=['I_STOKES', 'Q_STOKES'])
+    fname = str(tmp_path / 'map.fits')
+    fits_io_utils.write_planck_fullmap(fname, fmap)
+    lazy_map = fits_io_utils.read_planck_fullmap(fname, None, field=None,
+                                                 verbose=False, lazy=True)
+    leaf = me.lazy(lazy_map, column=1)
+    np.testing.assert_array_equal(leaf.evaluate(block_size=100,
+                                                num_threads=2), b)
+    # Blocks are read from the file, the column is never decoded in full
+    assert not lazy_map['data'].is_decoded(1)
+    nested = fits_io_utils.read_planck_fullmap(fname, None, field=None,
+                                               nest=True, verbose=False,
+                                               lazy=True)
+    leaf = me.lazy(nested, column=1)
+    assert leaf.ordering == 'nested'
+    np.testing.assert_array_equal(leaf.evaluate(block_size=100),
+                                  healpy.reorder(b, r2n=True))
+    diff = me.lazy(fmap, column=1) - me.lazy(b)
+    assert diff.count_nonzero(block_size=100) == 0
+
+
+def test_mismatched_operands():
+    a, _ = _maps()
+    with pytest.raises(ValueError):
+        me.lazy(a) + me.lazy(a, ordering='nested')
+    with pytest.raises(ValueError):
+        me.lazy(a) + me.lazy(np.zeros(12))
+    with pytest.raises(ValueError):
+        me.apply(np.add, 1, 2)
@@ -0,0 +1,187 @@
+import healpy
+import numpy as np
+import pytest
+
+from utils import map_utils
+
+
+def test_bundle_fullmap_metadata_filter():
+    npix = 12 * 2 ** 2
+    metadata = {'ordering': 'ring',
+                'column_properties': {'signal_i': [0], 'signal_q': [1],
+                                      'signal_u': [2]},
+                'column_units': ['ukcmb', 'ukcmb', 'kcmb'],
+                'column_names': ['I_STOKES', 'Q_STOKES', 'U_STOKES']}
+    fmap = map_utils.bundle_fullmap([np.zeros(npix), np.ones(npix)],
+                                    default_metadata=metadata,
+                                    metadata_filter=[0, 2])
+    assert fmap['column_properties'] == {'signal_i': [0], 'signal_q': [],
+                                         'signal_u': [1]}
+    assert fmap['column_units'] == ['ukcmb', 'kcmb']
+    assert fmap['column_names'] == ['I_STOKES', 'U_STOKES']
+    assert fmap['nside'] == 2
+
+
+@pytest.fixture
+def reorder_cache(monkeypatch):
+    monkeypatch.setattr(map_utils, 'REORDER_CACHE_DIR', None)
+    map_utils.clear_reorder_cache()
+    yield
+    map_utils.clear_reorder_cache()
+
+
+@pytest.mark.parametrize('nside', [1, 4, 32])
+def test_get_reorder_indices(reorder_cache, nside):
+    pixels = np.arange(12 * nside ** 2)
+    nested = map_utils.get_reorder_indices(nside, 'nested')
+    ring = map_utils.get_reorder_indices(nside, 'ring')
+    np.testing.assert_array_equal(nested, healpy.nest2ring(nside, pixels))
+    np.testing.assert_array_equal(ring, healpy.ring2nest(nside, pixels))
+    assert not nested.flags.writeable
+    assert map_utils.get_reorder_indices(nside, 'NESTED') is nested
+    ring_map = np.random.default_rng(0).normal(size=len(pixels))
+    np.testing.assert_array_equal(ring_map[nested],
+                                  healpy.reorder(ring_map, r2n=True))
+    with pytest.raises(ValueError):
+        map_utils.get_reorder_indices(nside, 'galactic')
+
+
+def test_get_reorder_indices_disk_cache(reorder_cache, tmp_path,
+                                        monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    idx = map_utils.get_reorder_indices(8, 'nested', cache_dir=cache_dir)
+    fname = tmp_path / 'cache' / 'reorder_nested_n8.npy'
+    assert sorted(path.name for path in (tmp_path / 'cache').iterdir()) == [
+        fname.name]
+    np.testing.assert_array_equal(np.load(str(fname)), idx)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("The permutation was recomputed")
+
+    # A new process (an empty memory cache) reuses the table on disk
+    map_utils.clear_reorder_cache()
+    monkeypatch.setattr(healpy.pixelfunc, 'nest2ring', fail)
+    cached = map_utils.get_reorder_indices(8, 'nested', cache_dir=cache_dir)
+    assert isinstance(cached, np.memmap)
+    np.testing.assert_array_equal(cached, idx)
+
+
+def test_get_reorder_indices_without_disk_cache(reorder_cache, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("The permutation was written to disk")
+
+    monkeypatch.setattr(map_utils, '_save_reorder_indices', fail)
+    map_utils.get_reorder_indices(4, 'ring', cache_dir=None)
+
+
+def test_reorder_columns_and_map(reorder_cache):
+    nside = 4
+    rng = np.random.default_rng(1)
+    ring = rng.normal(size=(3, 12 * nside ** 2))
+    nested = np.array([healpy.reorder(col, r2n=True) for col in ring])
+    np.testing.assert_array_equal(
+        map_utils.reorder_columns(ring, nside, 'nested'), nested)
+    columns = list(ring)
+    assert map_utils.reorder_columns(columns, nside, 'nested') is columns
+    np.testing.assert_array_equal(columns, nested)
+
+    fmap = map_utils.bundle_fullmap(list(ring), ordering='ring',
+                                    column_units=['', '', ''],
+                                    column_names=['I', 'Q', 'U'],
+                                    column_properties={})
+    nested_map = map_utils.reorder_map(fmap, 'NESTED')
+    assert nested_map['ordering'] == 'nested'
+    np.testing.assert_array_equal(nested_map['data'], nested)
+    # The input map is left as it was
+    assert fmap['ordering'] == 'ring'
+    np.testing.assert_array_equal(fmap['data'], ring)
+    assert map_utils.reorder_map(fmap, 'ring') is fmap
+    back = map_utils.reorder_map(nested_map, 'ring')
+    np.testing.assert_array_equal(back['data'], ring)
+
+
+def _map_array(nside=2):
+    npix = 12 * nside ** 2
+    data = np.arange(4 * npix, dtype=np.float64).reshape(4, npix)
+    fmap = map_utils.bundle_fullmap(
+        data, ordering='ring',
+        column_properties={'signal_i': [0], 'signal_q': [1], 'signal_u': [2],
+                           'covariance': [1, 3]},
+        column_units=['ukcmb', 'ukcmb', 'ukcmb', 'kcmb'],
+        column_names=['I_STOKES', 'Q_STOKES', 'U_STOKES', 'QQ_COV'],
+        comments=['A comment'])
+    return data, fmap, map_utils.MapArray.from_fullmap(fmap)
+
+
+def test_map_array_round_trip():
+    data, fmap, marr = _map_array()
+    assert np.shares_memory(marr.data, data)
+    np.testing.assert_array_equal(marr.data, data)
+    assert len(marr) == 4
+    assert marr.nside == 2
+    back = marr.to_fullmap()
+    for key in ('ordering', 'nside', 'column_properties', 'column_units',
+                'column_names', 'comments', 'type'):
+        assert back[key] == fmap[key]
+    for i in range(4):
+        np.testing.assert_array_equal(back['data'][i], data[i])
+        assert np.shares_memory(back['data'][i], data)
+
+    stacked = map_utils.MapArray.from_fullmap(
+        map_utils.bundle_fullmap(list(data), ordering='nested',
+                                 column_properties=fmap['column_properties'],
+                                 column_units=fmap['column_units'],
+                                 column_names=fmap['column_names']))
+    np.testing.assert_array_equal(stacked.data, data)
+    assert not np.shares_memory(stacked.data, data)
+
+
+def test_map_array_select_columns():
+    data, _, marr = _map_array()
+    sel = marr.select_columns([3, 1])
+    assert sel.column_names == ['QQ_COV', 'Q_STOKES']
+    assert sel.column_units == ['kcmb', 'ukcmb']
+    assert sel.column_properties == {'signal_i': [], 'signal_q': [1],
+                                     'signal_u': [], 'covariance': [0, 1]}
+    np.testing.assert_array_equal(sel.data, data[[3, 1]])
+    for i, col in enumerate(sel):
+        assert np.shares_memory(col, data)
+        np.testing.assert_array_equal(col, data[[3, 1][i]])
+    # Evenly spaced columns are still a view of the buffer
+    assert np.shares_memory(marr.select_columns([0, 2]).data, data)
+    assert np.shares_memory(sel.select_columns([1]).data, data)
+    np.testing.assert_array_equal(sel.select_columns([1]).data, data[1:2])
+    sel[0][0] = -1.
+    assert data[3, 0] == -1.
+
+
+def test_map_array_select_property():
+    data, _, marr = _map_array()
+    cov = marr.select_property('covariance')
+    assert cov.column_names == ['Q_STOKES', 'QQ_COV']
+    assert cov.column_properties['covariance'] == [0, 1]
+    assert cov.column_properties['signal_q'] == [0]
+    np.testing.assert_array_equal(cov.data, data[1::2])
+    assert np.shares_memory(cov.data, data)
+    assert len(marr.select_property('missing')) == 0
+
+    relabelled = cov.with_units(['kcmb', 'kcmb'])
+    assert relabelled.column_units == ['kcmb', 'kcmb']
+    assert cov.column_units == ['ukcmb', 'kcmb']
+    assert np.shares_memory(relabelled.data, data)
+    with pytest.raises(ValueError):
+        cov.with_units(['kcmb'])
+
+
+def test_map_array_reorder(reorder_cache):
+    data, _, marr = _map_array()
+    sel = marr.select_columns([2, 0])
+    assert sel.reorder('ring') is sel
+    nested = sel.reorder('nested')
+    assert nested.ordering == 'nested'
+    assert nested.column_names == sel.column_names
+    for i, row in enumerate([2, 0]):
+        np.testing.assert_array_equal(nested[i],
+                                      healpy.reorder(data[row], r2n=True))
+    assert not np.shares_memory(nested.data, data)
+    np.testing.assert_array_equal(nested.reorder('ring').data, sel.data)
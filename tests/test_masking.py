@@ -0,0 +1,44 @@
+import healpy
+import numpy as np
+import pytest
+
+from calculation import masking
+
+
+def _random_discs(num, radius_arcmin, seed=0):
+    rng = np.random.default_rng(seed)
+    lon = rng.uniform(0, 360, num)
+    lat = np.degrees(np.arcsin(rng.uniform(-1, 1, num)))
+    vecs = healpy.dir2vec((lon, lat), lonlat=True)
+    radii = np.radians(rng.uniform(0.5, 1.5, num) * radius_arcmin / 60.)
+    return vecs, radii
+
+
+@pytest.mark.parametrize('nest', [False, True])
+@pytest.mark.parametrize('inclusive', [False, True])
+def test_query_discs_matches_query_disc(nest, inclusive):
+    nside = 64
+    vecs, radii = _random_discs(300, 200)
+    # Discs centred on the poles
+    vecs = np.concatenate([vecs, [[0, 0], [0, 0], [1, -1]]], axis=1)
+    radii = np.concatenate([radii, [0.05, 0.3]])
+    expected = np.zeros(12 * nside ** 2, dtype=bool)
+    for vec, radius in zip(vecs.T, radii):
+        expected[healpy.query_disc(nside, vec, radius, inclusive=inclusive,
+                                   nest=nest)] = True
+    covered = masking.query_discs(nside, vecs, radii, inclusive=inclusive,
+                                  nest=nest, num_threads=2, batch_size=64)
+    np.testing.assert_array_equal(covered, expected)
+    assert masking.query_discs(nside, vecs, radii * 0, nest=nest).sum() == 0
+
+
+def test_radii2mask_orderings():
+    nside = 32
+    centers = (np.array([10., 200.]), np.array([45., -30.]))
+    radii = np.radians([3., 5.])
+    ring = masking.radii2mask(nside, centers, radii)
+    nested = masking.radii2mask(nside, centers, radii, ordering='nested')
+    assert not ring.all() and ring.any()
+    np.testing.assert_array_equal(healpy.reorder(ring, r2n=True), nested)
+    with pytest.raises(ValueError):
+        masking.radii2mask(nside, centers, radii, ordering='galactic')
@@ -0,0 +1,102 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from utils import operations
+
+
+def _naive_windows(data, window_size):
+    padded = operations.pad_data(data, window_size)
+    return [padded[i:i + window_size + 1] for i in range(len(data))]
+
+
+@pytest.mark.parametrize('window_size', [1, 4, 9])
+def test_moving_average_and_variance_match_windows(window_size):
+    rng = np.random.default_rng(1)
+    data = 1e6 + rng.normal(size=200)
+    windows = _naive_windows(data, window_size)
+    np.testing.assert_allclose(operations.moving_average(data, window_size),
+                               [np.mean(w) for w in windows], rtol=1e-12)
+    np.testing.assert_allclose(operations.moving_variance(data, window_size),
+                               [np.var(w) for w in windows], rtol=1e-8)
+
+
+def test_moving_average_keeps_nans_local():
+    rng = np.random.default_rng(2)
+    data = rng.normal(size=(2, 300))
+    data[0, 100] = np.nan
+    weights = rng.uniform(0.5, 1.5, size=data.shape)
+    weights[1, 250] = np.nan
+    window_size = 10
+    average = operations.moving_average(data, window_size, weights=weights)
+    variance = operations.moving_variance(data, window_size, weights=weights)
+    for row in range(2):
+        expected = [np.average(w, weights=v) for w, v in
+                    zip(_naive_windows(data[row], window_size),
+                        _naive_windows(weights[row], window_size))]
+        np.testing.assert_allclose(average[row], expected, rtol=1e-10)
+        np.testing.assert_array_equal(np.isnan(variance[row]),
+                                      np.isnan(expected))
+    assert np.isnan(average[0]).sum() == window_size + 1
+    assert np.isfinite(average[0, :95]).all()
+    assert np.isfinite(average[0, 106:]).all()
+
+
+def test_segmented_moving_average_keeps_nans_local():
+    data = np.arange(40, dtype=float)
+    data[5] = np.nan
+    average = operations.segmented_moving_average(data, None, 4,
+                                                  segment_starts=[20],
+                                                  edge='truncate')
+    assert np.isnan(average[3:8]).all()
+    assert np.isfinite(average[:3]).all() and np.isfinite(average[8:]).all()
+    np.testing.assert_allclose(average[22:38], data[22:38])
+    np.testing.assert_allclose(average[10], 10.)
+
+
+def _brute_force_quantiles(data, window_size, quantile, axis):
+    moved = np.moveaxis(data, axis, -1)
+    res = np.empty(moved.shape)
+    for idx in np.ndindex(moved.shape[:-1]):
+        for i, window in enumerate(_naive_windows(moved[idx], window_size)):
+            with warnings.catch_warnings():
+                # All-NaN windows give NaN
+                warnings.simplefilter('ignore', RuntimeWarning)
+                if quantile is None:
+                    res[idx + (i,)] = np.nanmedian(window)
+                else:
+                    res[idx + (i,)] = np.nanquantile(window, quantile)
+    return np.moveaxis(res, -1, axis)
+
+
+@pytest.mark.parametrize('window_size', [1, 2, 5, 8, 11])
+@pytest.mark.parametrize('quantile', [None, 0., 0.1, 0.5, 0.75, 1.])
+@pytest.mark.parametrize('axis', [-1, 0, 1])
+def test_moving_quantile_matches_brute_force(window_size, quantile, axis):
+    rng = np.random.default_rng(3)
+    data = rng.normal(size=(30, 3, 8))
+    # Repeated values, isolated NaNs and a NaN run longer than the windows
+    data[::4, 1] = 0.5
+    data[rng.uniform(size=data.shape) < 0.1] = np.nan
+    data[5:20, 2, 2:6] = np.nan
+    data = np.moveaxis(data, 0, axis)
+    expected = _brute_force_quantiles(data, window_size, quantile, axis)
+    if quantile is None:
+        res = operations.moving_median(data, window_size, axis=axis)
+    else:
+        res = operations.moving_quantile(data, window_size, quantile,
+                                         axis=axis)
+    assert res.shape == data.shape
+    np.testing.assert_array_equal(np.isnan(res), np.isnan(expected))
+    np.testing.assert_allclose(res, expected, rtol=1e-14, atol=1e-15)
+
+
+def test_moving_median_without_nans_matches_median():
+    data = np.random.default_rng(4).normal(size=101)
+    for window_size in (4, 7):
+        np.testing.assert_array_equal(
+            operations.moving_median(data, window_size),
+            [np.median(w) for w in _naive_windows(data, window_size)])
+    with pytest.raises(ValueError):
+        operations.moving_quantile(data, 4, 1.5)
@@ -0,0 +1,89 @@
+import os
+
+import healpy
+import numpy as np
+import pytest
+
+from calculation import sample_statistics
+from utils import file_utils
+
+NSIDE = 4
+
+
+def _write_chains(directory, num_chains, num_samples, seed=0):
+    rng = np.random.default_rng(seed)
+    maps = rng.normal(size=(num_chains, num_samples, 3, 12 * NSIDE ** 2))
+    for chain in range(num_chains):
+        for sample in range(num_samples):
+            healpy.write_map(
+                os.path.join(directory, 'cmb_c{:04d}_k{:05d}.fits'.format(
+                    chain + 1, sample + 1)),
+                maps[chain, sample], dtype=np.float64)
+    return maps
+
+
+def _pixels():
+    return [np.array([1, 5, 17, 40]), np.array([0, 5, 100]),
+            np.array([3, 150, 191])]
+
+
+def _stack(maps, pixels):
+    return np.concatenate([maps[..., comp, curr_pixels]
+                           for comp, curr_pixels in enumerate(pixels)],
+                          axis=-1)
+
+
+def test_running_covariance_combine():
+    rng = np.random.default_rng(1)
+    samples = 1e3 + rng.normal(size=(50, 6))
+    accumulators = []
+    for chunk in (samples[:7], samples[7:30], samples[30:]):
+        acc = sample_statistics.RunningCovariance(6)
+        for start in range(0, len(chunk), 4):
+            acc.update(chunk[start:start + 4])
+        accumulators.append(acc)
+    count, mean, cov = sample_statistics.combine(accumulators)
+    assert count == 50
+    np.testing.assert_allclose(mean, samples.mean(axis=0))
+    np.testing.assert_allclose(cov, np.cov(samples.T), rtol=1e-9)
+    with pytest.raises(ValueError):
+        sample_statistics.combine([sample_statistics.RunningCovariance(6)])
+
+
+@pytest.mark.parametrize('num_parallel_chains', [1, 2, None])
+def test_chain_mean_cov(tmp_path, num_parallel_chains):
+    maps = _write_chains(str(tmp_path), 3, 5)
+    chains = sample_statistics.group_chain_files(
+        str(tmp_path / 'cmb_c*_k*.fits'))
+    assert [len(files) for files in chains] == [5, 5, 5]
+    pixels = _pixels()
+    count, mean, cov = sample_statistics.chain_mean_cov(
+        chains, pixels, burnin=1, chunk_size=2, num_threads=2,
+        num_parallel_chains=num_parallel_chains)
+    samples = _stack(maps[:, 1:], pixels).reshape(-1, 10)
+    assert count == 12
+    np.testing.assert_allclose(mean, samples.mean(axis=0))
+    np.testing.assert_allclose(cov, np.cov(samples.T), rtol=1e-9)
+
+
+def test_write_mean_cov(tmp_path):
+    pixels = _pixels()
+    rng = np.random.default_rng(2)
+    samples = rng.normal(size=(20, 10))
+    mean, cov = samples.mean(axis=0), np.cov(samples.T)
+    prefix = str(tmp_path / 'test')
+    # Writing twice overwrites the outputs
+    for _ in range(2):
+        sample_statistics.write_mean_cov(prefix, mean, cov, pixels, NSIDE)
+
+    mean_maps = healpy.read_map(prefix + '_mean.fits', field=None)
+    rms_maps = healpy.read_map(prefix + '_rms.fits', field=None)
+    assert mean_maps.shape == rms_maps.shape == (3, 12 * NSIDE ** 2)
+    np.testing.assert_allclose(_stack(mean_maps, pixels), mean)
+    np.testing.assert_allclose(_stack(rms_maps, pixels),
+                               np.sqrt(np.diag(cov)))
+    assert np.sum(mean_maps != healpy.UNSEEN) == 10
+    covmat = file_utils.read_covmat(prefix + '_N.unf')
+    np.testing.assert_allclose(covmat['data'], cov)
+    assert covmat['ordering'] == 'ring'
+    assert covmat['polarization'] == 1
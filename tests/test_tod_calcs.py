@@ -0,0 +1,169 @@
+import math
+
+import numpy as np
+import pytest
+
+from calculation import tod_calcs
+
+
+def _loop_bin_phases(tod, sample_frequency, bin_width, target_period):
+    num_bins = math.ceil(target_period / bin_width)
+    binned_data = np.zeros(num_bins)
+    currlim = sample_frequency * bin_width
+    currbin = 0
+    for i, el in enumerate(tod):
+        if i > currlim:
+            currlim += sample_frequency * bin_width
+            currbin += 1
+            currbin = currbin % num_bins
+        binned_data[currbin] += el
+    return binned_data
+
+
+# (sample_frequency, bin_width, target_period). The target periods are not
+# multiples of the bin width, and a step below one sample makes the bin
+# counter lag behind the limits.
+PHASE_PARAMS = [(10., 0.27, 1.0), (3., 0.1, 0.95), (7.3, 1.3, 10.),
+                (2., 0.5, 3.), (100., 0.011, 0.123)]
+
+
+@pytest.mark.parametrize('sample_frequency,bin_width,target_period',
+                         PHASE_PARAMS)
+def test_bin_phases_matches_loop(sample_frequency, bin_width, target_period):
+    rng = np.random.default_rng(0)
+    tod = rng.normal(size=1000)
+    expected = _loop_bin_phases(tod, sample_frequency, bin_width,
+                                target_period)
+    binned = tod_calcs.bin_phases(tod, sample_frequency, bin_width,
+                                  target_period)
+    assert binned.shape == expected.shape
+    np.testing.assert_allclose(binned, expected, rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(
+        tod_calcs.bin_phases(list(tod), sample_frequency, bin_width,
+                             target_period), expected, rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize('sample_frequency,bin_width,target_period',
+                         PHASE_PARAMS)
+def test_bin_phases_batch(sample_frequency, bin_width, target_period):
+    rng = np.random.default_rng(1)
+    detectors = rng.normal(size=(4, 500))
+    binned = tod_calcs.bin_phases(detectors, sample_frequency, bin_width,
+                                  target_period)
+    assert binned.shape == (4, math.ceil(target_period / bin_width))
+    for row, tod in zip(binned, detectors):
+        np.testing.assert_allclose(
+            row, _loop_bin_phases(tod, sample_frequency, bin_width,
+                                  target_period), rtol=1e-12, atol=1e-12)
+
+    # TODs of different lengths, including an empty one
+    tods = [rng.normal(size=length) for length in (300, 0, 1, 777)]
+    binned = tod_calcs.bin_phases(tods, sample_frequency, bin_width,
+                                  target_period)
+    for row, tod in zip(binned, tods):
+        np.testing.assert_allclose(
+            row, _loop_bin_phases(tod, sample_frequency, bin_width,
+                                  target_period), rtol=1e-12, atol=1e-12)
+
+
+def _loop_downsample_tod(tod, orig_frequency, target_frequency):
+    samples_per_sample = orig_frequency / target_frequency
+    j = 0
+    curr_count = 0
+    downsampled_tod = []
+    curr_bin = 0
+    for i, el in enumerate(tod):
+        if i > (j+1) * samples_per_sample:
+            curr_bin /= curr_count
+            downsampled_tod.append(curr_bin)
+            j += 1
+            curr_bin = 0
+            curr_count = 0
+        curr_bin += el
+        curr_count += 1
+    return np.array(downsampled_tod)
+
+
+# The last one has less than one sample per bin, where at most one bin is
+# closed per sample
+FREQUENCIES = [(100., 7.), (50., 3.3), (10., 10.), (3., 7.)]
+
+
+def _uneven_chunks(tod, seed):
+    rng = np.random.default_rng(seed)
+    cuts = np.sort(rng.integers(0, tod.shape[-1], 12))
+    # Includes empty and single sample chunks
+    cuts = np.concatenate([[0, 0, 1], cuts, cuts[-1:]])
+    return np.split(tod, cuts, axis=-1)
+
+
+@pytest.mark.parametrize('orig_frequency,target_frequency', FREQUENCIES)
+def test_downsampler_chunks_match_whole(orig_frequency, target_frequency):
+    rng = np.random.default_rng(2)
+    tod = rng.normal(size=1000)
+    whole = tod_calcs.downsample_tod(tod, orig_frequency, target_frequency)
+    np.testing.assert_allclose(
+        whole, _loop_downsample_tod(tod, orig_frequency, target_frequency),
+        rtol=1e-12)
+    for seed in range(3):
+        downsampler = tod_calcs.TodDownsampler(orig_frequency,
+                                               target_frequency)
+        chunked = np.concatenate(
+            [downsampler.update(chunk)
+             for chunk in _uneven_chunks(tod, seed)])
+        np.testing.assert_allclose(chunked, whole, rtol=1e-12)
+        last = downsampler.flush()
+        assert last.shape == (1,)
+        np.testing.assert_allclose(
+            last[0], tod[len(tod) - _pending(tod, orig_frequency,
+                                             target_frequency):].mean())
+
+
+def _pending(tod, orig_frequency, target_frequency):
+    "Number of samples in the final bin, from the loop."
+    samples_per_sample = orig_frequency / target_frequency
+    j = 0
+    count = 0
+    for i in range(len(tod)):
+        if i > (j+1) * samples_per_sample:
+            j += 1
+            count = 0
+        count += 1
+    return count
+
+
+@pytest.mark.parametrize('orig_frequency,target_frequency', FREQUENCIES)
+def test_downsampler_detector_chunks(orig_frequency, target_frequency):
+    rng = np.random.default_rng(3)
+    tod = rng.normal(size=(3, 2, 500))
+    downsampler = tod_calcs.TodDownsampler(orig_frequency, target_frequency)
+    chunked = np.concatenate([downsampler.update(chunk)
+                              for chunk in _uneven_chunks(tod, 0)], axis=-1)
+    for idx in np.ndindex(3, 2):
+        np.testing.assert_allclose(
+            chunked[idx], tod_calcs.downsample_tod(tod[idx], orig_frequency,
+                                                   target_frequency),
+            rtol=1e-12)
+
+
+def test_downsampler_reset():
+    rng = np.random.default_rng(4)
+    first, second = rng.normal(size=333), rng.normal(size=500)
+    expected = tod_calcs.downsample_tod(second, 100., 7.)
+    downsampler = tod_calcs.TodDownsampler(100., 7.)
+    downsampler.update(first)
+    downsampler.reset()
+    np.testing.assert_allclose(downsampler.update(second), expected,
+                               rtol=1e-12)
+
+    # reset() also clears the shape of a partially filled bin
+    downsampler.reset()
+    downsampler.update(rng.normal(size=(2, 10)))
+    downsampler.reset()
+    assert downsampler.flush().shape == (0,)
+    np.testing.assert_allclose(downsampler.update(second), expected,
+                               rtol=1e-12)
+    # flush() resets as well
+    downsampler.flush()
+    np.testing.assert_allclose(downsampler.update(second), expected,
+                               rtol=1e-12)
@@ -0,0 +1,87 @@
+# Translation of FITS column metadata to the internal map conventions.
+#
+# Internal units are lower case strings made of an SI prefix and one of the
+# bases 'kcmb', 'jysr', 'krj' or 'ysz' (e.g. 'ukcmb'), with '^2' appended for
+# squared units; unitless columns have the unit ''. This is the inverse of
+# fits_utils.get_fits_ready_units.
+
+# FITS column types (TTYPE or EXTNAME, upper case) and their properties
+_TYPE_PROPERTIES = {
+    'I_STOKES': 'signal_i', 'TEMPERATURE': 'signal_i', 'I': 'signal_i',
+    'T': 'signal_i',
+    'Q_STOKES': 'signal_q', 'Q_POLARISATION': 'signal_q',
+    'Q_POLARIZATION': 'signal_q', 'Q': 'signal_q',
+    'U_STOKES': 'signal_u', 'U_POLARISATION': 'signal_u',
+    'U_POLARIZATION': 'signal_u', 'U': 'signal_u',
+    'I_RMS': 'rms_i', 'Q_RMS': 'rms_q', 'U_RMS': 'rms_u',
+    'I_WEIGHTS': 'weights_i', 'Q_WEIGHTS': 'weights_q',
+    'U_WEIGHTS': 'weights_u',
+    'MASK': 'mask', 'TMASK': 'mask',
+    'HITS': 'hits', 'HIT': 'hits', 'N_OBS': 'hits',
+}
+for _fields in ['II', 'IQ', 'IU', 'QQ', 'QU', 'UU']:
+    _TYPE_PROPERTIES[_fields] = 'covariance_' + _fields.lower()
+    _TYPE_PROPERTIES[_fields + '_COV'] = 'covariance_' + _fields.lower()
+
+# FITS formats of columns that are masks unless their type says otherwise
+_MASK_FORMATS = ('B', 'L')
+
+
+def get_backend_unit(fits_unit, unit_map=None):
+    """ Converts a FITS unit string to the internal unit.
+
+    Arguments:
+        fits_unit (string or None): The unit as found in the header, e.g.
+            'uK_CMB', 'MJy/sr' or '(K_CMB)^2'.
+        unit_map (dict or None): FITS unit to internal unit, for units that
+            do not follow the usual conventions. Takes precedence over the
+            conversion.
+
+    Returns:
+        The internal unit, e.g. 'ukcmb', 'mjysr' or 'kcmb^2'. Empty or
+            missing units give ''.
+    """
+    if unit_map is not None and fits_unit in unit_map:
+        return unit_map[fits_unit]
+    unit = (fits_unit or '').strip()
+    squared = False
+    for suffix in ('^2', '**2'):
+        if unit.endswith(suffix):
+            unit = unit[:-len(suffix)]
+            squared = True
+            break
+    if squared and unit.startswith('(') and unit.endswith(')'):
+        unit = unit[1:-1]
+    unit = unit.lower()
+    for char in ' _/':
+        unit = unit.replace(char, '')
+    if unit and squared:
+        unit += '^2'
+    return unit
+
+
+def resolve_properties(column_type, unit, informat=None):
+    """ Determines the properties of a map column.
+
+    Arguments:
+        column_type (string): The FITS type of the column (TTYPE, or EXTNAME
+            for cutouts).
+        unit (string or None): The internal unit of the column, as returned
+            by get_backend_unit.
+        informat (string or None): The FITS format of the column. Columns of
+            unknown type stored as bytes or logicals are taken to be masks.
+
+    Returns:
+        List of property names. Empty if the column type is unknown.
+    """
+    prop = _TYPE_PROPERTIES.get(column_type.strip().upper(), None)
+    if prop is None and informat in _MASK_FORMATS:
+        prop = 'mask'
+    if prop is None:
+        return []
+    properties = [prop]
+    if not unit:
+        properties.append('unitless')
+    elif unit.endswith('^2'):
+        properties.append('squared')
+    return properties
@@ -0,0 +1,474 @@
+import fnmatch
+import os
+import re
+import tempfile
+from concurrent import futures
+
+import h5py
+import numpy as np
+
+# Number of samples in a chunk of the columnar datasets
+DEFAULT_CHUNK_SAMPLES = 64
+# Target size in bytes of a chunk of the columnar datasets
+DEFAULT_CHUNK_BYTES = 1024 ** 2
+# Bytes of samples read from the chain before they are written to the store
+DEFAULT_BUFFER_BYTES = 256 * 1024 ** 2
+
+_SAMPLE_NAME = re.compile(r'^\d{6}$')
+
+
+def sample_names(chain):
+    "Names of the sample groups ('000000' etc.) of an open chain file, sorted."
+    return sorted(name for name in chain if _SAMPLE_NAME.match(name))
+
+
+def dataset_paths(group, patterns=None):
+    """ Paths of the datasets below an HDF5 group.
+
+    Arguments:
+        group (h5py.Group): The group, typically a sample group of a chain.
+        patterns (string or list of strings): Glob patterns, as for fnmatch,
+            that the paths (relative to group) must match one of, e.g.
+            'tod/*/gain'. If None, all datasets are returned.
+
+    Returns:
+        Sorted list of the relative paths.
+    """
+    paths = []
+
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            paths.append(name)
+
+    group.visititems(visit)
+    if patterns is not None:
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        paths = [path for path in paths
+                 if any(fnmatch.fnmatchcase(path, pattern)
+                        for pattern in patterns)]
+    return sorted(paths)
+
+
+def update_columnar(chain_fname, store_fname, datasets=None,
+                    chunk_samples=DEFAULT_CHUNK_SAMPLES,
+                    chunk_bytes=DEFAULT_CHUNK_BYTES,
+                    buffer_bytes=DEFAULT_BUFFER_BYTES,
+                    compression='gzip', compression_opts=4):
+    """ Transposes a Commander 3 chain file into a parameter-major store.
+
+    Chain files hold one group per sample ('{:06d}'/tod/070/gain etc.), so
+    the trace of a parameter is spread over all sample groups. The store
+    holds each dataset once, at the same path, with a leading sample axis:
+    a chain dataset of shape (ndet, npid) becomes (num_samples, ndet, npid).
+    The datasets are chunked along the sample axis and over as many of the
+    trailing elements as fit in chunk_bytes, and compressed, so the trace
+    of one detector is read in a single call touching few chunks. The
+    sample numbers are in the 'samples' dataset of the store.
+
+    The store is updated incrementally: only the samples of the chain that
+    are newer than the last sample of the store are converted. Samples
+    that do not (yet) have all the datasets, such as one being written by
+    Commander, end the update; they are converted by the next call.
+
+    Arguments:
+        chain_fname (string): The chain file.
+        store_fname (string): The store, which is created if it does not
+            exist.
+        datasets (string or list of strings): Glob patterns of the dataset
+            paths within a sample group, as for dataset_paths. They are
+            resolved against the first sample when the store is created;
+            later calls must resolve to the same datasets. None means all
+            datasets when creating the store, and those of the store when
+            updating it.
+        chunk_samples (int): Number of samples in a chunk.
+        chunk_bytes (int): Target size of a chunk in bytes.
+        buffer_bytes (int): Bytes of samples held in memory between writes.
+        compression, compression_opts: Passed to h5py for the datasets.
+
+    Returns:
+        The number of samples added to the store.
+    """
+    with h5py.File(chain_fname, 'r') as chain, \
+            h5py.File(store_fname, 'a') as store:
+        names = sample_names(chain)
+        if not names:
+            return 0
+        if 'samples' in store:
+            paths = [path for path in store.attrs['datasets']]
+            if datasets is not None and \
+                    dataset_paths(chain[names[0]], datasets) != paths:
+                raise ValueError("{} holds the datasets {}, not {}".format(
+                    store_fname, paths, datasets))
+            num_stored = len(store['samples'])
+            # Drop the samples of an update that was interrupted before
+            # the sample numbers were written
+            for path in paths:
+                if path in store and len(store[path]) != num_stored:
+                    store[path].resize(num_stored, axis=0)
+            last = store['samples'][-1] if num_stored else -1
+            names = [name for name in names if int(name) > last]
+        else:
+            paths = dataset_paths(chain[names[0]], datasets)
+            if not paths:
+                raise ValueError("No datasets matching {} in {}".format(
+                    datasets, chain_fname))
+            store.attrs['datasets'] = paths
+            store.attrs['chain'] = chain_fname
+            store.create_dataset('samples', shape=(0,), maxshape=(None,),
+                                 dtype=np.int64, chunks=(1024,))
+        complete = []
+        for name in names:
+            if not all(path in chain[name] for path in paths):
+                break
+            complete.append(name)
+        if not complete:
+            return 0
+        first = chain[complete[0]]
+        sample_bytes = sum(first[path].size * first[path].dtype.itemsize
+                           for path in paths)
+        batch_size = max(1, buffer_bytes // max(sample_bytes, 1))
+        for start in range(0, len(complete), batch_size):
+            batch = complete[start:start + batch_size]
+            for path in paths:
+                _append_dataset(chain, store, path, batch, chunk_samples,
+                                chunk_bytes, compression, compression_opts)
+            samples = store['samples']
+            samples.resize(len(samples) + len(batch), axis=0)
+            samples[-len(batch):] = [int(name) for name in batch]
+        return len(complete)
+
+
+def _append_dataset(chain, store, path, names, chunk_samples, chunk_bytes,
+                    compression, compression_opts):
+    "Appends one dataset of the sample groups 'names' to the store."
+    source = chain[names[0]][path]
+    values = np.empty((len(names),) + source.shape, dtype=source.dtype)
+    for i, name in enumerate(names):
+        dset = chain[name][path]
+        if dset.shape != source.shape:
+            raise ValueError("{} has shape {} in sample {}, but {} in "
+                             "sample {}".format(path, dset.shape, name,
+                                                source.shape, names[0]))
+        values[i] = dset[()]
+    if path not in store:
+        # Variable-length data can not be compressed
+        compress = values.dtype.kind != 'O'
+        store.create_dataset(
+            path, shape=(0,) + source.shape,
+            maxshape=(None,) + source.shape, dtype=source.dtype,
+            chunks=_chunk_shape(source.shape, values.dtype.itemsize,
+                                chunk_samples, chunk_bytes),
+            compression=compression if compress else None,
+            compression_opts=compression_opts if compress else None,
+            shuffle=compress and compression is not None)
+    dset = store[path]
+    if dset.shape[1:] != source.shape:
+        raise ValueError("{} has shape {} in sample {}, but {} in the "
+                         "store".format(path, source.shape, names[0],
+                                        dset.shape[1:]))
+    dset.resize(len(dset) + len(names), axis=0)
+    dset[-len(names):] = values
+
+
+def _chunk_shape(shape, itemsize, chunk_samples, chunk_bytes):
+    """ Chunk of chunk_samples samples and as many trailing elements as fit.
+
+    The last axis is filled first, so the chunks of a (ndet, npid) dataset
+    hold a run of PIDs of one detector.
+    """
+    chunk = []
+    size = chunk_samples * itemsize
+    for length in reversed(shape):
+        curr = max(1, min(length, chunk_bytes // size))
+        chunk.insert(0, curr)
+        size *= curr
+    return (chunk_samples,) + tuple(chunk)
+
+
+def read_columnar(store_fname, path, index=(), samples=None):
+    """ Reads the trace of a dataset from a store written by update_columnar.
+
+    Arguments:
+        store_fname (string): The store.
+        path (string): The dataset path within a sample, e.g. 'tod/070/gain'.
+        index (tuple): Index into the per-sample array, e.g. (2,) for the
+            third detector of a gain dataset. Defaults to the whole array.
+        samples (iterable of ints): The sample numbers to read. Those that
+            are not in the store are left out. None means all samples.
+
+    Returns:
+        Tuple (sample numbers, values), where values has the sample axis
+        first.
+    """
+    if not isinstance(index, tuple):
+        index = (index,)
+    with h5py.File(store_fname, 'r') as store:
+        stored = store['samples'][()]
+        if samples is None:
+            rows = slice(None)
+        else:
+            rows = np.flatnonzero(np.isin(stored, np.fromiter(samples,
+                                                              np.int64)))
+            if not len(rows):
+                rows = slice(0, 0)
+            elif rows[-1] - rows[0] + 1 == len(rows):
+                rows = slice(rows[0], rows[-1] + 1)
+        return stored[rows], store[path][(rows,) + index]
+
+
+def select_samples(numbers, iterations=None, thinning=1):
+    """ Selects sample numbers of a chain.
+
+    Arguments:
+        numbers (list of ints): The sample numbers in the chain, sorted.
+        iterations (list): The samples to select. Each item is one of
+            - an int: a sample number, or if negative, a position counted
+              from the last sample (-1 is the last one),
+            - a range or a (start, stop) tuple: the sample numbers in
+              range(start, stop) that are in the chain,
+            - a slice: applied to the list of samples, e.g. slice(-50, None)
+              for the last 50 samples.
+            A single int, range or slice may be given instead of a list.
+            None selects all samples.
+        thinning (int): Keep every thinning'th selected sample, counted
+            from the last one, so that the last selected sample is kept.
+
+    Returns:
+        The sorted list of selected sample numbers.
+    """
+    numbers = list(numbers)
+    if iterations is None:
+        iterations = [slice(None)]
+    elif isinstance(iterations, (int, np.integer, range, slice)):
+        iterations = [iterations]
+    available = set(numbers)
+    selected = set()
+    for item in iterations:
+        if isinstance(item, slice):
+            selected.update(numbers[item])
+        elif isinstance(item, (range, tuple)):
+            if isinstance(item, tuple):
+                item = range(*item)
+            selected.update(number for number in item
+                            if number in available)
+        elif item < 0:
+            if -item > len(numbers):
+                raise ValueError("The chain has only {} samples".format(
+                    len(numbers)))
+            selected.add(numbers[item])
+        elif item in available:
+            selected.add(int(item))
+        else:
+            raise ValueError("Sample {} is not in the chain".format(item))
+    return sorted(selected)[::-1][::thinning][::-1]
+
+
+def slice_chains(chain_fnames, out_fname, iterations=None, groups=None,
+                 thinning=1, virtual=False, flat=False, num_processes=None,
+                 compression='gzip', compression_opts=4):
+    """ Extracts samples and groups from Commander 3 chain files.
+
+    The selected samples of all chains are written to out_fname as groups
+    '000000', '000001' etc., in chain order, with 'chain' and 'sample'
+    attributes naming their source.
+
+    With virtual=True the datasets are HDF5 virtual datasets mapping the
+    chain files, so nothing is copied; the output then needs the chain
+    files to stay where they are (they are referred to by absolute path).
+    Scalar and variable-length datasets, which can not be mapped, are
+    copied. Otherwise the datasets are copied, chunked and compressed.
+    The copies are made in parallel by worker processes, each reading a
+    part of the samples (of different chains where possible) into a
+    temporary file next to out_fname. These are merged with HDF5 object
+    copies, which move the compressed chunks without recompressing them.
+
+    Arguments:
+        chain_fnames (string or list of strings): The chain files.
+        out_fname (string): The output file.
+        iterations, thinning: The samples to extract from each chain, as
+            for select_samples.
+        groups (string or list of strings): Glob patterns of the groups or
+            datasets to extract from each sample, e.g. ['cmb', 'tod/*/gain'].
+            Every pattern must match something in every selected sample.
+            None extracts whole samples.
+        virtual (bool): Whether to write virtual datasets.
+        flat (bool): Write the contents of the sample at the root of the
+            output file, as a Commander init file. Requires exactly one
+            selected sample.
+        num_processes (int): Number of processes copying samples. None
+            means one per chain, up to the number of CPUs.
+        compression, compression_opts: Passed to h5py for the copies.
+
+    Returns:
+        List of (chain filename, sample number, output group) tuples. The
+        output group is '/' for a flat output.
+    """
+    if isinstance(chain_fnames, str):
+        chain_fnames = [chain_fnames]
+    if isinstance(groups, str):
+        groups = [groups]
+    plan = []
+    for fname in chain_fnames:
+        with h5py.File(fname, 'r') as chain:
+            numbers = [int(name) for name in sample_names(chain)]
+        for number in select_samples(numbers, iterations, thinning):
+            plan.append((fname, number, '{:06d}'.format(len(plan))))
+    if flat:
+        if len(plan) != 1:
+            raise ValueError("A flat output needs exactly one sample, not "
+                             "{}".format(len(plan)))
+        plan = [plan[0][:2] + ('/',)]
+    if virtual:
+        chain, curr_fname = None, None
+        try:
+            with h5py.File(out_fname, 'w') as out:
+                for fname, number, target in plan:
+                    if fname != curr_fname:
+                        if chain is not None:
+                            chain.close()
+                        chain = h5py.File(fname, 'r')
+                        curr_fname = fname
+                    _slice_sample(chain, number, out.require_group(target),
+                                  groups, _virtual_dataset)
+        except Exception:
+            # Do not leave a partial output behind, as the copies do not
+            if os.path.exists(out_fname):
+                os.remove(out_fname)
+            raise
+        finally:
+            if chain is not None:
+                chain.close()
+        return plan
+
+    num_processes = num_processes or min(len(chain_fnames),
+                                         os.cpu_count())
+    # Split the samples of each chain, so that there are at least as many
+    # parts as processes
+    parts = []
+    splits = -(-num_processes // max(len(chain_fnames), 1))
+    for fname in chain_fnames:
+        chain_plan = [item for item in plan if item[0] == fname]
+        parts.extend(part for part in _split(chain_plan, splits) if part)
+    out_dir = os.path.dirname(os.path.abspath(out_fname))
+    tmp_fnames = []
+    try:
+        for _ in parts:
+            handle, tmp_fname = tempfile.mkstemp(suffix='.h5', dir=out_dir)
+            os.close(handle)
+            tmp_fnames.append(tmp_fname)
+        args = [(part, tmp_fname, groups, compression, compression_opts)
+                for part, tmp_fname in zip(parts, tmp_fnames)]
+        if num_processes == 1:
+            for curr_args in args:
+                _write_part(*curr_args)
+        else:
+            with futures.ProcessPoolExecutor(
+                    max_workers=num_processes) as pool:
+                for task in [pool.submit(_write_part, *curr_args)
+                             for curr_args in args]:
+                    task.result()
+        with h5py.File(out_fname, 'w') as out:
+            for tmp_fname in tmp_fnames:
+                with h5py.File(tmp_fname, 'r') as part:
+                    _copy_attrs(part, out)
+                    for name in part:
+                        out.copy(part[name], name)
+    finally:
+        for tmp_fname in tmp_fnames:
+            os.remove(tmp_fname)
+    return plan
+
+
+def _split(items, num_parts):
+    "Splits a list into num_parts contiguous parts of nearly equal length."
+    bounds = np.linspace(0, len(items), num_parts + 1).round().astype(int)
+    return [items[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def _write_part(plan, out_fname, groups, compression, compression_opts):
+    "Copies the samples in plan (all of one chain) to out_fname."
+    def write_dataset(dset, group, name):
+        _compressed_dataset(dset, group, name, compression, compression_opts)
+
+    with h5py.File(plan[0][0], 'r') as chain, \
+            h5py.File(out_fname, 'w') as out:
+        for _, number, target in plan:
+            _slice_sample(chain, number, out.require_group(target), groups,
+                          write_dataset)
+
+
+def _slice_sample(chain, number, target, patterns, write_dataset):
+    """ Writes the groups or datasets of a sample matching the patterns.
+
+    The matched objects keep their paths relative to the sample group.
+    Datasets are written with write_dataset(dataset, group, name).
+    """
+    source = chain['{:06d}'.format(number)]
+    if patterns is None:
+        paths = list(source)
+    else:
+        names = []
+        source.visit(names.append)
+        paths = []
+        for pattern in patterns:
+            matches = [name for name in names
+                       if fnmatch.fnmatchcase(name, pattern)]
+            if not matches:
+                raise ValueError("No '{}' in sample {} of {}".format(
+                    pattern, number, chain.filename))
+            paths.extend(matches)
+        # Objects inside a matched group are copied with it
+        paths = sorted(set(paths))
+        paths = [path for i, path in enumerate(paths)
+                 if not any(path.startswith(prev + '/')
+                            for prev in paths[:i])]
+    if target.name != '/':
+        target.attrs['chain'] = os.path.abspath(chain.filename)
+        target.attrs['sample'] = number
+    for path in paths:
+        obj = source[path]
+        parent = target.require_group(os.path.dirname(path) or '.')
+        if isinstance(obj, h5py.Dataset):
+            write_dataset(obj, parent, os.path.basename(path))
+            continue
+        group = parent.require_group(os.path.basename(path))
+        _copy_attrs(obj, group)
+
+        def visit(name, sub_obj):
+            if isinstance(sub_obj, h5py.Dataset):
+                write_dataset(sub_obj, group.require_group(
+                    os.path.dirname(name) or '.'), os.path.basename(name))
+            else:
+                _copy_attrs(sub_obj, group.require_group(name))
+
+        obj.visititems(visit)
+
+
+def _copy_attrs(source, target):
+    for key, value in source.attrs.items():
+        target.attrs[key] = value
+
+
+def _virtual_dataset(dset, group, name):
+    "Maps a chain dataset as a virtual dataset, or copies it if it can't be."
+    if dset.shape is None or dset.ndim == 0 or dset.size == 0 or \
+            dset.dtype.kind == 'O':
+        group.copy(dset, name)
+        return
+    layout = h5py.VirtualLayout(shape=dset.shape, dtype=dset.dtype)
+    layout[...] = h5py.VirtualSource(os.path.abspath(dset.file.filename),
+                                     dset.name, shape=dset.shape)
+    _copy_attrs(dset, group.create_virtual_dataset(name, layout))
+
+
+def _compressed_dataset(dset, group, name, compression, compression_opts):
+    "Copies a chain dataset, chunked and compressed where possible."
+    if dset.shape is None or dset.ndim == 0 or dset.size == 0 or \
+            dset.dtype.kind == 'O':
+        group.copy(dset, name)
+        return
+    _copy_attrs(dset, group.create_dataset(
+        name, data=dset[()], chunks=dset.chunks or True,
+        compression=compression, compression_opts=compression_opts,
+        shuffle=compression is not None))
@@ -1,30 +1,328 @@
-from scipy.io import FortranFile
+import os
+
 import numpy as np
 
-def read_covmat(fname):
-    with FortranFile(fname) as f:
-        n = f.read_ints(dtype=np.int32)
-        ordering = f.read_ints(dtype=np.int32)
-        polarization = f.read_ints(dtype=np.int32)
-        mat = []
-        for i in range(n[0]):
-            mat.append(f.read_reals(dtype=np.float))
-        if ordering[0] == 2:
-            ordering = 'nest'
-        else:
-            ordering = 'ring'
-    mat = np.array(mat)
-    diag = []
-    for i in range(n[0]):
-        diag.append(mat[i, i])
+DEFAULT_BLOCK_ROWS = 1024
+
+
+def read_covmat(fname, mmap=False):
+    """ Reads a covariance matrix from a Fortran unformatted file.
+
+    The file holds the integer records n, ordering and polarization,
+    followed by one record of n float64 values per matrix row. The record
+    markers are parsed once to find the rows, which are then exposed as a
+    strided view of the file.
+
+    Arguments:
+        fname (string): The file name.
+        mmap (bool): If True, 'data' is a read-only np.memmap view of the
+            rows in the file, so opening costs no memory and slices such
+            as data[i0:i1, j0:j1] only read the requested blocks. If
+            False, the matrix is read into memory in one copy.
+
+    Returns:
+        dict with keys 'data' (the (n, n) matrix), 'ordering' ('ring' or
+        'nest'), 'polarization', 'n' and 'diag' (the diagonal).
+    """
+    layout = _covmat_layout(fname)
+    n = layout['n']
+    rows = np.memmap(fname, dtype=layout['row_dtype'], mode='r',
+                     offset=layout['offset'], shape=(n,))
+    mat = rows['row']
+    diag = np.array(mat[np.arange(n), np.arange(n)])
+    if not mmap:
+        mat = np.array(mat)
     covmat = {'data': mat,
-              'ordering': ordering,
-              'polarization': polarization[0],
-              'n': n[0],
-              'diag': np.array(diag)}
+              'ordering': 'nest' if layout['ordering'] == 2 else 'ring',
+              'polarization': layout['polarization'],
+              'n': n,
+              'diag': diag}
     return covmat
 
 
+def _covmat_layout(fname):
+    """ Parses the record structure of a Fortran covariance matrix file.
+
+    Supports 4- and 8-byte record markers. All matrix rows must be single
+    records of n float64 values, which is checked against the markers of
+    the first and last rows and against the file size.
+
+    Returns:
+        dict with the header values 'n', 'ordering' and 'polarization',
+        the byte 'offset' of the first row record and the structured
+        'row_dtype' (marker, row, marker) of the row records.
+    """
+    fsize = os.path.getsize(fname)
+    with open(fname, 'rb') as f:
+        start = np.frombuffer(f.read(8), dtype='<u4')
+        marker_dtype = np.dtype('<u8' if start[1] == 0 else '<u4')
+        marker_size = marker_dtype.itemsize
+
+        def read_marker(offset):
+            f.seek(offset)
+            return int(np.frombuffer(f.read(marker_size),
+                                     dtype=marker_dtype)[0])
+
+        offset = 0
+        header = []
+        for _ in range(3):
+            length = read_marker(offset)
+            f.seek(offset + marker_size)
+            values = np.frombuffer(f.read(length), dtype=np.int32)
+            if (len(values) == 0 or
+                    read_marker(offset + marker_size + length) != length):
+                raise ValueError("Invalid record markers in the header of "
+                                 "{}".format(fname))
+            header.append(int(values[0]))
+            offset += 2 * marker_size + length
+        n = header[0]
+        row_length = 8 * n
+        stride = row_length + 2 * marker_size
+        if fsize != offset + n * stride:
+            raise ValueError("Size of {} does not match {} rows of {} "
+                             "values".format(fname, n, n))
+        for row_offset in (offset, offset + (n - 1) * stride):
+            if (read_marker(row_offset) != row_length or
+                    read_marker(row_offset + marker_size + row_length) !=
+                    row_length):
+                raise ValueError("Unexpected row record markers in "
+                                 "{}".format(fname))
+    row_dtype = np.dtype([('head', marker_dtype), ('row', '<f8', (n,)),
+                          ('tail', marker_dtype)])
+    return {'n': n,
+            'ordering': header[1],
+            'polarization': header[2],
+            'offset': offset,
+            'row_dtype': row_dtype}
+
+
+def write_covmat(fname, mat, ordering, polarization,
+                 block_rows=DEFAULT_BLOCK_ROWS):
+    """ Writes a covariance matrix in the Fortran unformatted format.
+
+    The layout is the one read by read_covmat: the integer records n,
+    ordering (1 for ring, 2 for nested) and polarization, followed by one
+    record per row. Rows are written in blocks, so mat can be
+    memory-mapped.
+
+    Arguments:
+        fname (string): The output filename.
+        mat (np.array): The (n, n) matrix.
+        ordering (string): 'ring' or 'nest'/'nested'.
+        polarization (int): The polarization flag.
+        block_rows (int): Number of rows written at a time.
+    """
+    n = mat.shape[0]
+    with CovmatWriter(fname, n, ordering, polarization) as writer:
+        for start in range(0, n, block_rows):
+            writer.write_rows(mat[start:start + block_rows])
+
+
+class CovmatWriter(object):
+    "Writes the header and then blocks of rows of a covariance matrix file."
+
+    def __init__(self, fname, n, ordering, polarization):
+        self._f = open(fname, 'wb')
+        self._n = n
+        self._written = 0
+        self._row_dtype = np.dtype([('head', '<u4'), ('row', '<f8', (n,)),
+                                    ('tail', '<u4')])
+        ordering = 2 if ordering.lower().startswith('nest') else 1
+        for value in (n, ordering, polarization):
+            np.array([4, value, 4], dtype='<i4').tofile(self._f)
+
+    def write_rows(self, rows):
+        block = np.empty(len(rows), dtype=self._row_dtype)
+        block['head'] = block['tail'] = 8 * self._n
+        block['row'] = rows
+        block.tofile(self._f)
+        self._written += len(rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._f.close()
+        if exc_type is None and self._written != self._n:
+            raise ValueError("Wrote {} rows of a {}x{} matrix".format(
+                self._written, self._n, self._n))
+
+
+class BlockDiagonalCovariance(object):
+    """ Covariance matrix with one small block per pixel.
+
+    The matrix has all pixels of one Stokes component before those of the
+    next (e.g. I, then Q, then U), as in the Fortran covariance files, and
+    only couples the components of the same pixel. It is stored as an
+    array of shape (nobs, ncomp, ncomp), so inversion, square roots and
+    rms cost O(N) instead of the O(N^3) of the dense matrix. A purely
+    diagonal matrix is the special case of diagonal blocks (or ncomp=1).
+
+    Attributes:
+        blocks (np.array): The (nobs, ncomp, ncomp) per-pixel blocks.
+        ordering (string): 'ring' or 'nest'.
+        polarization (int): The polarization flag of the matrix files.
+    """
+
+    def __init__(self, blocks, ordering, polarization):
+        blocks = np.asarray(blocks, dtype=np.float64)
+        if blocks.ndim != 3 or blocks.shape[1] != blocks.shape[2]:
+            raise ValueError("Blocks must have shape (nobs, ncomp, ncomp)")
+        self.blocks = blocks
+        self.ordering = ordering
+        self.polarization = polarization
+
+    @classmethod
+    def from_diagonal(cls, diag, ordering, polarization, ncomp=1):
+        """ Diagonal matrix from its diagonal (of length ncomp * nobs). """
+        diag = np.asarray(diag, dtype=np.float64)
+        if len(diag) % ncomp:
+            raise ValueError("Diagonal of length {} does not split into {} "
+                             "components".format(len(diag), ncomp))
+        nobs = len(diag) // ncomp
+        blocks = np.zeros((nobs, ncomp, ncomp))
+        comps = np.arange(ncomp)
+        blocks[:, comps, comps] = diag.reshape(ncomp, nobs).T
+        return cls(blocks, ordering, polarization)
+
+    @classmethod
+    def from_covmat(cls, covmat, ncomp=1, diagonal=False):
+        """ Extracts the per-pixel blocks of a covariance matrix.
+
+        Arguments:
+            covmat (dict): A matrix as returned by read_covmat. With
+                mmap=True only the elements of the blocks are read.
+            ncomp (int): Number of Stokes components of the matrix.
+            diagonal (bool): If True, only the diagonal is kept, dropping
+                the correlations between the components of a pixel.
+        """
+        if diagonal:
+            return cls.from_diagonal(covmat['diag'], covmat['ordering'],
+                                     covmat['polarization'], ncomp)
+        n = covmat['n']
+        if n % ncomp:
+            raise ValueError("Matrix of size {} does not split into {} "
+                             "components".format(n, ncomp))
+        nobs = n // ncomp
+        index = (np.arange(ncomp)[None, :] * nobs +
+                 np.arange(nobs)[:, None])
+        mat = covmat['data']
+        blocks = np.empty((nobs, ncomp, ncomp))
+        for i in range(ncomp):
+            for j in range(ncomp):
+                blocks[:, i, j] = mat[index[:, i], index[:, j]]
+        return cls(blocks, covmat['ordering'], covmat['polarization'])
+
+    @classmethod
+    def load(cls, fname):
+        """ Reads a matrix written by save. """
+        with np.load(fname) as data:
+            return cls(data['blocks'], str(data['ordering']),
+                       int(data['polarization']))
+
+    def save(self, fname):
+        """ Writes the blocks to a compact .npz file. """
+        np.savez(fname, blocks=self.blocks, ordering=self.ordering,
+                 polarization=self.polarization)
+
+    @property
+    def nobs(self):
+        return self.blocks.shape[0]
+
+    @property
+    def ncomp(self):
+        return self.blocks.shape[1]
+
+    @property
+    def n(self):
+        return self.nobs * self.ncomp
+
+    @property
+    def diag(self):
+        "The diagonal of the full matrix."
+        comps = np.arange(self.ncomp)
+        return self.blocks[:, comps, comps].T.ravel()
+
+    def is_diagonal(self):
+        comps = np.arange(self.ncomp)
+        offdiag = self.blocks.copy()
+        offdiag[:, comps, comps] = 0
+        return not offdiag.any()
+
+    def rms(self):
+        "Square root of the diagonal, as an array of shape (ncomp, nobs)."
+        return np.sqrt(self.diag.reshape(self.ncomp, self.nobs))
+
+    def inverse(self):
+        "The inverse matrix, block by block."
+        if self.is_diagonal():
+            return self._from_diagonal_values(1. / self._diagonal_values())
+        return self._like(np.linalg.inv(self.blocks))
+
+    def power(self, power):
+        """ Symmetric matrix power, e.g. 0.5 for the square root.
+
+        Each block is eigendecomposed, as in covariance.matrix_power.
+        """
+        if self.is_diagonal():
+            values = self._diagonal_values()
+            if power != int(power) and np.any(values < 0):
+                raise np.linalg.LinAlgError("Matrix has negative "
+                                            "eigenvalues")
+            return self._from_diagonal_values(values ** power)
+        eigvals, eigvecs = np.linalg.eigh(self.blocks)
+        if power != int(power) and np.any(eigvals < 0):
+            raise np.linalg.LinAlgError("Matrix has negative eigenvalues")
+        scaled = eigvecs * eigvals[:, None, :] ** power
+        return self._like(np.matmul(scaled, eigvecs.transpose(0, 2, 1)))
+
+    def sqrt(self):
+        return self.power(0.5)
+
+    def inverse_sqrt(self):
+        return self.power(-0.5)
+
+    def to_dense(self):
+        """ The full (n, n) matrix. Only feasible for small matrices. """
+        return self._dense_rows(0, self.n)
+
+    def write_covmat(self, fname, block_rows=DEFAULT_BLOCK_ROWS):
+        """ Expands the matrix to a dense Fortran covariance matrix file.
+
+        Only block_rows rows of the dense matrix are held in memory at a
+        time. See write_covmat for the format.
+        """
+        with CovmatWriter(fname, self.n, self.ordering,
+                           self.polarization) as writer:
+            for start in range(0, self.n, block_rows):
+                writer.write_rows(self._dense_rows(
+                    start, min(start + block_rows, self.n)))
+
+    def _dense_rows(self, start, stop):
+        "Rows start:stop of the full matrix."
+        rows = np.arange(start, stop)
+        comp, pixel = np.divmod(rows, self.nobs)
+        res = np.zeros((stop - start, self.n))
+        for other in range(self.ncomp):
+            res[rows - start, other * self.nobs + pixel] = \
+                self.blocks[pixel, comp, other]
+        return res
+
+    def _diagonal_values(self):
+        comps = np.arange(self.ncomp)
+        return self.blocks[:, comps, comps]
+
+    def _from_diagonal_values(self, values):
+        blocks = np.zeros_like(self.blocks)
+        comps = np.arange(self.ncomp)
+        blocks[:, comps, comps] = values
+        return self._like(blocks)
+
+    def _like(self, blocks):
+        return BlockDiagonalCovariance(blocks, self.ordering,
+                                       self.polarization)
+
+
 def extract_fname(full_fname):
     """ Given a full file path, extracts the file name part of the string. 
 
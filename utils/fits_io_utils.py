@@ -1,12 +1,200 @@
 import astropy.io.fits as pf
+import itertools
 import numpy as np
+import os
 import healpy
 from utils import map_utils, fits_utils
 
+# Prefixes of the header keys describing the columns of a binary table
+_COLUMN_KEY_PREFIXES = ('TTYPE', 'TFORM', 'TUNIT')
+
+
+class LazyMapColumns(object):
+    """ Sequence of full map columns backed by a memory-mapped FITS table.
+
+    The columns are kept as views into the memory-mapped binary table and are
+    only decoded (byte-swapped, cast, reordered and bad-value masked) the first
+    time they are accessed. Decoded columns are cached, so each column is
+    decoded at most once. The object can be used wherever the 'data' list of a
+    fullmap map object is expected.
+
+    Arguments:
+        hdulist (HDUList): The opened (memory-mapped) FITS file. A reference is
+            kept so that the underlying file stays open.
+        fits_hdu (BinTableHDU): The HDU containing the map columns.
+        field (list of integers): Which fields of the table to expose.
+        dtype (list of numpy dtypes): The data type of each decoded column.
+        nside (integer): The nside of the map.
+        ordering (string): The ordering of the map in the file, 'RING' or
+            'NESTED'.
+        nest (bool or None): See read_planck_fullmap.
+        verbose (bool): If True, print a number of diagnostic messages.
+    """
+
+    def __init__(self, hdulist, fits_hdu, field, dtype, nside, ordering,
+                 nest=False, verbose=True):
+        self._hdulist = hdulist
+        self._fits_hdu = fits_hdu
+        self._field = list(field)
+        self._dtype = list(dtype)
+        self._nside = nside
+        self._ordering = ordering
+        self._nest = nest
+        self._verbose = verbose
+        self._decoded = [None] * len(self._field)
+
+    def __len__(self):
+        return len(self._field)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if self._decoded[idx] is None:
+            self._decoded[idx] = _decode_column(
+                self.raw(idx), self._dtype[idx], self._nside, self._ordering,
+                nest=self._nest, verbose=self._verbose)
+        return self._decoded[idx]
+
+    def raw(self, idx):
+        """ Returns the undecoded column as a view into the memory map.
+
+        No data is read until the view is used, and byte-swapping is deferred
+        to numpy. The view is in the ordering of the file, and bad values have
+        not been masked.
+
+        Arguments:
+            idx (integer): The column (position in 'field') to return.
+
+        Returns:
+            Read-only numpy array view of the column as stored on disk.
+        """
+        return _get_raw_column(self._fits_hdu, self._field[idx])
+
+    def read_block(self, idx, start, stop):
+        """ Decodes a block of consecutive pixels of a column.
+
+        If the column has already been decoded, or if its ordering has to be
+        converted, the block is taken from the fully decoded column. Otherwise
+        only the requested pixels are read from the memory map.
+
+        Arguments:
+            idx (integer): The column (position in 'field') to read.
+            start, stop (integers): The pixel range to read (stop exclusive).
+
+        Returns:
+            1-D numpy array of length stop - start.
+        """
+        if (self._decoded[idx] is not None or
+                (self._nest is not None and
+                 self._nest != (self._ordering == 'NESTED'))):
+            return self[idx][start:stop]
+        raw = self.raw(idx)
+        if raw.ndim > 1:
+            repeat = raw.shape[1]
+            first_row = start // repeat
+            last_row = -(-stop // repeat)
+            raw = raw[first_row:last_row].reshape(-1)
+            start -= first_row * repeat
+            stop -= first_row * repeat
+        block = np.empty(stop - start, dtype=self._dtype[idx])
+        np.copyto(block, raw[start:stop], casting='unsafe')
+        try:
+            block[healpy.pixelfunc.mask_bad(block)] = healpy.UNSEEN
+        except OverflowError:
+            pass
+        return block
+
+    def is_decoded(self, idx):
+        "Whether column idx has already been decoded."
+        return self._decoded[idx] is not None
+
+    def release(self, idx=None):
+        """ Drop decoded column(s) so that their memory can be reclaimed.
+
+        Arguments:
+            idx (integer or None): The column to release. If None, all decoded
+                columns are released.
+        """
+        if idx is None:
+            self._decoded = [None] * len(self._field)
+        else:
+            self._decoded[idx] = None
+
+
+def _get_raw_column(fits_hdu, ff):
+    """ Returns a column of a binary table HDU without copying it.
+
+    Arguments:
+        fits_hdu (BinTableHDU): The HDU to read from.
+        ff (integer): The field number.
+
+    Returns:
+        numpy array view of the field, in the byte order used in the file.
+    """
+    try:
+        return fits_hdu.data.field(ff)
+    except pf.VerifyError as e:
+        print(e)
+        print("Trying to fix a badly formatted header")
+        fits_hdu.verify("fix")
+        return fits_hdu.data.field(ff)
+
+
+def _decode_column(raw, dtype, nside, ordering, nest=False, verbose=True,
+                   out=None):
+    """ Converts a raw FITS table column to a native HEALPix map.
+
+    The byte-swap and cast are done in a single pass into the output array, so
+    that the only full-size array allocated is the output itself (plus one
+    temporary if the ordering needs to be converted). The ordering permutation
+    is shared between columns and calls through map_utils.get_reorder_indices.
+
+    Arguments:
+        raw (numpy array): The column as stored in the FITS table.
+        dtype (numpy dtype): The data type of the output map.
+        nside (integer): The nside of the map.
+        ordering (string): The ordering of the map in the file, 'RING' or
+            'NESTED'.
+        nest (bool or None): See read_planck_fullmap.
+        verbose (bool): If True, print a number of diagnostic messages.
+        out (numpy array): 1-D array to decode into, e.g. a row of a map
+            buffer. Only used if the ordering is not converted. By default
+            a new array is allocated.
+
+    Returns:
+        1-D numpy array containing the map.
+    """
+    sz = healpy.pixelfunc.nside2npix(nside)
+    if (not healpy.pixelfunc.isnpixok(raw.size) or
+            (sz > 0 and sz != raw.size)):
+        raise ValueError('Wrong nside parameter.')
+    m = out if out is not None else np.empty(raw.size, dtype=dtype)
+    np.copyto(m.reshape(raw.shape), raw, casting='unsafe')
+    if nest is not None:  # no conversion with None
+        if nest and ordering == 'RING':
+            m = np.take(m, map_utils.get_reorder_indices(nside, 'nested'))
+            if verbose:
+                print('Ordering converted to NEST')
+        elif (not nest) and ordering == 'NESTED':
+            m = np.take(m, map_utils.get_reorder_indices(nside, 'ring'))
+            if verbose:
+                print('Ordering converted to RING')
+    try:
+        m[healpy.pixelfunc.mask_bad(m)] = healpy.UNSEEN
+    except OverflowError:
+        pass
+    return m
+
 
 def read_planck_fullmap(fname, unit_map, field=0, nest=False,
                         dtype=np.float64, verbose=True, extension=1,
-                        extract_comments=False):
+                        extract_comments=False, lazy=False, array=False):
     """ Reads a FITS file containing one or more HEALPix maps from PLA.
 
     This routine is mostly copied from healpy.read_map with some minor changes
@@ -22,12 +210,21 @@ def read_planck_fullmap(fname, unit_map, field=0, nest=False,
             data, specifies which we should read from.
         extract_comments (bool): Whether to propagate the comments in the FITS
             header to the output map object.
+        lazy (bool): If True, the file is memory-mapped and the 'data' of the
+            returned map object is a LazyMapColumns sequence, so that each
+            column is only read and decoded when it is accessed.
+        array (bool): If True, the columns are decoded into a single
+            (ncol, npix) buffer, of the common type of the dtypes, and a
+            map_utils.MapArray is returned instead of the map object. Can
+            not be combined with lazy.
 
     Returns:
-        Map object containing the specified data.
+        Map object (or MapArray) containing the specified data.
     """
+    if lazy and array:
+        raise ValueError("A lazy map can not be read as a MapArray")
 
-    hdulist = pf.open(fname)
+    hdulist = pf.open(fname, memmap=True)
     fits_hdu = hdulist[extension]
 
     nside = fits_hdu.header['NSIDE']
@@ -38,12 +235,9 @@ def read_planck_fullmap(fname, unit_map, field=0, nest=False,
 
     ordering = fits_hdu.header['ORDERING']
 
-    sz = healpy.pixelfunc.nside2npix(nside)
-    ret = []
-
     if field is None:
-        field = range(len(fits_hdu.data.columns))
-    elif not (hasattr(field, '__len__') or isinstance(field, basestring)):
+        field = range(len(fits_hdu.columns))
+    elif not (hasattr(field, '__len__') or isinstance(field, str)):
         field = (field,)
 
     if dtype is None:
@@ -58,38 +252,31 @@ def read_planck_fullmap(fname, unit_map, field=0, nest=False,
         except TypeError:
             dtype = [dtype] * len(field)
 
-    for ff, curr_dtype in zip(field, dtype):
-        try:
-            m = fits_hdu.data.field(ff).astype(curr_dtype).ravel()
-        except pf.VerifyError as e:
-            print(e)
-            print("Trying to fix a badly formatted header")
-            m = fits_hdu.verify("fix")
-            m = fits_hdu.data.field(ff).astype(curr_dtype).ravel()
-
-        if (not healpy.pixelfunc.isnpixok(m.size) or
-                (sz > 0 and sz != m.size)):
-            raise ValueError('Wrong nside parameter.')
-        if nest is not None:  # no conversion with None
-            if nest and ordering == 'RING':
-                idx = healpy.pixelfunc.nest2ring(
-                    nside,
-                    np.arange(m.size, dtype=np.int32))
-                m = m[idx]
-                if verbose:
-                    print('Ordering converted to NEST')
-            elif (not nest) and ordering == 'NESTED':
-                idx = healpy.pixelfunc.ring2nest(nside,
-                                                 np.arange(m.size,
-                                                           dtype=np.int32))
-                m = m[idx]
-                if verbose:
-                    print('Ordering converted to RING')
-        try:
-            m[healpy.pixelfunc.mask_bad(m)] = healpy.UNSEEN
-        except OverflowError:
-            pass
-        ret.append(m)
+    if lazy:
+        ret = LazyMapColumns(hdulist, fits_hdu, field, dtype, nside, ordering,
+                             nest=nest, verbose=verbose)
+    else:
+        if array:
+            ret = np.empty((len(field), 12 * nside ** 2),
+                           dtype=np.result_type(*dtype))
+        else:
+            ret = []
+        for i, (ff, curr_dtype) in enumerate(zip(field, dtype)):
+            m = _decode_column(_get_raw_column(fits_hdu, ff), curr_dtype,
+                               nside, ordering, nest=None, verbose=verbose,
+                               out=ret[i] if array else None)
+            if not array:
+                ret.append(m)
+        # All columns are converted with one lookup of the permutation (and
+        # a buffer with a single call)
+        if nest is not None and nest and ordering == 'RING':
+            ret = map_utils.reorder_columns(ret, nside, 'nested')
+            if verbose:
+                print('Ordering converted to NEST')
+        elif nest is not None and not nest and ordering == 'NESTED':
+            ret = map_utils.reorder_columns(ret, nside, 'ring')
+            if verbose:
+                print('Ordering converted to RING')
     if nest is not None:
         ordering = ('nested' if nest else 'ring')
     else:
@@ -99,11 +286,200 @@ def read_planck_fullmap(fname, unit_map, field=0, nest=False,
     if extract_comments:
         comments = fits_utils.extract_header_comments(fits_hdu.header.cards)
 
-    return map_utils.bundle_fullmap(ret, header=list(fits_hdu.header.cards),
+    fmap = map_utils.bundle_fullmap(ret, header=list(fits_hdu.header.cards),
                                     ordering=ordering,
                                     header_filter=list(field),
                                     unit_map=unit_map,
-                                    comments=comments)
+                                    comments=comments, nside=nside)
+    if not lazy:
+        hdulist.close()
+    if array:
+        return map_utils.MapArray.from_fullmap(fmap)
+    return fmap
+
+
+def read_fits_header(fname, extension=1):
+    """ Reads the header of a FITS extension without touching any data.
+
+    Only the header blocks are parsed. The data units of preceding HDUs are
+    skipped by seeking past them, using the sizes given in their headers.
+
+    Arguments:
+        fname (string): The filename of the FITS file.
+        extension (integer): The HDU whose header to read.
+
+    Returns:
+        fits_utils.IndexedHeader containing the cards of the header.
+    """
+
+    with open(fname, 'rb') as f:
+        for i in range(extension + 1):
+            header = pf.Header.fromfile(f)
+            if i == extension:
+                break
+            f.seek(_fits_data_size(header), os.SEEK_CUR)
+    return fits_utils.IndexedHeader(
+        (card.keyword, card.value, card.comment) for card in header.cards)
+
+
+def _fits_data_size(header):
+    "The size in bytes (including padding) of the data unit of an HDU."
+    naxis = header.get('NAXIS', 0)
+    if naxis == 0:
+        return 0
+    size = 1
+    for i in range(1, naxis + 1):
+        size *= header['NAXIS%d' % i]
+    size = (abs(header['BITPIX']) // 8 * header.get('GCOUNT', 1) *
+            (header.get('PCOUNT', 0) + size))
+    return size + (-size % 2880)
+
+
+def read_planck_pixels(fname, pixels=None, pixel_ranges=None, field=0,
+                       nest=False, dtype=np.float64, extension=1):
+    """ Reads a subset of the pixels of a FITS file containing HEALPix maps.
+
+    Only the rows of the binary table that contain the requested pixels are
+    read from disk, seeking directly to them. The ordering conversion is done
+    on the pixel indices, not on the map, so requesting RING pixels from a
+    NESTED file costs no more than requesting NESTED pixels.
+
+    Arguments:
+        fname (string): The filename of the map.
+        pixels (iterable of integers): The pixels to read.
+        pixel_ranges (iterable of (start, stop) tuples): Ranges of pixels to
+            read, in addition to 'pixels'. 'stop' is exclusive.
+        field (integer, iterable): Which field(s) to load.
+        nest (bool or None): Whether the pixel indices are NESTED (True) or
+            RING (False). If None, the indices are in the ordering of the file.
+        dtype (numpy dtype): To which data type the data should be cast.
+        extension (integer): If the file contains several extensions containing
+            data, specifies which we should read from.
+
+    Returns:
+        numpy array containing the pixel values, in the order they were
+            requested (first 'pixels', then each of 'pixel_ranges'). If field
+            is an integer, the array is 1-D, otherwise it has the shape
+            (len(field), number of pixels).
+    """
+
+    pixlist = []
+    if pixels is not None:
+        pixlist.append(np.asarray(pixels, dtype=np.int64).ravel())
+    if pixel_ranges is not None:
+        for start, stop in pixel_ranges:
+            pixlist.append(np.arange(start, stop, dtype=np.int64))
+    if pixlist == []:
+        raise ValueError("No pixels requested")
+    pixels = np.concatenate(pixlist)
+
+    single_field = field is not None and not hasattr(field, '__len__')
+    if single_field:
+        field = (field,)
+
+    with pf.open(fname, memmap=True, lazy_load_hdus=True) as hdulist:
+        fits_hdu = hdulist[extension]
+        header = fits_hdu.header
+        datloc = fits_hdu.fileinfo()['datLoc']
+    nside = int(header['NSIDE'])
+    if not healpy.pixelfunc.isnsideok(nside):
+        raise ValueError('Wrong nside parameter.')
+    ordering = header['ORDERING']
+    row_dtype, repeats = _fits_row_dtype(header)
+    if field is None:
+        field = range(len(repeats))
+
+    npix = healpy.pixelfunc.nside2npix(nside)
+    if np.any(pixels < 0) or np.any(pixels >= npix):
+        raise ValueError('Pixel index out of range for nside %d' % nside)
+    if nest is not None:
+        if nest and ordering == 'RING':
+            pixels = healpy.pixelfunc.nest2ring(nside, pixels)
+        elif (not nest) and ordering == 'NESTED':
+            pixels = healpy.pixelfunc.ring2nest(nside, pixels)
+
+    repeat = repeats[field[0]]
+    if any(repeats[ff] != repeat for ff in field):
+        raise ValueError("All fields must have the same repeat count")
+    if repeat * header['NAXIS2'] != npix:
+        raise ValueError('Wrong nside parameter.')
+    rows = pixels // repeat
+    elements = pixels % repeat
+    unique_rows, row_pos = np.unique(rows, return_inverse=True)
+
+    table = _read_table_rows(fname, datloc, row_dtype, unique_rows)
+    out = np.empty((len(field), len(pixels)), dtype=dtype)
+    for i, ff in enumerate(field):
+        col = table['f%d' % ff].reshape(len(unique_rows), repeat)
+        out[i] = col[row_pos, elements]
+    try:
+        out[healpy.pixelfunc.mask_bad(out)] = healpy.UNSEEN
+    except OverflowError:
+        pass
+    if single_field:
+        return out[0]
+    return out
+
+
+def _fits_row_dtype(header):
+    """ Builds the numpy dtype of one row of a FITS binary table.
+
+    Arguments:
+        header (Header): The header of the binary table HDU.
+
+    Returns:
+        The (big-endian) structured dtype of a row, with field i named 'fi',
+            and a list of the repeat count of each field.
+    """
+    names = []
+    formats = []
+    repeats = []
+    for i in range(header['TFIELDS']):
+        tform = header['TFORM%d' % (i + 1)].strip()
+        repeat = int(tform[:-1]) if len(tform) > 1 else 1
+        coltype = fits_utils.fits2numpyformat(tform[-1]).newbyteorder('>')
+        names.append('f%d' % i)
+        formats.append((coltype, (repeat,)) if repeat > 1 else coltype)
+        repeats.append(repeat)
+    row_dtype = np.dtype({'names': names, 'formats': formats})
+    if row_dtype.itemsize != header['NAXIS1']:
+        raise ValueError("Row size in header does not match column formats")
+    return row_dtype, repeats
+
+
+def _read_table_rows(fname, datloc, row_dtype, rows, max_gap=8192):
+    """ Reads a sorted set of rows from a FITS binary table.
+
+    Rows that are close to each other are read in one go, so that the number
+    of seeks stays small without reading much unneeded data.
+
+    Arguments:
+        fname (string): The filename of the FITS file.
+        datloc (integer): The byte offset of the table data in the file.
+        row_dtype (numpy dtype): The dtype of one table row.
+        rows (numpy array): Sorted, unique row numbers to read.
+        max_gap (integer): Runs of rows separated by fewer than this many bytes
+            are merged into a single read.
+
+    Returns:
+        Structured numpy array with one element per requested row.
+    """
+    out = np.empty(len(rows), dtype=row_dtype)
+    if len(rows) == 0:
+        return out
+    rowsize = row_dtype.itemsize
+    gap_rows = max(1, max_gap // rowsize)
+    breaks = np.nonzero(np.diff(rows) > gap_rows)[0] + 1
+    run_starts = np.concatenate(([0], breaks))
+    run_ends = np.concatenate((breaks, [len(rows)]))
+    with open(fname, 'rb') as f:
+        for start, end in zip(run_starts, run_ends):
+            first = rows[start]
+            nrows = rows[end - 1] - first + 1
+            f.seek(datloc + first * rowsize)
+            run = np.frombuffer(f.read(nrows * rowsize), dtype=row_dtype)
+            out[start:end] = run[rows[start:end] - first]
+    return out
 
 
 def write_planck_fullmap(fname, fmap):
@@ -121,7 +497,6 @@ def write_planck_fullmap(fname, fmap):
     """
 
     m = fmap['data']
-    header = fits_utils.prepare_header(fmap)
 
     if not hasattr(m, '__len__'):
         raise TypeError('The map must be a sequence')
@@ -130,11 +505,53 @@ def write_planck_fullmap(fname, fmap):
     if healpy.pixelfunc.maptype(m) == 0:  # a single map is converted to a list
         m = [m]
 
-    # We collect column units, names, and formats from the input header
+    # maps must have same length
+    assert len(set(map(len, m))) == 1, "Maps must have same length"
+    nside = healpy.pixelfunc.npix2nside(len(m[0]))
+
+    if nside < 0:
+        raise ValueError('Invalid healpix map : wrong number of pixel')
+
+    # The whole map is written as a single block. Writing the header
+    # ourselves (rather than through astropy, which re-syncs the column
+    # cards and drops empty TUNITs) keeps the cards of each column together
+    write_planck_fullmap_chunked(fname, fmap, chunks=[list(m)])
+
+
+def write_planck_fullmap_chunked(fname, fmap, chunks=None,
+                                 chunk_size=1048576):
+    """ Writes a map to a FITS file, streaming the data in blocks of pixels.
+
+    The header is written first, and then the pixel rows are written one
+    block at a time, so that the full FITS table never has to be held in
+    memory. The output is equivalent to that of write_planck_fullmap.
+
+    Arguments:
+        fname (string): The filename (including path) of the output file.
+        fmap (map object): The map object to save. Only the metadata is used
+            if 'chunks' is given, in which case 'data' may be missing.
+        chunks (iterable or None): Blocks of consecutive pixels, in order.
+            Each block is either a 1-D array (for single-column maps), a 2-D
+            array of shape (ncol, nblock) or a list of 1-D arrays, one per
+            column. If None, the blocks are taken from fmap['data'].
+        chunk_size (integer): The number of pixels per block if 'chunks' is
+            None.
+
+    Returns:
+        None
+    """
+
+    if chunks is None:
+        chunks = map_utils.iterate_map_chunks(fmap, chunk_size)
+    chunks = iter(chunks)
+    first = _chunk_columns(next(chunks))
+    metadata = dict(fmap)
+    metadata['data'] = first
+    header = fits_utils.prepare_header(metadata)
+
     column_names = []
     column_units = []
     fitsformat = []
-
     for args in header:
         if args[0].startswith('TTYPE'):
             column_names.append(args[1])
@@ -143,37 +560,103 @@ def write_planck_fullmap(fname, fmap):
         elif args[0].startswith('TUNIT'):
             column_units.append(args[1])
 
-    # maps must have same length
-    assert len(set(map(len, m))) == 1, "Maps must have same length"
-    nside = healpy.pixelfunc.npix2nside(len(m[0]))
+    cols = []
+    for cn, cu, curr_fitsformat in zip(column_names, column_units,
+                                       fitsformat):
+        cols.append(pf.Column(name=cn, format='%s' % curr_fitsformat,
+                              unit=cu))
+    tbhdu = pf.BinTableHDU.from_columns(cols, nrows=0)
+    npix = healpy.pixelfunc.nside2npix(fmap['nside'])
+    tbhdu.header['NAXIS2'] = npix
+    table_header = _build_table_header(tbhdu.header, header)
+    row_dtype = _fits_row_dtype(table_header)[0]
+
+    nrows = 0
+    with open(fname, 'wb') as f:
+        f.write(pf.PrimaryHDU().header.tostring().encode('ascii'))
+        f.write(table_header.tostring().encode('ascii'))
+        for chunk in itertools.chain([first], chunks):
+            chunk = _chunk_columns(chunk)
+            if len(chunk) != len(cols):
+                raise ValueError("Number of columns in chunk does not match "
+                                 "the map")
+            rows = np.empty(len(chunk[0]), dtype=row_dtype)
+            for i, col in enumerate(chunk):
+                rows['f%d' % i] = col
+            nrows += len(rows)
+            if nrows > npix:
+                break
+            f.write(rows.tobytes())
+        f.write(b'\0' * (-nrows * row_dtype.itemsize % 2880))
+    if nrows != npix:
+        os.remove(fname)
+        raise ValueError("Wrote %d pixels, but the map has %d" %
+                         (nrows, npix))
 
-    if nside < 0:
-        raise ValueError('Invalid healpix map : wrong number of pixel')
 
-    cols = []
+def _chunk_columns(chunk):
+    """ Normalizes a block of pixels to a list of 1-D column arrays. """
+    if isinstance(chunk, np.ndarray) and chunk.ndim == 1:
+        chunk = [chunk]
+    return [healpy.pixelfunc.ma_to_array(col) for col in chunk]
 
-    for cn, cu, mm, curr_fitsformat in zip(column_names, column_units, m,
-                                           fitsformat):
-        cols.append(pf.Column(name=cn,
-                              format='%s' % curr_fitsformat,
-                              array=mm,
-                              unit=cu))
-    tbhdu = pf.BinTableHDU.from_columns(cols)
 
-    currpos = len(tbhdu.header)
+def _build_table_header(table_header, header):
+    """ Merges the cards of a map header into a binary table header.
+
+    TTYPE, TFORM and TUNIT cards of 'header' update the corresponding cards of
+    the table header in place. Those missing from the table header (such as
+    TUNIT cards of columns created without a unit) are inserted after the
+    other cards of their column, so that the cards stay grouped per column.
+    The remaining cards of 'header' are appended in their original order,
+    skipping keys that are already present (except COMMENTs).
+
+    Arguments:
+        table_header (Header): The header of the binary table HDU.
+        header (list of tuples): Each element is a header card in the same way
+            pyfits treats them (triplet of (KEY, VALUE, COMMENT)).
+
+    Returns:
+        A new Header containing the merged cards.
+    """
+    column_cards = {}
+    other_cards = []
     for args in header:
-        if (args[0].startswith('TTYPE') or args[0].startswith('TFORM') or
-                args[0].startswith('TUNIT')):
-            tbhdu.header.set(args[0], value=args[1], comment=args[2],
-                             after=currpos)
-            currpos += 1
+        if _column_number(args[0]) is not None:
+            column_cards[args[0]] = tuple(args)
+        else:
+            other_cards.append(tuple(args))
+    table_cards = [tuple(card) for card in table_header.cards]
+    present = set(card[0] for card in table_cards)
+    cards = []
+    for i, card in enumerate(table_cards):
+        cards.append(column_cards.pop(card[0], card))
+        col = _column_number(card[0])
+        if col is None:
+            continue
+        if (i + 1 < len(table_cards) and
+                _column_number(table_cards[i + 1][0]) == col):
             continue
-        elif (args[0] != 'COMMENT' and args[0] in tbhdu.header):
+        for prefix in _COLUMN_KEY_PREFIXES:
+            key = '%s%d' % (prefix, col)
+            if key in column_cards and key not in present:
+                cards.append(column_cards.pop(key))
+    # Cards of columns that are not in the table
+    cards.extend(card for card in column_cards.values())
+    positions = set(card[0] for card in cards)
+    for args in other_cards:
+        if args[0] != 'COMMENT' and args[0] in positions:
             continue
-        tbhdu.header.insert(currpos, args, after=True)
-        currpos += 1
+        positions.add(args[0])
+        cards.append(args)
+    return pf.Header(cards)
+
 
-    tbhdu.writeto(fname, clobber=True)
+def _column_number(key):
+    "The column number of a TTYPEn, TFORMn or TUNITn key, otherwise None."
+    if key[:5] in _COLUMN_KEY_PREFIXES and key[5:].isdigit():
+        return int(key[5:])
+    return None
 
 
 def read_planck_cutout(fname, unit_map, extract_comments=False):
@@ -234,4 +717,4 @@ def write_planck_cutout(fname, cutout):
         hdulist.append(pf.ImageHDU(data=data, name=name,
                                    header=pf.Header(header)))
         hdulist = pf.HDUList(hdulist)
-    hdulist.writeto(fname, clobber=True)
+    hdulist.writeto(fname, overwrite=True)
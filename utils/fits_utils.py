@@ -1,5 +1,9 @@
+import bisect
+
 import numpy as np
 
+from utils import backend_defaults
+
 DEFAULT_COLUMN_NAMES = {
     'signal_i': 'I_STOKES',
     'signal_q': 'Q_STOKES',
@@ -20,6 +24,179 @@ DEFAULT_COLUMN_NAMES = {
     'hits': 'Hits'
 }
 
+class IndexedHeader(list):
+    """ A header (list of cards) with an index from keys to card positions.
+
+    Behaves exactly like the list of (KEY, VALUE, COMMENT) cards it is built
+    from, so it can be passed to every function in this module, but key
+    lookups are O(1) instead of a linear scan. In addition, the TTYPEn, TUNITn
+    and TFORMn cards are decoded into per-column lists in the same pass.
+
+    Attributes:
+        positions (dict): Maps each key to the list of positions (in order) of
+            the cards with that key.
+        column_types, column_units, column_formats (lists): The value of the
+            first TTYPEn, TUNITn and TFORMn card for each column n, or None
+            if the card is missing. Their length is the value of TFIELDS (or
+            the largest column number found, if larger).
+    """
+
+    _column_keys = {'TTYPE': 'column_types',
+                    'TUNIT': 'column_units',
+                    'TFORM': 'column_formats'}
+
+    def __init__(self, cards=()):
+        list.__init__(self, cards)
+        self._reindex()
+
+    def _reindex(self):
+        self.positions = {}
+        self.column_types = []
+        self.column_units = []
+        self.column_formats = []
+        for i in range(len(self)):
+            self._index_card(i)
+        self._pad_columns(self.get_value('TFIELDS', default_value=0))
+
+    def _pad_columns(self, numcols):
+        for attr in self._column_keys.values():
+            column_list = getattr(self, attr)
+            column_list.extend([None] * (numcols - len(column_list)))
+
+    def _index_card(self, pos):
+        # Cards are always indexed in increasing position, so the first
+        # element of each position list is the first occurence of the key.
+        key = self[pos][0]
+        positions = self.positions.setdefault(key, [])
+        positions.append(pos)
+        attr = self._column_keys.get(key[:5], None)
+        if len(positions) > 1 or attr is None or not key[5:].isdigit():
+            return
+        col = int(key[5:]) - 1
+        if col < 0:
+            return
+        self._pad_columns(col + 1)
+        getattr(self, attr)[col] = self[pos][1]
+
+    def get_value(self, key, default_value='nf'):
+        "Indexed equivalent of get_hdu_header_val."
+        positions = self.positions.get(key, None)
+        if positions:
+            return self[positions[0]][1]
+        if default_value != 'nf':
+            return default_value
+        raise ValueError("Header key %s not found" % key)
+
+    def get_card(self, key, default_value='nf'):
+        "Indexed equivalent of get_hdu_header_card."
+        positions = self.positions.get(key, None)
+        if positions:
+            return self[positions[0]]
+        if default_value != 'nf':
+            return default_value
+        raise ValueError("Header key %s not found" % key)
+
+    def append(self, card):
+        list.append(self, card)
+        self._index_card(len(self) - 1)
+
+    def extend(self, cards):
+        for card in cards:
+            self.append(card)
+
+    def _update_column(self, key):
+        # Updates the decoded column value of a key whose positions changed
+        attr = self._column_keys.get(key[:5], None)
+        if attr is None or not key[5:].isdigit() or int(key[5:]) < 1:
+            return
+        col = int(key[5:]) - 1
+        self._pad_columns(col + 1)
+        getattr(self, attr)[col] = self[self.positions[key][0]][1]
+
+    def __setitem__(self, idx, card):
+        if not isinstance(idx, (int, np.integer)):
+            list.__setitem__(self, idx, card)
+            self._reindex()
+            return
+        pos = idx + len(self) if idx < 0 else idx
+        if not 0 <= pos < len(self):
+            raise IndexError("list assignment index out of range")
+        old_key = self[pos][0]
+        list.__setitem__(self, pos, card)
+        old_positions = self.positions[old_key]
+        old_positions.remove(pos)
+        if not old_positions or 'TFIELDS' in (old_key, card[0]):
+            # A key is gone or the number of columns changed, which can
+            # shrink the column lists
+            self._reindex()
+            return
+        bisect.insort(self.positions.setdefault(card[0], []), pos)
+        self._update_column(old_key)
+        self._update_column(card[0])
+
+    def __delitem__(self, idx):
+        list.__delitem__(self, idx)
+        self._reindex()
+
+    def __iadd__(self, cards):
+        self.extend(cards)
+        return self
+
+    def insert(self, idx, card):
+        list.insert(self, idx, card)
+        self._reindex()
+
+    def pop(self, idx=-1):
+        card = list.pop(self, idx)
+        self._reindex()
+        return card
+
+    def remove(self, card):
+        list.remove(self, card)
+        self._reindex()
+
+    def clear(self):
+        list.clear(self)
+        self._reindex()
+
+    def reverse(self):
+        list.reverse(self)
+        self._reindex()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._reindex()
+
+    def __imul__(self, num):
+        list.__imul__(self, num)
+        self._reindex()
+        return self
+
+    def copy(self):
+        return self.__class__(self)
+
+    def __reduce__(self):
+        # Rebuild from the cards, so that copies and unpickled headers get a
+        # fresh index (the default would restore the cards through append,
+        # on top of the copied index, or before the index exists)
+        return (self.__class__, (list(self),))
+
+
+def index_header(header):
+    """ Builds an IndexedHeader from a header, unless it already is one.
+
+    Arguments:
+        header (list of tuples): Each element is a header card in the same way
+            pyfits treats them (triplet of (KEY, VALUE, COMMENT)).
+
+    Returns:
+        IndexedHeader containing the same cards as the input header.
+    """
+    if header is None or isinstance(header, IndexedHeader):
+        return header
+    return IndexedHeader(header)
+
+
 def get_hdu_header_val(header, inkey, default_value='nf'):
     """ Finds the value associated with a given header key.
 
@@ -35,6 +212,8 @@ def get_hdu_header_val(header, inkey, default_value='nf'):
         The value belonging to the header key. Note that the value returned
             corresponds to the first occurence of the key in the list.
     """
+    if isinstance(header, IndexedHeader):
+        return header.get_value(inkey, default_value=default_value)
     for key, value, comment in header:
         if key == inkey:
             return value
@@ -58,6 +237,8 @@ def get_hdu_header_card(header, inkey, default_value='nf'):
         The header card containing inkey. Note that the card returned
             corresponds to the first occurence of the key in the list.
     """
+    if isinstance(header, IndexedHeader):
+        return header.get_card(inkey, default_value=default_value)
     for card in header:
         key = card[0]
         if key == inkey:
@@ -98,14 +279,7 @@ def replace_hdu_header_card(header, card):
     Returns:
         Input header with the input card replacing the existing one.
     """
-    found = False
-    for i in range(len(header)):
-        if header[i][0] == card[0]:
-            if found:
-                raise LookupError("There are more than one instance of the "
-                                  "key in the header")
-            found = True
-            idx = i
+    idx = _find_unique_card(header, card[0])
     header[idx] = card
     return header
 
@@ -123,20 +297,28 @@ def replace_hdu_header_value(header, key, value):
         Input header with the input value replacing the value in the card whose
             key equals the input key.
     """
-    found = False
-    for i in xrange(len(header)):
-        if header[i][0] == key:
-            if found:
-                raise LookupError("There are more than one instance of the "
-                                  "key in the header")
-            found = True
-            idx = i
+    idx = _find_unique_card(header, key)
     orig_card = header[idx]
     new_card = (orig_card[0], value, orig_card[2])
     header[idx] = new_card
     return header
 
 
+def _find_unique_card(header, key):
+    """ Finds the position of the unique card with the given key.
+
+    Raises LookupError if the key occurs more than once.
+    """
+    if isinstance(header, IndexedHeader):
+        positions = header.positions.get(key, [])
+    else:
+        positions = [i for i in range(len(header)) if header[i][0] == key]
+    if len(positions) > 1:
+        raise LookupError("There are more than one instance of the "
+                          "key in the header")
+    return positions[0]
+
+
 def add_element_to_hdu_header(header, element, idx=None, idx2=None,
                               eltype=None):
     """ A convenience function for adding a card of the most common types to a
@@ -307,7 +489,7 @@ def create_basic_hdu_headerlist(inmap):
                    (0.0, 'lonpole')]
     if inmap['orig_mapfname'] is not None:
         common_vals.append((inmap['orig_mapfname'], 'map'))
-    for i in xrange(num_map_columns):
+    for i in range(num_map_columns):
         currheader = []
         currheader = add_element_to_hdu_header(currheader, column_names[i],
                                                eltype='extname')
@@ -348,12 +530,12 @@ def guess_fits_column_names(column_properties, num_map_columns):
     fields = 'iqu'
     for subtype in ['signal', 'rms', 'weight']:
         propnames.extend([subtype + '_' + field for field in fields])
-    for i in xrange(len(fields)):
-        for j in xrange(i, len(fields)):
+    for i in range(len(fields)):
+        for j in range(i, len(fields)):
             propnames.append('covariance_' + fields[i] + fields[j])
     propnames.append('mask')
     propnames.append('hits')
-    for col in xrange(num_map_columns):
+    for col in range(num_map_columns):
         for propname in propnames:
             if col in column_properties.get(propname, []):
                 fits_colnames.append(DEFAULT_COLUMN_NAMES[ propname])
@@ -403,7 +585,7 @@ def find_hdu_num(hdulist, hdu_name):
         The index of the HDU whose EXTNAME matches hdu_name.
     """
     hdu_num = None
-    for i in xrange(len(hdulist)):
+    for i in range(len(hdulist)):
         if 'EXTNAME' not in hdulist[i].header:
             continue
         if hdulist[i].header['EXTNAME'] == hdu_name:
@@ -443,24 +625,27 @@ def resolve_hdu_column_properties(header, unit_map, column_filter=None):
     Returns:
         dict containing the column properties as described in README.txt
     """
-    numcols = get_hdu_header_val(header, 'TFIELDS')
+    header = index_header(header)
+    numcols = header.get_value('TFIELDS')
     colprops = {}
     if column_filter is None:
         column_filter = range(numcols)
+    column_filter = set(column_filter)
     col_idx = 0
-    for i in xrange(1, numcols + 1):
+    for i in range(1, numcols + 1):
         if i - 1 not in column_filter:
             continue
-        typecard = get_hdu_header_card(header, 'TTYPE%d' % i)
-        unitcard = get_hdu_header_card(header, 'TUNIT%d' % i,
-                                       default_value=None)
-        formatcard = get_hdu_header_card(header, 'TFORM%d' % i)
-        currtype = typecard[1]
-        if unitcard is not None:
-            currunit = backend_defaults.get_backend_unit(unitcard[1], unit_map)
+        currtype = header.column_types[i - 1]
+        if currtype is None:
+            raise ValueError("Header key TTYPE%d not found" % i)
+        currformat = header.column_formats[i - 1]
+        if currformat is None:
+            raise ValueError("Header key TFORM%d not found" % i)
+        if header.column_units[i - 1] is not None:
+            currunit = backend_defaults.get_backend_unit(
+                header.column_units[i - 1], unit_map)
         else:
             currunit = None
-        currformat = formatcard[1]
         currcol_properties = backend_defaults.resolve_properties(
             currtype, currunit, informat=currformat)
         if not currcol_properties:
@@ -490,14 +675,15 @@ def resolve_hdulist_column_properties(header, unit_map, column_filter=None):
     numcols = len(header)
     if column_filter is None:
         column_filter = range(numcols)
+    column_filter = set(column_filter)
     colprops = {}
     col_idx = 0
-    for i in xrange(1, numcols + 1):
+    for i in range(1, numcols + 1):
         if i - 1 not in column_filter:
             continue
-        currtype = get_hdu_header_val(header[i], 'EXTNAME')
+        currtype = get_hdu_header_val(header[i - 1], 'EXTNAME')
         currunit = backend_defaults.get_backend_unit(
-            get_hdu_header_val(header[i], 'UNITS'), unit_map)
+            get_hdu_header_val(header[i - 1], 'UNITS'), unit_map)
         currcol_properties = backend_defaults.resolve_properties(currtype,
                                                                  currunit)
         if not currcol_properties:
@@ -525,14 +711,18 @@ def resolve_hdu_column_units(header, unit_map, column_filter=None):
         A list where each element contains the internal unit of the
             corresponding map column.
     """
-    numcols = get_hdu_header_val(header, 'TFIELDS')
+    header = index_header(header)
+    numcols = header.get_value('TFIELDS')
     if column_filter is None:
         column_filter = range(numcols)
+    column_filter = set(column_filter)
     colunits = []
-    for i in xrange(1, numcols + 1):
+    for i in range(1, numcols + 1):
         if i-1 not in column_filter:
             continue
-        value = get_hdu_header_val(header, 'TUNIT%d' % i, default_value='')
+        value = header.column_units[i - 1]
+        if value is None:
+            value = ''
         colunits.append(backend_defaults.get_backend_unit(value, unit_map))
     return colunits
 
@@ -555,13 +745,14 @@ def resolve_hdulist_column_units(header, unit_map, column_filter=None):
     numcols = len(header)
     if column_filter is None:
         column_filter = range(numcols)
+    column_filter = set(column_filter)
     colunits = []
-    for i in xrange(1, numcols + 1):
+    for i in range(1, numcols + 1):
         if i-1 not in column_filter:
             continue
         colunits.append(
             backend_defaults.get_backend_unit(
-                get_hdu_header_val(header[i], 'UNITS'), unit_map))
+                get_hdu_header_val(header[i - 1], 'UNITS'), unit_map))
     return colunits
 
 
@@ -579,14 +770,18 @@ def extract_hdu_column_types(header, column_filter=None):
         A list where each element contains the FITS type of the corresponding
             map column.
     """
-    numcols = get_hdu_header_val(header, 'TFIELDS')
+    header = index_header(header)
+    numcols = header.get_value('TFIELDS')
     if column_filter is None:
         column_filter = range(numcols)
+    column_filter = set(column_filter)
     coltypes = []
-    for i in xrange(1, numcols + 1):
+    for i in range(1, numcols + 1):
         if i-1 not in column_filter:
             continue
-        value = get_hdu_header_val(header, 'TTYPE%d' % i)
+        value = header.column_types[i - 1]
+        if value is None:
+            raise ValueError("Header key TTYPE%d not found" % i)
         coltypes.append(value)
     return coltypes
 
@@ -608,11 +803,12 @@ def extract_hdulist_column_types(header, column_filter=None):
     numcols = len(header)
     if column_filter is None:
         column_filter = range(numcols)
+    column_filter = set(column_filter)
     coltypes = []
-    for i in xrange(1, numcols + 1):
+    for i in range(1, numcols + 1):
         if i-1 not in column_filter:
             continue
-        value = get_hdu_header_val(header[i], 'EXTNAME')
+        value = get_hdu_header_val(header[i - 1], 'EXTNAME')
         coltypes.append(value)
     return coltypes
 
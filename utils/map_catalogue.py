@@ -0,0 +1,237 @@
+from utils import fits_io_utils, fits_utils
+import fnmatch
+import json
+import multiprocessing
+import os
+import sqlite3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS maps (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER,
+    nside INTEGER,
+    ordering TEXT,
+    numcols INTEGER,
+    column_properties TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS columns (
+    path TEXT,
+    idx INTEGER,
+    name TEXT,
+    unit TEXT,
+    format TEXT,
+    PRIMARY KEY (path, idx)
+);
+CREATE INDEX IF NOT EXISTS columns_name ON columns (name);
+"""
+
+
+def catalogue_entry(fname, unit_map=None, extension=1):
+    """ Collects the header information of a full map file.
+
+    Only the header of the file is read.
+
+    Arguments:
+        fname (string): The filename of the map.
+        unit_map (dict): Passed on to fits_utils.resolve_hdu_column_properties.
+        extension (integer): The HDU containing the map.
+
+    Returns:
+        dict with the keys 'path', 'mtime', 'size', 'nside', 'ordering',
+            'numcols', 'column_names', 'column_units', 'column_formats',
+            'column_properties' and 'error'. If the file could not be parsed,
+            'error' contains the error message and the header fields are None.
+            If only the column properties could not be resolved, they are None
+            and 'error' is set.
+    """
+
+    stat = os.stat(fname)
+    entry = {'path': fname, 'mtime': stat.st_mtime, 'size': stat.st_size,
+             'nside': None, 'ordering': None, 'numcols': None,
+             'column_names': [], 'column_units': [], 'column_formats': [],
+             'column_properties': None, 'error': None}
+    try:
+        header = fits_io_utils.read_fits_header(fname, extension=extension)
+        entry['nside'] = int(header.get_value('NSIDE'))
+        entry['ordering'] = header.get_value('ORDERING').lower()
+        entry['numcols'] = header.get_value('TFIELDS')
+    except (IOError, OSError, ValueError, KeyError) as e:
+        entry['error'] = str(e)
+        return entry
+    entry['column_names'] = header.column_types
+    entry['column_units'] = header.column_units
+    entry['column_formats'] = header.column_formats
+    try:
+        entry['column_properties'] = (
+            fits_utils.resolve_hdu_column_properties(header, unit_map))
+    except (ValueError, KeyError) as e:
+        entry['error'] = str(e)
+    return entry
+
+
+def _catalogue_entry_star(args):
+    return catalogue_entry(*args)
+
+
+def find_map_files(directory, pattern='*.fits'):
+    """ Lists the files in a directory tree matching a glob pattern.
+
+    Arguments:
+        directory (string): The top directory to search.
+        pattern (string): The pattern file names must match.
+
+    Returns:
+        Sorted list of file paths.
+    """
+    fnames = []
+    for root, dirs, files in os.walk(directory):
+        for fname in fnmatch.filter(files, pattern):
+            fnames.append(os.path.join(root, fname))
+    return sorted(fnames)
+
+
+def open_catalogue(db_fname):
+    """ Opens (and creates, if needed) a map catalogue database.
+
+    Arguments:
+        db_fname (string): The filename of the sqlite catalogue.
+
+    Returns:
+        sqlite3 connection to the catalogue.
+    """
+    conn = sqlite3.connect(db_fname)
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def update_catalogue(db_fname, fnames, unit_map=None, extension=1,
+                     num_processes=None, prune=True, verbose=False):
+    """ Adds map files to a catalogue, rescanning only changed files.
+
+    A file is (re)scanned if it is not in the catalogue or if its mtime or
+    size differ from the catalogued values. Headers are parsed in parallel.
+
+    Arguments:
+        db_fname (string): The filename of the sqlite catalogue.
+        fnames (list of strings): The map files to catalogue.
+        unit_map (dict): Passed on to fits_utils.resolve_hdu_column_properties.
+        extension (integer): The HDU containing the maps.
+        num_processes (int or None): Number of worker processes. If None, the
+            number of CPUs is used. If 1, no pool is started.
+        prune (bool): Whether to remove catalogued files that no longer exist
+            on disk.
+        verbose (bool): If True, print progress information.
+
+    Returns:
+        Tuple (number of files scanned, number of files removed).
+    """
+
+    conn = open_catalogue(db_fname)
+    known = dict((row[0], (row[1], row[2])) for row in
+                 conn.execute('SELECT path, mtime, size FROM maps'))
+    stale = []
+    for fname in fnames:
+        try:
+            stat = os.stat(fname)
+        except OSError:
+            continue
+        if known.get(fname, None) != (stat.st_mtime, stat.st_size):
+            stale.append(fname)
+
+    args = [(fname, unit_map, extension) for fname in stale]
+    if num_processes == 1 or len(args) < 2:
+        entries = map(_catalogue_entry_star, args)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(num_processes)
+        entries = pool.imap_unordered(_catalogue_entry_star, args,
+                                      chunksize=64)
+    try:
+        with conn:
+            for i, entry in enumerate(entries):
+                _store_entry(conn, entry)
+                if verbose and (i + 1) % 1000 == 0:
+                    print("Scanned %d of %d files" % (i + 1, len(args)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    removed = 0
+    if prune:
+        gone = [path for path in known if not os.path.exists(path)]
+        with conn:
+            for path in gone:
+                conn.execute('DELETE FROM maps WHERE path = ?', (path,))
+                conn.execute('DELETE FROM columns WHERE path = ?', (path,))
+        removed = len(gone)
+    conn.close()
+    return len(stale), removed
+
+
+def _store_entry(conn, entry):
+    "Inserts or replaces a catalogue entry."
+    conn.execute('DELETE FROM columns WHERE path = ?', (entry['path'],))
+    conn.execute(
+        'INSERT OR REPLACE INTO maps VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (entry['path'], entry['mtime'], entry['size'], entry['nside'],
+         entry['ordering'], entry['numcols'],
+         json.dumps(entry['column_properties']), entry['error']))
+    conn.executemany(
+        'INSERT INTO columns VALUES (?, ?, ?, ?, ?)',
+        [(entry['path'], i, name, unit, form) for i, (name, unit, form) in
+         enumerate(zip(entry['column_names'], entry['column_units'],
+                       entry['column_formats']))])
+
+
+def query_catalogue(db_fname, nside=None, ordering=None, column_name=None,
+                    path_pattern=None):
+    """ Looks up catalogued map files matching the given criteria.
+
+    Arguments:
+        db_fname (string): The filename of the sqlite catalogue.
+        nside (int or None): Only return maps with this nside.
+        ordering (string or None): Only return maps with this ordering.
+        column_name (string or None): Only return maps containing a column
+            with this name.
+        path_pattern (string or None): Only return maps whose path matches
+            this glob pattern.
+
+    Returns:
+        List of dicts with the same keys as returned by catalogue_entry,
+            sorted by path.
+    """
+
+    conn = open_catalogue(db_fname)
+    query = ('SELECT path, mtime, size, nside, ordering, numcols, '
+             'column_properties, error FROM maps WHERE 1')
+    params = []
+    if nside is not None:
+        query += ' AND nside = ?'
+        params.append(nside)
+    if ordering is not None:
+        query += ' AND ordering = ?'
+        params.append(ordering.lower())
+    if column_name is not None:
+        query += ' AND path IN (SELECT path FROM columns WHERE name = ?)'
+        params.append(column_name)
+    if path_pattern is not None:
+        query += ' AND path GLOB ?'
+        params.append(path_pattern)
+    query += ' ORDER BY path'
+    entries = []
+    for row in conn.execute(query, params).fetchall():
+        entry = {'path': row[0], 'mtime': row[1], 'size': row[2],
+                 'nside': row[3], 'ordering': row[4], 'numcols': row[5],
+                 'column_properties': json.loads(row[6]), 'error': row[7]}
+        columns = conn.execute(
+            'SELECT name, unit, format FROM columns WHERE path = ? '
+            'ORDER BY idx', (row[0],)).fetchall()
+        entry['column_names'] = [col[0] for col in columns]
+        entry['column_units'] = [col[1] for col in columns]
+        entry['column_formats'] = [col[2] for col in columns]
+        entries.append(entry)
+    conn.close()
+    return entries
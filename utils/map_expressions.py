@@ -0,0 +1,341 @@
+from concurrent import futures
+from utils import fits_io_utils
+import healpy
+import numpy as np
+
+# Number of pixels evaluated at a time (at the resolution of the output)
+DEFAULT_BLOCK_SIZE = 262144
+
+
+class MapExpression(object):
+    """ Base class for lazily evaluated full map expressions.
+
+    Expressions are built from leaves (see lazy()) with the usual arithmetic,
+    comparison and logical operators and with where() and ud_grade(). Nothing
+    is computed until evaluate() (or one of the reductions) is called. The
+    whole expression is then evaluated one block of pixels at a time, so that
+    the intermediate results only ever exist for a single block.
+
+    Attributes:
+        nside (int): The nside of the map the expression evaluates to.
+        ordering (string): 'ring' or 'nested'.
+    """
+
+    nside = None
+    ordering = None
+
+    @property
+    def npix(self):
+        return healpy.pixelfunc.nside2npix(self.nside)
+
+    def children(self):
+        "The sub-expressions this expression depends on."
+        return []
+
+    def _eval_block(self, start, stop):
+        "Evaluates the expression for the pixels start:stop."
+        raise NotImplementedError
+
+    def _prepare(self, block_size, num_threads):
+        "Materializes the parts of the expression that can't be blocked."
+        for child in self.children():
+            child._prepare(block_size, num_threads)
+
+    def evaluate(self, block_size=DEFAULT_BLOCK_SIZE, num_threads=1,
+                 out=None):
+        """ Evaluates the expression.
+
+        Arguments:
+            block_size (int): The number of output pixels evaluated at a time.
+            num_threads (int): The number of threads evaluating blocks.
+            out (numpy array or None): Array to write the result into.
+
+        Returns:
+            1-D numpy array containing the full map.
+        """
+        self._prepare(block_size, num_threads)
+        npix = self.npix
+        first = self._eval_block(0, min(block_size, npix))
+        if out is None:
+            out = np.empty(npix, dtype=first.dtype)
+        out[:len(first)] = first
+        starts = range(block_size, npix, block_size)
+
+        def run(start):
+            stop = min(start + block_size, npix)
+            out[start:stop] = self._eval_block(start, stop)
+
+        _run_blocks(run, starts, num_threads)
+        return out
+
+    def _reduce_blocks(self, func, block_size, num_threads):
+        "Applies func to every block and returns the list of results."
+        self._prepare(block_size, num_threads)
+        npix = self.npix
+        starts = list(range(0, npix, block_size))
+        results = [None] * len(starts)
+
+        def run(i):
+            stop = min(starts[i] + block_size, npix)
+            results[i] = func(self._eval_block(starts[i], stop))
+
+        _run_blocks(run, range(len(starts)), num_threads)
+        return results
+
+    def sum(self, block_size=DEFAULT_BLOCK_SIZE, num_threads=1):
+        "Sum over all pixels, computed block by block."
+        return np.sum(self._reduce_blocks(np.sum, block_size, num_threads))
+
+    def mean(self, block_size=DEFAULT_BLOCK_SIZE, num_threads=1):
+        "Mean over all pixels, computed block by block."
+        return self.sum(block_size, num_threads) / float(self.npix)
+
+    def count_nonzero(self, block_size=DEFAULT_BLOCK_SIZE, num_threads=1):
+        "Number of nonzero pixels, computed block by block."
+        return int(np.sum(self._reduce_blocks(np.count_nonzero, block_size,
+                                              num_threads)))
+
+    def quantile(self, q, block_size=DEFAULT_BLOCK_SIZE, num_threads=1):
+        """ Quantile(s) of the pixel values, as np.quantile.
+
+        The expression has to be evaluated in full for this, but no other
+        full-size temporaries are created.
+        """
+        values = self.evaluate(block_size=block_size,
+                               num_threads=num_threads)
+        return np.quantile(values, q, overwrite_input=True)
+
+    def _binary(self, other, func, reverse=False):
+        if reverse:
+            return ElementwiseExpression(func, [other, self])
+        return ElementwiseExpression(func, [self, other])
+
+    def __add__(self, other):
+        return self._binary(other, np.add)
+
+    def __radd__(self, other):
+        return self._binary(other, np.add, reverse=True)
+
+    def __sub__(self, other):
+        return self._binary(other, np.subtract)
+
+    def __rsub__(self, other):
+        return self._binary(other, np.subtract, reverse=True)
+
+    def __mul__(self, other):
+        return self._binary(other, np.multiply)
+
+    def __rmul__(self, other):
+        return self._binary(other, np.multiply, reverse=True)
+
+    def __truediv__(self, other):
+        return self._binary(other, np.true_divide)
+
+    def __rtruediv__(self, other):
+        return self._binary(other, np.true_divide, reverse=True)
+
+    __div__ = __truediv__
+    __rdiv__ = __rtruediv__
+
+    def __pow__(self, other):
+        return self._binary(other, np.power)
+
+    def __neg__(self):
+        return ElementwiseExpression(np.negative, [self])
+
+    def __abs__(self):
+        return ElementwiseExpression(np.absolute, [self])
+
+    def __lt__(self, other):
+        return self._binary(other, np.less)
+
+    def __le__(self, other):
+        return self._binary(other, np.less_equal)
+
+    def __gt__(self, other):
+        return self._binary(other, np.greater)
+
+    def __ge__(self, other):
+        return self._binary(other, np.greater_equal)
+
+    def __eq__(self, other):
+        return self._binary(other, np.equal)
+
+    def __ne__(self, other):
+        return self._binary(other, np.not_equal)
+
+    __hash__ = object.__hash__
+
+    def __and__(self, other):
+        return self._binary(other, np.logical_and)
+
+    def __rand__(self, other):
+        return self._binary(other, np.logical_and, reverse=True)
+
+    def __or__(self, other):
+        return self._binary(other, np.logical_or)
+
+    def __ror__(self, other):
+        return self._binary(other, np.logical_or, reverse=True)
+
+    def __invert__(self):
+        return ElementwiseExpression(np.logical_not, [self])
+
+
+class MapLeaf(MapExpression):
+    """ A map that is read block by block.
+
+    Arguments:
+        source (numpy array or callable): Either the full map, or a function
+            taking (start, stop) and returning those pixels.
+        nside (int): The nside of the map. Inferred from 'source' if it is an
+            array.
+        ordering (string): 'ring' or 'nested'.
+    """
+
+    def __init__(self, source, nside=None, ordering='ring'):
+        if callable(source):
+            if nside is None:
+                raise ValueError("nside must be given for callable sources")
+            self._read = source
+        else:
+            source = np.asarray(source)
+            if nside is None:
+                nside = healpy.pixelfunc.npix2nside(len(source))
+            self._read = lambda start, stop: source[start:stop]
+        self.nside = nside
+        self.ordering = ordering.lower()
+
+    def _eval_block(self, start, stop):
+        return self._read(start, stop)
+
+
+class ElementwiseExpression(MapExpression):
+    """ A numpy ufunc (or any elementwise function) applied to operands.
+
+    Operands can be MapExpressions or scalars. All map operands must have the
+    same nside and ordering.
+    """
+
+    def __init__(self, func, operands):
+        maps = [op for op in operands if isinstance(op, MapExpression)]
+        if not maps:
+            raise ValueError("At least one operand must be a map expression")
+        for op in maps[1:]:
+            if op.nside != maps[0].nside or op.ordering != maps[0].ordering:
+                raise ValueError("Map operands have different nside or "
+                                 "ordering")
+        self._func = func
+        self._operands = list(operands)
+        self.nside = maps[0].nside
+        self.ordering = maps[0].ordering
+
+    def children(self):
+        return [op for op in self._operands if isinstance(op, MapExpression)]
+
+    def _eval_block(self, start, stop):
+        args = [op._eval_block(start, stop) if isinstance(op, MapExpression)
+                else op for op in self._operands]
+        return self._func(*args)
+
+
+class UdGradeExpression(MapExpression):
+    """ Change of resolution, as healpy.ud_grade (with pess=False).
+
+    For NESTED maps, the output is computed block by block from the matching
+    block of the input. For RING maps, the input is evaluated in full (block
+    by block) before the regridding.
+    """
+
+    def __init__(self, child, nside_out):
+        if not healpy.pixelfunc.isnsideok(nside_out):
+            raise ValueError('Wrong nside parameter.')
+        self._child = child
+        self._materialized = None
+        self.nside = nside_out
+        self.ordering = child.ordering
+
+    def children(self):
+        return [self._child]
+
+    def _prepare(self, block_size, num_threads):
+        if self.ordering == 'nested' or self._materialized is not None:
+            MapExpression._prepare(self, block_size, num_threads)
+            return
+        full = self._child.evaluate(block_size=block_size,
+                                    num_threads=num_threads)
+        self._materialized = healpy.ud_grade(full, self.nside)
+
+    def _eval_block(self, start, stop):
+        if self._materialized is not None:
+            return self._materialized[start:stop]
+        nside_in = self._child.nside
+        if self.nside <= nside_in:
+            ratio = (nside_in // self.nside) ** 2
+            block = self._child._eval_block(start * ratio, stop * ratio)
+            block = np.asarray(block, dtype=np.float64).reshape(-1, ratio)
+            good = ~healpy.pixelfunc.mask_bad(block)
+            count = good.sum(axis=1)
+            total = np.where(good, block, 0).sum(axis=1)
+            out = np.full(stop - start, healpy.UNSEEN)
+            nonzero = count > 0
+            out[nonzero] = total[nonzero] / count[nonzero]
+            return out
+        ratio = (self.nside // nside_in) ** 2
+        first = start // ratio
+        last = -(-stop // ratio)
+        block = np.repeat(self._child._eval_block(first, last), ratio)
+        return block[start - first * ratio:stop - first * ratio]
+
+
+def _run_blocks(func, items, num_threads):
+    "Calls func on every item, on a thread pool if num_threads > 1."
+    if num_threads is None or num_threads <= 1:
+        for item in items:
+            func(item)
+        return
+    with futures.ThreadPoolExecutor(max_workers=num_threads) as pool:
+        for result in [pool.submit(func, item) for item in items]:
+            result.result()
+
+
+def lazy(source, ordering='ring', column=0):
+    """ Wraps a map as a leaf of a lazy expression.
+
+    Arguments:
+        source (numpy array, fullmap object or MapExpression): The map. For
+            fullmap objects read with read_planck_fullmap(lazy=True), the
+            column is decoded block by block straight from the file.
+        ordering (string): The ordering of the map if 'source' is an array.
+        column (int): Which column to use if 'source' is a fullmap object.
+
+    Returns:
+        MapExpression representing the map.
+    """
+    if isinstance(source, MapExpression):
+        return source
+    if isinstance(source, dict):
+        data = source['data']
+        if isinstance(data, fits_io_utils.LazyMapColumns):
+            return MapLeaf(lambda start, stop: data.read_block(column, start,
+                                                               stop),
+                           nside=source['nside'],
+                           ordering=source['ordering'])
+        return MapLeaf(data[column], nside=source['nside'],
+                       ordering=source['ordering'])
+    return MapLeaf(source, ordering=ordering)
+
+
+def where(condition, x, y):
+    "Lazy equivalent of np.where."
+    return ElementwiseExpression(np.where, [condition, x, y])
+
+
+def apply(func, *operands):
+    "Lazily applies an elementwise function to maps and scalars."
+    return ElementwiseExpression(func, list(operands))
+
+
+def ud_grade(expression, nside_out):
+    "Lazy equivalent of healpy.ud_grade."
+    return UdGradeExpression(lazy(expression), nside_out)
@@ -1,12 +1,23 @@
 from utils import fits_utils
 import copy
+import healpy
 import numpy as np
+import os
+import tempfile
+import threading
+
+# Directory in which ordering permutation tables are stored between
+# processes. None means that the tables are only cached in memory.
+REORDER_CACHE_DIR = None
+
+_reorder_cache = {}
+_reorder_cache_lock = threading.Lock()
 
 
 def bundle_fullmap(data, default_metadata={}, ordering=None, header=None,
                    column_properties=None, column_units=None,
                    column_names=None, comments=[], header_filter=None,
-                   unit_map=None, metadata_filter=None):
+                   unit_map=None, metadata_filter=None, nside=None):
 
     """ Creates a bona fide fullmap object (a dict) to be used internally.
 
@@ -40,6 +51,8 @@ def bundle_fullmap(data, default_metadata={}, ordering=None, header=None,
             the new map object.
         metadata_filter (list of ints): This provides the same functionality as
             the header_filter, but applied to default_metadata.
+        nside (int): The nside of the map. If None, it is inferred from the
+            length of the first data column.
 
     Returns:
         a dict representing the fullmap object described in README.txt
@@ -56,13 +69,15 @@ def bundle_fullmap(data, default_metadata={}, ordering=None, header=None,
                          "equal")
     if header is None:
         header = default_metadata.get('orig_header', None)
+    header = fits_utils.index_header(header)
     if ordering is None:
         ordering = default_metadata.get(
             'ordering', None)
         if ordering is None:
             ordering = fits_utils.get_hdu_header_val(
                 header, 'ORDERING').lower()
-    nside = int(np.sqrt(len(data[0]) / 12))
+    if nside is None:
+        nside = int(np.sqrt(len(data[0]) / 12))
     if column_properties is None:
         column_properties = default_metadata.get(
             'column_properties', None)
@@ -72,7 +87,7 @@ def bundle_fullmap(data, default_metadata={}, ordering=None, header=None,
     if column_properties is not None and metadata_filter is not None:
         colprops_old = copy.deepcopy(column_properties)
         column_properties = {}
-        for key, columns in colprops_old.iteritems():
+        for key, columns in colprops_old.items():
             newcols = []
             count = 0
             for col in metadata_filter:
@@ -266,6 +281,369 @@ def bundle_cutout(data, default_metadata={}, header=None,
             'column_names': column_names, 'orig_header_filter': header_filter}
 
 
+class MapArray(object):
+    """ Compact fullmap object backed by a single (ncol, npix) buffer.
+
+    All columns live in one contiguous 2-D array. Column selection, column
+    reordering and unit relabelling return new MapArray objects that share
+    that buffer, so no pixel data is copied. The object can be converted to
+    and from the dict form produced by bundle_fullmap.
+
+    Indexing a MapArray with an integer returns a view of that column, and
+    len() gives the number of columns, so it can also be used wherever the
+    'data' list of a fullmap object is expected.
+    """
+
+    __slots__ = ('_buffer', '_columns', 'nside', 'ordering',
+                 'column_properties', 'column_units', 'column_names',
+                 'comments', 'filename', 'orig_header', 'orig_header_filter')
+
+    def __init__(self, buffer, ordering, column_properties, column_units,
+                 column_names, comments=None, filename=None, orig_header=None,
+                 orig_header_filter=None, columns=None):
+        """
+        Arguments:
+            buffer (numpy array of shape (n, npix) or (npix)): The pixel data.
+                It is used as is, without copying.
+            ordering (string): 'ring' or 'nested'.
+            column_properties (dict of string->list of ints): See
+                bundle_fullmap. Refers to the selected columns.
+            column_units, column_names (lists of strings): See bundle_fullmap.
+            comments (list of strings): See bundle_fullmap.
+            filename, orig_header, orig_header_filter: See bundle_fullmap.
+            columns (slice, list of ints or None): Which rows of the buffer
+                make up the columns of this map. None means all of them.
+        """
+        buffer = np.asarray(buffer)
+        if buffer.ndim == 1:
+            buffer = buffer.reshape(1, -1)
+        if columns is None:
+            columns = slice(0, buffer.shape[0], 1)
+        self._buffer = buffer
+        self._columns = columns
+        self.nside = int(np.sqrt(buffer.shape[1] / 12))
+        self.ordering = ordering
+        self.column_properties = column_properties
+        self.column_units = column_units
+        self.column_names = column_names
+        self.comments = comments if comments is not None else []
+        self.filename = filename
+        self.orig_header = orig_header
+        self.orig_header_filter = orig_header_filter
+        if (len(column_units) != len(self) or
+                len(column_names) != len(self)):
+            raise ValueError("Length of data is not equal to length of "
+                             "column units or names")
+
+    @classmethod
+    def from_fullmap(cls, fmap):
+        """ Creates a MapArray from a fullmap dict.
+
+        If the data of the map is already a 2-D array it is used without
+        copying, otherwise the columns are stacked into a new buffer.
+
+        Arguments:
+            fmap (dict): A fullmap object as returned by bundle_fullmap.
+
+        Returns:
+            MapArray containing the same data and metadata.
+        """
+        data = fmap['data']
+        if isinstance(data, MapArray):
+            return data
+        if not (isinstance(data, np.ndarray) and data.ndim == 2):
+            data = np.stack([np.asarray(col) for col in data])
+        return cls(data, fmap['ordering'], fmap['column_properties'],
+                   fmap['column_units'], fmap['column_names'],
+                   comments=fmap.get('comments', []),
+                   filename=fmap.get('filename', None),
+                   orig_header=fmap.get('orig_header', None),
+                   orig_header_filter=fmap.get('orig_header_filter', None))
+
+    def to_fullmap(self):
+        """ Converts the map to the dict form used by bundle_fullmap.
+
+        Returns:
+            dict whose 'data' is a list of views into the buffer of this map.
+        """
+        return {'data': [self[i] for i in range(len(self))],
+                'orig_header': self.orig_header, 'type': 'fullmap',
+                'nside': self.nside,
+                'column_properties': self.column_properties,
+                'ordering': self.ordering,
+                'column_units': self.column_units,
+                'comments': self.comments, 'filename': self.filename,
+                'column_names': self.column_names,
+                'orig_header_filter': self.orig_header_filter}
+
+    def _rows(self):
+        if isinstance(self._columns, slice):
+            return range(*self._columns.indices(self._buffer.shape[0]))
+        return self._columns
+
+    def __len__(self):
+        return len(self._rows())
+
+    def __getitem__(self, idx):
+        return self._buffer[self._rows()[idx]]
+
+    def __iter__(self):
+        for row in self._rows():
+            yield self._buffer[row]
+
+    @property
+    def npix(self):
+        return self._buffer.shape[1]
+
+    @property
+    def data(self):
+        """ The selected columns as a 2-D array of shape (ncol, npix).
+
+        This is a view of the buffer whenever the selected columns are evenly
+        spaced rows of it (which includes any contiguous selection), and a
+        copy otherwise.
+        """
+        if isinstance(self._columns, slice):
+            return self._buffer[self._columns]
+        rows = self._columns
+        if len(rows) == 1:
+            return self._buffer[rows[0]:rows[0] + 1]
+        step = rows[1] - rows[0]
+        if step > 0 and all(rows[i + 1] - rows[i] == step
+                            for i in range(len(rows) - 1)):
+            return self._buffer[rows[0]:rows[-1] + 1:step]
+        return self._buffer[list(rows)]
+
+    def _new(self, columns, column_properties, column_units, column_names):
+        return MapArray(self._buffer, self.ordering, column_properties,
+                        column_units, column_names, comments=self.comments,
+                        filename=self.filename, orig_header=self.orig_header,
+                        orig_header_filter=self.orig_header_filter,
+                        columns=columns)
+
+    def select_columns(self, columns):
+        """ Returns a map containing only the given columns, in that order.
+
+        No pixel data is copied; the new map shares the buffer of this one.
+
+        Arguments:
+            columns (list of ints): The columns to keep. The same list can be
+                used to reorder the columns.
+
+        Returns:
+            MapArray with the selected columns and the matching metadata.
+        """
+        rows = self._rows()
+        new_rows = [rows[col] for col in columns]
+        column_properties = {}
+        for key, cols in self.column_properties.items():
+            cols = set(cols)
+            column_properties[key] = [i for i, col in enumerate(columns)
+                                      if col in cols]
+        column_units = [self.column_units[col] for col in columns]
+        column_names = [self.column_names[col] for col in columns]
+        return self._new(new_rows, column_properties, column_units,
+                         column_names)
+
+    def select_property(self, column_property):
+        """ Returns a map containing the columns with the given property.
+
+        Arguments:
+            column_property (string): E.g. 'signal' or 'covariance'.
+
+        Returns:
+            MapArray sharing the buffer of this map.
+        """
+        return self.select_columns(
+            self.column_properties.get(column_property, []))
+
+    def with_units(self, column_units):
+        """ Returns a map with new unit labels, sharing the pixel data.
+
+        Arguments:
+            column_units (list of strings): The new unit of each column.
+
+        Returns:
+            MapArray sharing the buffer of this map.
+        """
+        if len(column_units) != len(self):
+            raise ValueError("Length of data is not equal to length of "
+                             "column units")
+        return self._new(self._columns, self.column_properties,
+                         list(column_units), self.column_names)
+
+    def reorder(self, ordering, cache_dir=None):
+        """ Returns the map converted to the given ordering.
+
+        All selected columns are permuted with a single call, into a new
+        buffer. If the map already has the requested ordering, it is returned
+        unchanged.
+
+        Arguments:
+            ordering (string): 'ring' or 'nested'.
+            cache_dir (string or None): See get_reorder_indices.
+
+        Returns:
+            MapArray in the requested ordering.
+        """
+        ordering = ordering.lower()
+        if self.ordering.lower() == ordering:
+            return self
+        buffer = reorder_columns(self.data, self.nside, ordering,
+                                 cache_dir=cache_dir)
+        return MapArray(buffer, ordering, self.column_properties,
+                        self.column_units, self.column_names,
+                        comments=self.comments, filename=self.filename,
+                        orig_header=self.orig_header,
+                        orig_header_filter=self.orig_header_filter)
+
+
+def iterate_map_chunks(fmap, chunk_size):
+    """ Iterates over a map object in blocks of consecutive pixels.
+
+    Arguments:
+        fmap (dict): The fullmap object to iterate over.
+        chunk_size (int): The number of pixels in each block.
+
+    Returns:
+        Generator yielding lists of 1-D views, one per map column, each
+            covering the next block of pixels.
+    """
+
+    data = fmap['data']
+    npix = len(data[0])
+    for start in range(0, npix, chunk_size):
+        yield [col[start:start + chunk_size] for col in data]
+
+
+def get_reorder_indices(nside, ordering, cache_dir=None):
+    """ Returns the permutation that converts a map to the given ordering.
+
+    If m is a map in the opposite ordering, m[idx] is the map in 'ordering'.
+    The permutations are cached per (nside, ordering) for the lifetime of the
+    process, and optionally on disk, so they are only computed once.
+
+    Arguments:
+        nside (int): The nside of the map.
+        ordering (string): 'ring' or 'nested', the ordering to convert to.
+        cache_dir (string or None): Directory for the on-disk cache. If None,
+            REORDER_CACHE_DIR is used. Tables found on disk are memory-mapped.
+
+    Returns:
+        Read-only numpy integer array of length 12 * nside ** 2.
+    """
+
+    ordering = ordering.lower()
+    if ordering not in ('ring', 'nested'):
+        raise ValueError("Unknown ordering %s" % ordering)
+    key = (nside, ordering)
+    idx = _reorder_cache.get(key, None)
+    if idx is not None:
+        return idx
+    with _reorder_cache_lock:
+        idx = _reorder_cache.get(key, None)
+        if idx is not None:
+            return idx
+        if cache_dir is None:
+            cache_dir = REORDER_CACHE_DIR
+        cache_fname = None
+        if cache_dir is not None:
+            cache_fname = os.path.join(
+                cache_dir, 'reorder_%s_n%d.npy' % (ordering, nside))
+            if os.path.exists(cache_fname):
+                idx = np.load(cache_fname, mmap_mode='r')
+        if idx is None:
+            npix = healpy.pixelfunc.nside2npix(nside)
+            idx_dtype = np.int32 if npix < 2 ** 31 else np.int64
+            pixels = np.arange(npix, dtype=idx_dtype)
+            if ordering == 'nested':
+                idx = healpy.pixelfunc.nest2ring(nside, pixels)
+            else:
+                idx = healpy.pixelfunc.ring2nest(nside, pixels)
+            idx = idx.astype(idx_dtype, copy=False)
+            idx.flags.writeable = False
+            if cache_fname is not None:
+                _save_reorder_indices(cache_fname, idx)
+        _reorder_cache[key] = idx
+    return idx
+
+
+def _save_reorder_indices(fname, idx):
+    "Atomically writes a permutation table to the on-disk cache."
+    dirname = os.path.dirname(fname)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmpname = tempfile.mkstemp(dir=dirname, suffix='.npy')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, idx)
+        os.rename(tmpname, fname)
+    except OSError:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+
+
+def clear_reorder_cache():
+    "Empties the in-memory cache of ordering permutations."
+    with _reorder_cache_lock:
+        _reorder_cache.clear()
+
+
+def reorder_columns(columns, nside, ordering, cache_dir=None):
+    """ Converts all columns of a map to the given ordering.
+
+    The permutation is looked up once and applied to every column. A 2-D
+    array is reordered with a single numpy call into a new array. A list is
+    reordered in place, replacing one column at a time, so that only one
+    extra column is held in memory.
+
+    Arguments:
+        columns (list of arrays or array of shape (n, npix)): The map columns,
+            in the ordering opposite to 'ordering'.
+        nside (int): The nside of the map.
+        ordering (string): 'ring' or 'nested', the ordering to convert to.
+        cache_dir (string or None): See get_reorder_indices.
+
+    Returns:
+        The reordered columns: a new 2-D array if the input was a 2-D array,
+            and the input list otherwise.
+    """
+
+    idx = get_reorder_indices(nside, ordering, cache_dir=cache_dir)
+    if isinstance(columns, np.ndarray) and columns.ndim == 2:
+        return np.take(columns, idx, axis=1)
+    for i, col in enumerate(columns):
+        columns[i] = np.take(col, idx)
+    return columns
+
+
+def reorder_map(fmap, ordering, cache_dir=None):
+    """ Converts a fullmap object to the given ordering.
+
+    Arguments:
+        fmap (dict): The fullmap object to convert.
+        ordering (string): 'ring' or 'nested'.
+        cache_dir (string or None): See get_reorder_indices.
+
+    Returns:
+        A new fullmap object sharing the metadata of fmap, with reordered
+            data. If fmap already has the requested ordering, it is returned
+            unchanged.
+    """
+
+    ordering = ordering.lower()
+    if fmap['ordering'].lower() == ordering:
+        return fmap
+    outmap = dict(fmap)
+    data = fmap['data']
+    if not (isinstance(data, np.ndarray) and data.ndim == 2):
+        data = list(data)
+    outmap['data'] = reorder_columns(data, fmap['nside'], ordering,
+                                     cache_dir=cache_dir)
+    outmap['ordering'] = ordering
+    return outmap
+
+
 def sign_map(fmap, job_id=None):
 
     """ Utility function for having a uniform way of signing a map with a job
@@ -1,35 +1,310 @@
+import bisect
+import math
+
 import numpy as np
 
-def moving_average(data, window_size, weights=None):
-    # Pads symmetrically around start and end points
+def moving_average(data, window_size, weights=None, axis=-1):
+    """ Weighted moving average with symmetric padding at the edges.
+
+    Output point i is the weighted mean of padded_data[i:i+window_size+1],
+    with the padding of pad_data. The window sums are differences of
+    cumulative sums, so the cost does not depend on the window size.
+
+    Arguments:
+        data (np.array): The data. For arrays of more than one dimension,
+            every 1-D slice along axis is smoothed independently.
+        window_size (int): The window size.
+        weights (np.array): Optional weights, either of the same shape as
+            data or 1-D along axis.
+        axis (int): The axis to smooth along.
+
+    Returns:
+        Array of the same shape as data.
+    """
+    shift, sum_weights, sum_dev = _window_sums(data, window_size, weights,
+                                               axis, 1)
+    return np.moveaxis(shift + sum_dev / sum_weights, -1, axis)
+
+def moving_variance(data, window_size, weights=None, axis=-1):
+    """ Weighted moving variance with symmetric padding at the edges.
+
+    Output point i is the (population) variance of
+    padded_data[i:i+window_size+1], computed from cumulative sums as for
+    moving_average.
+
+    Arguments:
+        data (np.array): The data. For arrays of more than one dimension,
+            every 1-D slice along axis is treated independently.
+        window_size (int): The window size.
+        weights (np.array): Optional weights, either of the same shape as
+            data or 1-D along axis.
+        axis (int): The axis to compute the variance along.
+
+    Returns:
+        Array of the same shape as data.
+    """
+    _, sum_weights, sum_dev, sum_sqdev = _window_sums(data, window_size,
+                                                      weights, axis, 2)
+    mean_dev = sum_dev / sum_weights
+    variance = sum_sqdev / sum_weights - mean_dev * mean_dev
+    return np.moveaxis(np.maximum(variance, 0), -1, axis)
+
 
+def moving_median(data, window_size, axis=-1):
+    """ Moving median with symmetric padding at the edges.
+
+    Output point i is the median of padded_data[i:i+window_size+1], with
+    the padding of pad_data, ignoring NaNs (NaN if the window holds no
+    other values). See moving_quantile.
+    """
+    return moving_quantile(data, window_size, None, axis=axis)
+
+def moving_quantile(data, window_size, quantile, axis=-1):
+    """ Moving quantile with symmetric padding at the edges.
+
+    Output point i is the quantile of padded_data[i:i+window_size+1], with
+    the padding of pad_data, computed like np.nanquantile (linear
+    interpolation, NaNs ignored). The window is kept as a sorted list as
+    it slides, so each step is a binary search and an O(w) list shift
+    instead of a new O(w log w) sort.
+
+    Arguments:
+        data (np.array): The data. For arrays of more than one dimension,
+            every 1-D slice along axis is filtered independently.
+        window_size (int): The window size.
+        quantile (float): The quantile, between 0 and 1. None gives the
+            median as np.median computes it (mean of the middle values).
+        axis (int): The axis to filter along.
+
+    Returns:
+        Array of the same shape as data.
+    """
+    if quantile is not None and not 0 <= quantile <= 1:
+        raise ValueError("Quantile must be between 0 and 1: "
+                         "{}".format(quantile))
+    data = np.moveaxis(np.asarray(data, dtype=np.float64), axis, -1)
     padded_data = pad_data(data, window_size)
-    if weights is not None:
-        padded_weights = pad_data(weights, window_size)
+    num = data.shape[-1]
+    highs = np.minimum(np.arange(num) + int(window_size) + 1,
+                       padded_data.shape[-1])
+    res = np.empty(data.shape)
+    flat_res = res.reshape(-1, num)
+    for row, padded_row in enumerate(padded_data.reshape(-1,
+                                                         padded_data.shape[-1])):
+        flat_res[row] = _sorted_window_quantiles(padded_row.tolist(), highs,
+                                                 quantile)
+    return np.moveaxis(res, -1, axis)
+
+
+def _sorted_window_quantiles(values, highs, quantile):
+    """ Quantiles of values[i:highs[i]] for each i, skipping NaNs. """
+    window = []
+    res = []
+    curr_high = 0
+    for low, high in enumerate(highs.tolist()):
+        for value in values[curr_high:high]:
+            if value == value:
+                bisect.insort(window, value)
+        curr_high = high
+        res.append(_sorted_quantile(window, quantile))
+        value = values[low]
+        if value == value:
+            del window[bisect.bisect_left(window, value)]
+    return res
+
+
+def _sorted_quantile(window, quantile):
+    """ Quantile of a sorted list, interpolated as np.quantile does.
+
+    A quantile of None gives the median as np.median computes it.
+    """
+    num = len(window)
+    if num == 0:
+        return np.nan
+    if quantile is None:
+        middle = num // 2
+        if num % 2:
+            return window[middle]
+        return (window[middle - 1] + window[middle]) / 2.
+    virtual_index = (num - 1) * quantile
+    lower = min(max(math.floor(virtual_index), 0), num - 1)
+    upper = min(lower + 1, num - 1)
+    gamma = virtual_index - math.floor(virtual_index)
+    diff = window[upper] - window[lower]
+    if gamma >= 0.5:
+        return window[upper] - diff * (1 - gamma)
+    return window[lower] + diff * gamma
+
+
+def segmented_moving_average(data, weights, windows, segment_starts=None,
+                             edge='reflect', axis=-1):
+    """ Weighted moving average with a per-sample window inside segments.
+
+    The window of sample i spans windows[i] + 1 samples starting at
+    i - windows[i] // 2, as in moving_average, but never crosses the
+    boundaries of the segment (e.g. PID range) that sample i belongs to.
+    All window sums are differences of cumulative sums, so the cost is
+    O(n) whatever the window sizes.
+
+    Arguments:
+        data (np.array): The data. For arrays of more than one dimension,
+            every 1-D slice along axis is smoothed independently.
+        weights (np.array): Weights of the data points (e.g. inverse
+            variances), broadcastable to data. None gives equal weights.
+        windows (np.array of ints): The window size of each sample, either
+            1-D along axis or of the same shape as data.
+        segment_starts (np.array of ints): Indices along axis at which new
+            segments start. The first segment always starts at 0. None
+            means a single segment.
+        edge (string): 'reflect' mirrors windows[i] // 2 points at the
+            segment edges, like pad_data does at the ends of the array;
+            reflections longer than the segment are truncated. 'truncate' only uses
+            the part of the window inside the segment.
+        axis (int): The axis to smooth along.
+
+    Returns:
+        Array of the same shape as data.
+    """
+    if edge not in ('reflect', 'truncate'):
+        raise ValueError("Unknown edge mode: {}".format(edge))
+    data = np.moveaxis(np.asarray(data, dtype=np.float64), axis, -1)
+    num = data.shape[-1]
+    if weights is None:
+        weights = np.ones(num)
+    weights = np.asarray(weights, dtype=np.float64)
+    if weights.ndim > 1:
+        weights = np.moveaxis(weights, axis, -1)
+    weights = np.broadcast_to(weights, data.shape)
+    windows = np.asarray(windows, dtype=np.int64)
+    if windows.ndim > 1:
+        windows = np.moveaxis(windows, axis, -1)
+    windows = np.broadcast_to(windows, data.shape)
+
+    if segment_starts is None:
+        segment_starts = []
+    starts = np.union1d([0], np.asarray(segment_starts, dtype=np.int64))
+    if starts[0] < 0 or starts[-1] >= max(num, 1):
+        raise ValueError("Segment starts must lie within the data")
+    ends = np.append(starts[1:], num)
+    indices = np.arange(num)
+    segment = np.searchsorted(starts, indices, side='right') - 1
+    seg_start, seg_end = starts[segment], ends[segment]
+
+    # Shift each segment by the mean of its finite values so the cumulative
+    # sums stay small
+    finite = np.isfinite(data)
+    with np.errstate(invalid='ignore'):
+        shift = (np.add.reduceat(np.where(finite, data, 0.), starts, axis=-1) /
+                 np.add.reduceat(finite, starts, axis=-1))
+    shift = np.nan_to_num(shift, nan=0.)[..., segment]
+    weighted_dev = weights * (data - shift)
+
+    lows = indices - windows // 2
+    highs = lows + windows + 1
+    inner_lows = np.maximum(lows, seg_start)
+    inner_highs = np.minimum(highs, seg_end)
+    if edge == 'reflect':
+        seg_len = seg_end - seg_start
+        num_left = np.clip(seg_start - lows, 0, seg_len)
+        num_right = np.clip(highs - seg_end, 0,
+                            np.minimum(seg_len, windows // 2))
+
+    def window_sum(cumulative):
+        total = (np.take_along_axis(cumulative, inner_highs, axis=-1) -
+                 np.take_along_axis(cumulative, inner_lows, axis=-1))
+        if edge == 'reflect':
+            total += (
+                np.take_along_axis(cumulative, seg_start + num_left, axis=-1) -
+                cumulative[..., seg_start] +
+                cumulative[..., seg_end] -
+                np.take_along_axis(cumulative, seg_end - num_right, axis=-1))
+        return total
+
+    sums = [_local_window_sum(np.broadcast_to(weights, data.shape), window_sum),
+            _local_window_sum(weighted_dev, window_sum)]
+    return np.moveaxis(shift + sums[1] / sums[0], -1, axis)
+
+
+def _window_sums(data, window_size, weights, axis, order):
+    """ Windowed sums of weights and of weighted powers of the data.
+
+    The data are shifted by the mean of the finite values of each padded
+    slice before the cumulative sums are taken. This keeps the cumulative
+    sums small, so the differences between them (the window sums) do not
+    lose precision to cancellation. Windows holding a NaN get NaN sums.
+
+    Returns:
+        The shift and the window sums of w, w * (x - shift) and, if
+        order == 2, w * (x - shift)**2, each with the smoothing axis last.
+    """
+    data = np.moveaxis(np.asarray(data, dtype=np.float64), axis, -1)
+    num = data.shape[-1]
+    padded_data = pad_data(data, window_size)
+    if weights is None:
+        padded_weights = np.ones(padded_data.shape[-1])
     else:
-        padded_weights = np.ones(len(padded_data))
+        weights = np.asarray(weights, dtype=np.float64)
+        if weights.ndim > 1:
+            weights = np.moveaxis(weights, axis, -1)
+        padded_weights = pad_data(weights, window_size)
 
-    means = []
-    for i in range(len(data)):
-        means.append(np.average(padded_data[i:i+int(window_size)+1],
-                                weights=padded_weights[i:i+int(window_size)+1]))
+    lows = np.arange(num)
+    highs = np.minimum(lows + int(window_size) + 1, padded_data.shape[-1])
 
-    return np.array(means)
+    def window_sum(cumulative):
+        return cumulative[..., highs] - cumulative[..., lows]
 
-def moving_variance(data, window_size):
+    finite = np.isfinite(padded_data)
+    with np.errstate(invalid='ignore'):
+        shift = (np.sum(padded_data, axis=-1, keepdims=True, where=finite) /
+                 np.sum(finite, axis=-1, keepdims=True))
+    shift = np.nan_to_num(shift, nan=0.)
+    weighted_dev = padded_weights * (padded_data - shift)
+    sums = [shift,
+            _local_window_sum(np.broadcast_to(padded_weights,
+                                              weighted_dev.shape), window_sum),
+            _local_window_sum(weighted_dev, window_sum)]
+    if order == 2:
+        sums.append(_local_window_sum(weighted_dev * (padded_data - shift),
+                                      window_sum))
+    return sums
 
-    padded_data = np.append(np.append(data[int(window_size/2)-1::-1], data), data[-1:-int(window_size/2)-1:-1])
 
-    variance = []
+def _local_window_sum(values, window_sum):
+    """ Window sums of values taken from their cumulative sums.
 
-    for i in range(len(data)):
-        variance.append(np.var(padded_data[i:i+int(window_size)+1]))
+    Non-finite values are left out of the cumulative sums, where a single
+    NaN would spoil every later window, and only set the windows holding
+    them to NaN.
 
-    return variance
+    Arguments:
+        values (np.array): The values, summed along the last axis.
+        window_sum (function): Gives the window sums from an array of
+            cumulative sums along the last axis that starts with 0.
 
+    Returns:
+        The window sums.
+    """
+    shape = values.shape[:-1] + (values.shape[-1] + 1,)
+    finite = np.isfinite(values)
+    cumulative = np.zeros(shape)
+    np.cumsum(np.where(finite, values, 0.), axis=-1, out=cumulative[..., 1:])
+    total = window_sum(cumulative)
+    if not finite.all():
+        num_bad = np.zeros(shape)
+        np.cumsum(~finite, axis=-1, out=num_bad[..., 1:])
+        total[window_sum(num_bad) > 0] = np.nan
+    return total
 
 
-def pad_data(data, window_size):
-    padded_data = np.append(np.append(data[int(window_size/2)-1::-1], data), data[-1:-int(window_size/2)-1:-1])
+def pad_data(data, window_size, axis=-1):
+    """ Pads data symmetrically by reflecting int(window_size/2) points.
 
-    return padded_data
+    Works along the given axis of arrays of any dimension.
+    """
+    num = np.shape(data)[axis]
+    indices = np.arange(num)
+    half = int(window_size/2)
+    indices = np.append(np.append(indices[half-1::-1], indices),
+                        indices[-1:-half-1:-1])
+    return np.take(data, indices, axis=axis)